@@ -1,174 +1,119 @@
-import joblib
+import numpy as np
 import pandas as pd
-import time
 import datetime
-from datascratch import data_export
-import pymssql
-
-
-A_class = ["HJ02", "HJ03", "HJ04", "HJ05", "HJ06", "HJ07", "HJ08", "HJ09", "HJ10", "HJ11", "HJ12",
-            "HJ61", "HJ62", "HJ63", "HJ64", "HJ65", "HJ66", "HJ67", "HJ68", "HJ69", "HJ70", "HJ71",
-            "HJ72", "HJ73", "HJ74"]
-B_class = ["HJ15", "HJ16", "HJ17", "HJ18", "HJ19", "HJ20", "HJ22", "HJ23", "HJ24", "HJ25", "HJ26", "HJ27",
-            "HJ28", "HJ29", "HJ30", "HJ31"]
-C_class_1 = ["RPC_HJ84_L_TIC01_RKC_READ_PV"]
-C_class_2 = ["HJ83", "HJ82", "HJ81", "HJ75", "HJ76", "HJ78", "HJ79"]
-C_class_3 = ["HJ44", "HJ45", "HJ46", "HJ47", "HJ48", "HJ49"]
-
-en = []
-
-for i in A_class:
-    en_A = []
-    rpa = f"RPA_{i}_TIC01_RKC_READ_PV"
-    en_A.append(rpa)
-
-for i in B_class:
-    en_B = []
-    rpb = f"RPB_{i}_TIC01_RKC_READ_PV"
-    en_B.append(rpb)
-
-for i in C_class_2:
-    en_C_2 = []
-    rpc = f"RPC_{i}_TIC01_RKC_READ_PV"
-    en_C_2.append(rpc)
-
-for i in C_class_3:
-    en_C_3 = []
-    rpc_1 = f"RPC_{i}_M_TIC01_RKC_READ_PV"
-    en_C_3.append(rpc_1)
-
-    globals()[i+"_en"] = en
-
-# KQ01~KQ08的ch
-for i in machine:
-    ch = []
-    temp1 = f"{i}混合馬達震動值X"
-    temp2 = f"{i}混合機震動值Y"
-    temp3 = f"{i}熱拌機電流值"
-    temp4 = f"{i}熱拌機混合溫度"
-
-    ch.append(temp1)
-    ch.append(temp2)
-    ch.append(temp3)
-    ch.append(temp4)
-    globals()[i+"_ch"] = ch
-
-# 將各機台tag英文名稱+路徑結合，後面PI系統抓資料用
-pisource = 'pi:\\10.114.134.1\\'
-for i in machine:
-    globals()[i+"_pitag"] = [pisource + element for element in globals()[i+"_en"]]
-
-# 建立中英對照dict，tag_name_trans = 中英對照dict
-for i in machine:
-    globals()[i+"_namedict"] = dict((en, ch) for en, ch in zip(globals()[i+"_en"], globals()[i+"_ch"]))
-
-tag = [KQ01_pitag, KQ02_pitag, KQ03_pitag, KQ04_pitag, KQ05_pitag, KQ06_pitag, KQ07_pitag, KQ08_pitag]
-
-catboost = joblib.load('catboost.pkl')
-catboost_KQ07 = joblib.load('catboost_KQ#7.pkl')
-catboost_KQ08 = joblib.load('catboost_KQ#8.pkl')
-
-while True:
-    start = datetime.datetime.now() - datetime.timedelta(minutes=0)
-    end = datetime.datetime.now()
-    time_format = '%Y-%m-%d %H:%M:%S'
-
-    start_time = start.strftime(time_format)  # 注意这里使用了 strftime
-    end_time = end.strftime(time_format)      # 注意这里使用了 strftime
-    dt_time = datetime.datetime.strftime(end, time_format)
-
-    pi_data1 = data_export(start_time=start_time,
-                           end_time=end_time,
-                           tagpoint_list=tag[0],
-                           time_interval='1m').iloc[-1:, :]
-
-    pi_data2 = data_export(start_time=start_time,
-                           end_time=end_time,
-                           tagpoint_list=tag[1],
-                           time_interval='1m').iloc[-1:, :]
-
-    pi_data3 = data_export(start_time=start_time,
-                           end_time=end_time,
-                           tagpoint_list=tag[2],
-                           time_interval='1m').iloc[-1:, :]
-
-    pi_data4 = data_export(start_time=start_time,
-                           end_time=end_time,
-                           tagpoint_list=tag[3],
-                           time_interval='1m').iloc[-1:, :]
-
-    pi_data5 = data_export(start_time=start_time,
-                           end_time=end_time,
-                           tagpoint_list=tag[4],
-                           time_interval='1m').iloc[-1:, :]
-
-    pi_data6 = data_export(start_time=start_time,
-                           end_time=end_time,
-                           tagpoint_list=tag[5],
-                           time_interval='1m').iloc[-1:, :]
-
-    pi_data7 = data_export(start_time=start_time,
-                           end_time=end_time,
-                           tagpoint_list=tag[6],
-                           time_interval='1m').iloc[-1:, :]
-
-    pi_data8 = data_export(start_time=start_time,
-                           end_time=end_time,
-                           tagpoint_list=tag[7],
-                           time_interval='1m').iloc[-1:, :]
-
-    all_pi = [pi_data1, pi_data2, pi_data3, pi_data4, pi_data5, pi_data6, pi_data7, pi_data8]
-
-    # data = pd.read_excel('上線應用\pi_data\KQ_Data.xlsx')
-
-    all_machine = ['KQ01', 'KQ02', 'KQ03', 'KQ04', 'KQ05', 'KQ06', 'KQ07', 'KQ08']
-
-    temp_df = pd.DataFrame()
-
-    for i in range(len(all_pi)):
-
-        column_names = ['X', 'Y', 'C', 'T']
-        current_pi = all_pi[i].copy()
+from datascratch import data_export, data_export_at_times
+from poller import PollingEngine, Checkpoint
+from model_registry import load_model_registry
+from metrics import start_reporting
+import os
+from sql_sink import SQLSink, MSSQLBackend
+from tag_registry import load_registry
+
+
+# KQ01~KQ08 各 4 個 tag (X / Y / C / T) 的命名規則在 tag_registry.json 的 machines, 由 use_registry 載入
+registry = None
+all_machine = []
+tag = []
+all_tag = []
+
+
+# 依註冊表建立各機台的 tag 清單; PI tag 名稱還沒設定時丟 ValueError, 程式啟動就失敗, 不會輪詢不存在的 tag
+def use_registry(tag_registry):
+    global registry, all_machine, tag, all_tag
+    machines = tag_registry.machine_codes()
+    tag = [tag_registry.machine_paths([machine]) for machine in machines]
+    all_machine, all_tag, registry = machines, tag_registry.machine_paths(), tag_registry
+
+# 機台 -> 模型對照在 model_registry.json, 模型第一次用到才載入, 檔案更新會自動重新載入
+models = load_model_registry()
+
+# 健康度結果寫進 SQL Server; 連線資訊由環境變數提供, 資料庫斷線時先存在本機 spool 檔, 恢復後自動補寫
+# import 時不連線也不啟動背景執行緒, 由 __main__ 建立 (smoke_online.py 換成 SQLite)
+SQL_COLUMNS = ['DT', 'X', 'Y', 'C', 'T', 'Health', 'Status', 'Machine']
+sql_sink = None
+
+
+def open_sql_sink():
+    return SQLSink(MSSQLBackend(server=os.environ.get('KQ_SQL_SERVER'),
+                                user=os.environ.get('KQ_SQL_USER'),
+                                password=os.environ.get('KQ_SQL_PASSWORD'),
+                                database=os.environ.get('KQ_SQL_DATABASE'),
+                                login_timeout=10, timeout=60),
+                   table=os.environ.get('KQ_SQL_TABLE', 'KQ_Health'),
+                   columns=SQL_COLUMNS)
+
+
+def insert_data_to_sql(df):
+    return sql_sink.write(df)
+
+
+POLL_INTERVAL = 600         # 秒, 對齊整點的 :00, :10, :20 ...
+CHECKPOINT_PATH = './online_checkpoint.json'   # 最後處理的 tick 與待補抓的空窗
+
+
+# data: index = tick 時間, 欄位順序同 all_tag (可以是一輪的 1 列, 或補抓時的多列)
+# 電流 < 10 視為停機, 健康度直接給 0; 其餘共用同一個模型的機台所有列合併成一次 predict
+def score(data):
+    column_names = registry.channels
+    dt_time = data.index.strftime('%Y-%m-%d %H:%M:%S')
+    machine_pi = {}
+    offset = 0
+    for i in range(len(tag)):
+        current_pi = data.iloc[:, offset:offset + len(tag[i])].copy()
+        offset += len(tag[i])
         current_pi.columns = column_names
+        current_pi.index = range(len(current_pi))
+        machine_pi[all_machine[i]] = current_pi
+
+    stopped = {machine: (current_pi['C'] < 10).values for machine, current_pi in machine_pi.items()}
+    health = models.predict({machine: current_pi.values[~stopped[machine]]
+                             for machine, current_pi in machine_pi.items() if not stopped[machine].all()})
+
+    frames = []
+    for machine, current_pi in machine_pi.items():
+        machine_health = np.zeros(len(current_pi))
+        machine_status = np.zeros(len(current_pi), dtype=int)
+        if machine in health:
+            machine_health[~stopped[machine]] = health[machine]
+            machine_status[~stopped[machine]] = 1
+        current_pi['Health'] = machine_health
+        current_pi['Status'] = machine_status
+
+        current_pi['Machine'] = machine
+        current_pi['DT'] = dt_time
+        current_pi = current_pi[['DT'] + [col for col in current_pi.columns if col != 'DT']]
+        frames.append(current_pi)
+    return pd.concat(frames, ignore_index=True).sort_values('DT', kind='stable', ignore_index=True)
 
-        if (current_pi['C'] < 10).all():
-            current_pi['Health'] = 0
-            current_pi['Status'] = 0
-
-        elif i == 6:
-            current_pi['Health'] = catboost_KQ07.predict(current_pi.values)
-            current_pi['Status'] = 1
 
-        elif i == 7:
-            current_pi['Health'] = catboost_KQ08.predict(current_pi.values)
-            current_pi['Status'] = 1
+# 每個 tick 執行一次: 8 台機台的 tag 合成一次批次請求抓 tick 當下的值, 推論後寫入 SQL
+def poll_cycle(tick, timer):
+    with timer.stage('fetch'):
+        data = data_export_at_times(all_tag, [tick], use_cache=False)
 
-        else:
-            current_pi['Health'] = catboost.predict(current_pi.values)
-            current_pi['Status'] = 1
-        
-        current_pi['Machine'] = all_machine[i]
-        current_pi['DT'] = dt_time
-        current_pi = current_pi[['DT'] + [col for col in current_pi.columns if col != 'DT']]
+    with timer.stage('predict'):
+        temp_df = score(data)
 
-        # print('第', i+1, '台KQ:', '健康度:', current_pi['Health'])
+    with timer.stage('sql'):
+        insert_data_to_sql(temp_df)
 
-        temp_df = pd.concat([temp_df, current_pi], ignore_index=True)
-    #     print('1:', temp_df)
-    # print('2:', temp_df)
+    print(f"{datetime.datetime.now()}的數據上傳成功! {timer.summary()}")
 
-    insert_data_to_sql(temp_df)
 
-    # excel_name = os.path.join('pi_data', 'KQ_Data.xlsx')
-    # writer_data(temp_df, excel_name)
-    
-    # data = data.append(temp_df, ignore_index=True)
-    # excel_filename = os.path.join('上線應用', 'pi_data', 'KQ_Data.xlsx') # 這邊要依據當前目錄做更改喔
-    # # temp_df.to_excel(excel_filename, index=False)
-    # data.to_excel(excel_filename, index=False)
-    #     # all_result[i].to_excel(writer, sheet_name=f'KQ{str(i+1)}', index=False)
-    print(f"{datetime.datetime.now()}的數據上傳成功!")
+# 補抓停機/斷線期間的 tick: 整段一次區間查詢 (取樣間隔 = POLL_INTERVAL, 網格與 tick 對齊), 一次推論, 一次寫入
+def backfill_cycle(ticks):
+    data = data_export(ticks[0].strftime('%Y-%m-%d %H:%M:%S'), ticks[-1].strftime('%Y-%m-%d %H:%M:%S'),
+                       all_tag, time_interval=f'{POLL_INTERVAL}s')
+    data = data[data.index.isin(ticks)]
+    insert_data_to_sql(score(data))
 
-    time.sleep(600)
-    # break
 
+if __name__ == '__main__':
+    use_registry(load_registry())
+    sql_sink = open_sql_sink()
+    start_reporting()
+    try:
+        PollingEngine(POLL_INTERVAL, poll_cycle, checkpoint=Checkpoint(CHECKPOINT_PATH, POLL_INTERVAL),
+                      backfill=backfill_cycle).run()
+    finally:
+        sql_sink.close()
@@ -0,0 +1,171 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+import datascratch
+from datascratch import PISessionPool, PILogin, PIWEB_API_URL
+from export_engine import EXPORT_MODES, EXPORT_PLANS, is_closed_month
+from export_jobs import MODE_SUFFIX
+from exporter import write_artifact, FORMATS
+from fetch_engine import RateLimiter, set_rate_limit, deadline
+from month_matrix import count_missing
+from pi_cache import PIValueCache
+from range_export import month_range
+from tag_registry import load_registry
+
+############################ Parameters
+BATCH_DIR = './batch_exports'       # 預設輸出資料夾, 底下一個月一個子資料夾
+BATCH_PROCESSES = 4                 # 同時跑幾個月 (每個月一個程序)
+BATCH_RATE = 20.0                   # 所有程序合計每秒最多送幾個 PI 請求
+BATCH_MONTH_DEADLINE = 600          # 每個月最多等 PI 幾秒, 超過的格子標成 #N/A, 該月記為部分結果
+PARTIAL_MARKER = 'PARTIAL.json'     # 月份資料夾裡有這個檔 = 上次是部分結果, 下次重跑會重抓
+############################
+
+
+# 每個月要輸出的 [(棟別代碼, 檔名)]; 'ALL' 為全廠一個檔, 非快照模式的檔名加後綴 (與 UI 下載的檔名一樣)
+def _outputs(buildings, mode, registry):
+    names = dict(registry.buildings, ALL='全廠')
+    suffix = '' if mode == 'snapshot' else MODE_SUFFIX.get(mode, mode)
+    return [(code, f'{names[code]}{suffix}') for code in buildings]
+
+
+def _artifact_name(name, fmt):
+    return f'{name}壓縮檔.zip' if fmt == 'xlsx' else f'{name}.{fmt}'
+
+
+# 該月所有檔案都在且上次不是部分結果, 就不用再跑
+def _month_done(folder, outputs, fmts):
+    if os.path.exists(os.path.join(folder, PARTIAL_MARKER)):
+        return False
+    return all(os.path.exists(os.path.join(folder, _artifact_name(name, fmt))) for _, name in outputs for fmt in fmts)
+
+
+# 只要有一個棟別要全廠, 就一次抓全廠; 否則只抓指定的棟別
+def _fetch_scope(buildings):
+    return None if 'ALL' in buildings else list(buildings)
+
+
+# 每個 worker 程序啟動時執行一次: 裝上共用的速率上限, 換成自己的 PI 連線 (可指定其他 PI Web API) 與快取連線
+def _init_worker(limiter, pi_url):
+    set_rate_limit(limiter)
+    if pi_url != PIWEB_API_URL:
+        datascratch.SESSION_POOL = PISessionPool(login=lambda: PILogin(piweb_api_url=pi_url, keep_alive=True))
+    datascratch.VALUE_CACHE = PIValueCache(datascratch.VALUE_CACHE.path)
+
+
+# 一個月一個工作單位 (在 worker 程序裡執行): 所有棟別一次抓完共用批次請求, 再依棟別切開寫檔
+# 檔案先寫進暫存資料夾再搬到 {out}/{月}/, 中途被砍掉不會留下寫一半的檔案
+def export_month(x, buildings, mode, fmts, out, timeout=BATCH_MONTH_DEADLINE):
+    registry = load_registry()
+    t0 = time.perf_counter()
+    with deadline(timeout):
+        frames = EXPORT_MODES[mode](x, _fetch_scope(buildings), registry)
+    if 'ALL' in buildings:
+        frames['ALL'] = pd.concat(list(frames.values()))
+
+    folder = os.path.join(out, x)
+    tmp = os.path.join(folder, f'.tmp.{os.getpid()}')
+    os.makedirs(tmp, exist_ok=True)
+    missing = {}
+    try:
+        for code, name in _outputs(buildings, mode, registry):
+            n = count_missing(frames[code])
+            if n:
+                missing[code] = n
+            for fmt in fmts:
+                path = write_artifact(frames[code], name, tmp, fmt)
+                os.replace(path, os.path.join(folder, os.path.basename(path)))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    marker = os.path.join(folder, PARTIAL_MARKER)
+    if missing:
+        with open(marker, 'w', encoding='utf-8') as f:
+            json.dump(missing, f, ensure_ascii=False)
+    elif os.path.exists(marker):
+        os.remove(marker)
+    return {'month': x, 'seconds': round(time.perf_counter() - t0, 3), 'missing': missing}
+
+
+# 還沒完整輸出過的月份 (force = True 時全部); 還沒結束的月份之後的日子上次是補 0, 每次都重跑
+def pending(months, buildings, mode, fmts, out, force=False, registry=None):
+    outputs = _outputs(buildings, mode, registry or load_registry())
+    return [x for x in months
+            if force or not is_closed_month(x) or not _month_done(os.path.join(out, x), outputs, fmts)]
+
+
+# 估算要跑的月份會送出幾個 PI 請求 (只看本機快取與 WebID 索引, 不連 PI); 已輸出過的月份不算
+def plan(months, buildings, mode='snapshot', fmts=('xlsx',), out=BATCH_DIR, force=False):
+    registry = load_registry()
+    todo = pending(months, buildings, mode, fmts, out, force, registry)
+    planned = [dict(EXPORT_PLANS[mode](x, _fetch_scope(buildings), registry), month=x) for x in todo]
+    total = {key: sum(p[key] for p in planned) for key in ('http_requests', 'sub_requests', 'resolve_tags')}
+    return {'skipped': [x for x in months if x not in todo], 'months': planned, 'total': total}
+
+
+# 整批匯出: 每個月丟給 process pool 的一個程序, 所有程序共用一個 PI 請求速率上限
+# 已經完整輸出過且已結束的月份跳過 (force = True 時全部重跑); 回傳每個月的結果與失敗的月份
+def run_batch(months, buildings, mode='snapshot', fmts=('xlsx',), out=BATCH_DIR, processes=BATCH_PROCESSES,
+              rate=BATCH_RATE, timeout=BATCH_MONTH_DEADLINE, force=False, pi_url=PIWEB_API_URL):
+    todo = pending(months, buildings, mode, fmts, out, force)
+    report = {'skipped': [x for x in months if x not in todo], 'done': [], 'failed': {}}
+    if not todo:
+        return report
+    # spawn: worker 不繼承父程序的連線、執行緒與 sqlite 連線
+    context = multiprocessing.get_context('spawn')
+    limiter = RateLimiter(rate, context) if rate else None
+    with ProcessPoolExecutor(max_workers=min(processes, len(todo)), mp_context=context,
+                             initializer=_init_worker, initargs=(limiter, pi_url)) as pool:
+        futures = {pool.submit(export_month, x, buildings, mode, list(fmts), out, timeout): x for x in todo}
+        for future in as_completed(futures):
+            x = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                report['failed'][x] = f'{type(e).__name__}: {e}'
+                print(f'{x} 失敗: {e}', file=sys.stderr)
+                continue
+            report['done'].append(result)
+            status = f"部分結果 {result['missing']}" if result['missing'] else '完成'
+            print(f"{x} {status} ({result['seconds']}s)", file=sys.stderr)
+    report['done'].sort(key=lambda r: r['month'])
+    return report
+
+
+# python batch_export.py --start 2024-01 --end 2024-12 --buildings ALL --out D:/C1
+# python batch_export.py --start 2024-01 --end 2024-03 --buildings A B --mode summary --formats xlsx csv.gz
+# python batch_export.py --start 2023-01 --end 2024-12 --buildings ALL --dry-run    只估算請求數, 不連 PI
+# 有月份失敗或只拿到部分結果時 exit code = 1, 重跑同一個指令只會補那些月份
+if __name__ == '__main__':
+    codes = load_registry().building_codes()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--start', required=True, help='YYYY-MM')
+    parser.add_argument('--end', help='YYYY-MM, 預設與 --start 相同')
+    parser.add_argument('--buildings', nargs='+', default=['ALL'], choices=codes + ['ALL'])
+    parser.add_argument('--mode', default='snapshot', choices=list(EXPORT_MODES))
+    parser.add_argument('--formats', nargs='+', default=['xlsx'], choices=list(FORMATS))
+    parser.add_argument('--out', default=BATCH_DIR)
+    parser.add_argument('--processes', type=int, default=BATCH_PROCESSES)
+    parser.add_argument('--rate', type=float, default=BATCH_RATE, help='每秒最多幾個 PI 請求 (0 = 不限)')
+    parser.add_argument('--deadline', type=float, default=BATCH_MONTH_DEADLINE, help='每個月最多等幾秒')
+    parser.add_argument('--force', action='store_true', help='已經輸出過的月份也重跑')
+    parser.add_argument('--pi-url', default=PIWEB_API_URL)
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+    months = list(month_range(args.start, args.end or args.start))
+    buildings = list(dict.fromkeys(args.buildings))
+    if args.dry_run:
+        print(json.dumps(plan(months, buildings, args.mode, args.formats, args.out, args.force), ensure_ascii=False,
+                         indent=1))
+        sys.exit(0)
+    report = run_batch(months, buildings, args.mode, args.formats, args.out, args.processes, args.rate,
+                       args.deadline, args.force, args.pi_url)
+    print(json.dumps(report, ensure_ascii=False, indent=1))
+    partial = any(r['missing'] for r in report['done'])
+    sys.exit(1 if report['failed'] or partial else 0)
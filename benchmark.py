@@ -0,0 +1,231 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+import datascratch
+from datascratch import decode_streamsets, data_export, data_export_at_times, PISessionPool, PILogin
+from export_engine import export_buildings_month
+from fetch_engine import FETCH_ENGINE
+from mock_piwebapi import MockPIWebAPI
+from pi_cache import PIValueCache, WebIdIndex
+from tag_registry import load_registry
+
+PI_SOURCE = 'pi:\\10.114.134.1\\'
+BASELINE_PATH = './benchmark_baseline.json'
+REGRESSION_TOLERANCE = 0.2      # 比基準慢超過 20% 視為退步
+REGRESSION_FLOOR = 0.05         # 差距小於這麼多秒視為量測誤差, 不算退步
+MOCK_LATENCY = 0.02             # 假 PI server 每個請求的延遲 (秒), 接近廠內網路
+
+
+# 產生與 PI Web API streamsets/interpolated 相同格式的假資料, bad_ratio 比例的點是壞值 dict
+def synthetic_streamset(n_tags, n_points, bad_ratio=0.01, start=datetime(2023, 11, 1), step=timedelta(minutes=1),
+                        seed=0):
+    rng = np.random.default_rng(seed)
+    stamps = [(start + step * k).strftime('%Y-%m-%dT%H:%M:%SZ') for k in range(n_points)]
+    items = []
+    for j in range(n_tags):
+        values = rng.normal(180, 5, n_points).round(2)
+        bad = rng.random(n_points) < bad_ratio
+        items.append({'WebId': f'W{j:04d}', 'Name': f'TAG{j:04d}', 'Items': [
+            {'Timestamp': t, 'Value': {'Name': 'No Data', 'Value': 248, 'IsSystem': True} if b else float(v),
+             'UnitsAbbreviation': '', 'Good': not b, 'Questionable': False, 'Substituted': False}
+            for t, v, b in zip(stamps, values, bad)]})
+    return {'Items': items}
+
+
+# 舊流程: 套件 DataApi.convert_multiple_streams_to_df 逐 stream 建 DataFrame + concat,
+# 再由 PICatchParametersData 篩 Value 欄、逐列轉時區、改兩次欄名, 最後 applymap 把 dict 換成 0
+def legacy_decode(content, point_list):
+    main_df = pd.DataFrame()
+    for i, stream in enumerate(content['Items']):
+        items = stream['Items']
+        df = pd.DataFrame({'Value': [item['Value'] for item in items],
+                           'Timestamp': [item['Timestamp'] for item in items],
+                           'UnitsAbbreviation': [item['UnitsAbbreviation'] for item in items],
+                           'Good': [item['Good'] for item in items],
+                           'Questionable': [item['Questionable'] for item in items],
+                           'Substituted': [item['Substituted'] for item in items]})
+        df.columns = [c + str(i + 1) for c in df.columns]
+        main_df = pd.concat([main_df, df], axis=1)
+    data = main_df
+    index = data.Timestamp1
+    data = data[['Value' + str(i + 1) for i in range(len(point_list))]]
+    data.columns = [i.split('\\')[-1] for i in point_list]
+    data['Timestamp'] = index
+    data['Timestamp'] = pd.to_datetime(data['Timestamp'])
+    data['Timestamp'] = (data['Timestamp'] + pd.Timedelta(8, unit='h')).apply(lambda x: x.tz_localize(tz=None))
+    data.index = data['Timestamp']
+    data = data.drop(columns=['Timestamp'])
+    data.columns = [x[17:] for x in point_list]
+    map_cells = data.map if hasattr(data, 'map') else data.applymap
+    return map_cells(lambda v: 0 if isinstance(v, dict) else v)
+
+
+def fast_decode(content, point_list):
+    web_ids = [stream['WebId'] for stream in content['Items']]
+    index, values, good = decode_streamsets([content], web_ids)
+    return pd.DataFrame(np.where(good, values, 0), index=index, columns=[x[17:] for x in point_list])
+
+
+def _best_of(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+# PI 回應解析的單次成本 (不含網路), 舊流程 vs 向量化解碼
+def bench_decode(n_tags=25, n_points=1440, repeat=5):
+    content = json.loads(json.dumps(synthetic_streamset(n_tags, n_points)))
+    point_list = [PI_SOURCE + f'TAG{j:04d}' for j in range(n_tags)]
+    legacy = legacy_decode(content, point_list)
+    fast = fast_decode(content, point_list)
+    assert np.allclose(legacy.values.astype(float), fast.values) and legacy.index.equals(fast.index)
+    before = _best_of(lambda: legacy_decode(content, point_list), repeat)
+    after = _best_of(lambda: fast_decode(content, point_list), repeat)
+    return {'name': 'decode', 'tags': n_tags, 'points': n_points,
+            'before_ms': round(before * 1000, 2), 'after_ms': round(after * 1000, 2),
+            'speedup': round(before / after, 1)}
+
+
+# datascratch 改接本機假 PI server, 快取用暫存檔 (每個量測都是冷快取), 結束後還原
+# WebID 索引也用暫存檔, 只有第一個量測會查 WebID, 之後跟正式環境一樣直接用索引
+# 量測期間關掉對沖: 對沖送出的重複請求 (輸的那份還會在背景跑完) 會讓請求數與位元組數每次不同
+@contextmanager
+def mock_backend(mock):
+    saved = datascratch.SESSION_POOL, datascratch.VALUE_CACHE, datascratch.WEB_ID_INDEX
+    hedge_percentile = FETCH_ENGINE.hedge_percentile
+    folder = tempfile.mkdtemp(prefix='bench_')
+    datascratch.SESSION_POOL = PISessionPool(login=lambda: PILogin(piweb_api_url=mock.url, keep_alive=True))
+    datascratch.WEB_ID_INDEX = WebIdIndex(os.path.join(folder, 'webids.json'))
+    FETCH_ENGINE.hedge_percentile = 0
+    try:
+        yield folder
+    finally:
+        FETCH_ENGINE.hedge_percentile = hedge_percentile
+        datascratch.SESSION_POOL.clear()
+        datascratch.VALUE_CACHE.close()
+        datascratch.SESSION_POOL, datascratch.VALUE_CACHE, datascratch.WEB_ID_INDEX = saved
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def _fresh_cache(folder):
+    datascratch.VALUE_CACHE.close()
+    datascratch.VALUE_CACHE = PIValueCache(os.path.join(folder, f'cache_{time.perf_counter_ns()}.sqlite'))
+
+
+# 跑一次量牆鐘時間與請求數, 再開 tracemalloc 跑一次量峰值記憶體 (tracemalloc 本身會拖慢, 不混在一起量)
+def _measure(name, fn, mock, folder, cells, warm=False):
+    _fresh_cache(folder)
+    if warm:
+        fn()
+    mock.reset_counters()
+    t0 = time.perf_counter()
+    fn()
+    wall = time.perf_counter() - t0
+    served = mock.stats()
+    _fresh_cache(folder)
+    if warm:
+        fn()
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'name': name, 'wall_s': round(wall, 3), 'requests': served['requests'],
+            'sub_requests': served['sub_requests'], 'bytes': served['bytes_sent'], 'bytes_raw': served['bytes_raw'],
+            'peak_mb': round(peak / 2 ** 20, 2), 'cells': cells, 'cells_per_s': round(cells / wall, 1)}
+
+
+# 月報 (各棟 / 全廠 / 全廠暖快取)、連續多個月、data_export 一天區間、Online.py 一輪監控
+def bench_suite(month='2024-01', months=3, latency=MOCK_LATENCY, kq_machines=8):
+    registry = load_registry()
+    with MockPIWebAPI(latency=latency) as mock, mock_backend(mock) as folder:
+        results = []
+        year, first = (int(v) for v in month.split('-'))
+        for code in registry.building_codes():
+            n = len(registry.tags([code]))
+            results.append(_measure(f'month_{code}', lambda: export_buildings_month(month, [code]), mock, folder,
+                                    n * 31))
+        n = len(registry.tags())
+        results.append(_measure('month_all', lambda: export_buildings_month(month), mock, folder, n * 31))
+        results.append(_measure('month_all_warm', lambda: export_buildings_month(month), mock, folder, n * 31,
+                                warm=True))
+        span = [f'{year + (first - 1 + k) // 12}-{(first - 1 + k) % 12 + 1:02d}' for k in range(months)]
+        results.append(_measure(f'multi_month_{months}', lambda: [export_buildings_month(x) for x in span],
+                                mock, folder, n * 31 * months))
+        paths = registry.paths(['A'])
+        start = datetime(year, first, 1)
+        results.append(_measure('data_export_1d_10m', lambda: data_export(
+            start.strftime('%Y-%m-%d %H:%M:%S'), (start + timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S'),
+            paths, '10m', use_cache=False), mock, folder, len(paths) * 145))
+        kq_tags = [PI_SOURCE + f'KQ{m:02d}_{ch}' for m in range(1, kq_machines + 1) for ch in 'XYCT']
+        results.append(_measure('monitor_cycle', lambda: data_export_at_times(
+            kq_tags, [start + timedelta(hours=11)], use_cache=False), mock, folder, len(kq_tags)))
+    return results
+
+
+# 與基準比較, 回傳退步的項目 (牆鐘時間或請求數超過容許範圍)
+def compare(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    old = {r['name']: r for r in baseline}
+    regressions = []
+    for r in results:
+        b = old.get(r['name'])
+        if b is None:
+            continue
+        ratio = r['wall_s'] / b['wall_s'] if b['wall_s'] else 1.0
+        print(f"{r['name']:<22} {b['wall_s']:>8.3f}s -> {r['wall_s']:>8.3f}s ({ratio:5.2f}x)  "
+              f"requests {b['requests']} -> {r['requests']}")
+        slower = ratio > 1 + tolerance and r['wall_s'] - b['wall_s'] > REGRESSION_FLOOR
+        if slower or r['requests'] > b['requests']:
+            regressions.append(r['name'])
+    return regressions
+
+
+# python benchmark.py                      解碼微基準
+# python benchmark.py --suite --save        跑完整套件並存成基準
+# python benchmark.py --suite --compare     跑完整套件並與基準比較, 有退步時 exit code = 1
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tags', type=int, default=25)
+    parser.add_argument('--points', type=int, default=1440)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--suite', action='store_true')
+    parser.add_argument('--month', default='2024-01')
+    parser.add_argument('--months', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=MOCK_LATENCY)
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save', action='store_true')
+    parser.add_argument('--compare', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE)
+    args = parser.parse_args()
+    if not args.suite:
+        print(json.dumps(bench_decode(args.tags, args.points, args.repeat), ensure_ascii=False))
+        sys.exit(0)
+    results = [bench_decode(args.tags, args.points, args.repeat)]
+    results[0]['wall_s'], results[0]['requests'] = round(results[0]['after_ms'] / 1000, 5), 0
+    results += bench_suite(args.month, args.months, args.latency)
+    for r in results:
+        print(json.dumps(r, ensure_ascii=False))
+    if args.compare:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f)['results'], args.tolerance)
+        if regressions:
+            print('退步: ' + ', '.join(regressions))
+            sys.exit(1)
+    if args.save:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({'created': datetime.now().isoformat(timespec='seconds'), 'latency': args.latency,
+                       'results': results}, f, ensure_ascii=False, indent=1)
@@ -0,0 +1,63 @@
+import argparse
+import json
+import sys
+from datetime import timedelta
+
+import pandas as pd
+
+from benchmark import mock_backend, _fresh_cache
+from datascratch import data_export, data_export_at_times
+from export_engine import export_buildings_month, get_month_snapshot_times
+from mock_piwebapi import MockPIWebAPI
+from tag_registry import load_registry
+
+############################ Parameters
+CHECK_MONTH = '2024-01'
+CHECK_SUSPECT_RATIO = 0.05      # 假 PI server 回傳數值但 Good = false 的格子比例
+############################
+
+
+def _same(a, b):
+    if isinstance(a, tuple):
+        return all(_same(x, y) for x, y in zip(a, b))
+    return a.equals(b)
+
+
+# 冷快取 vs 熱快取: 同一個已結束的月份連抓兩次, 第二次全部來自本機快取, 結果要完全一樣且不再向 PI 要資料
+# 假 PI server 會送出 Good = false 的數值, 冷快取判成壞值的格子, 熱快取也必須判成壞值
+def check(month=CHECK_MONTH, suspect_ratio=CHECK_SUSPECT_RATIO):
+    registry = load_registry()
+    paths = registry.paths()
+    times = get_month_snapshot_times(month, registry)
+    start = times[0].replace(hour=0)
+    end = times[-1].replace(hour=0) + timedelta(days=1) - timedelta(minutes=10)
+    cases = {
+        'month_export': lambda: pd.concat(list(export_buildings_month(month).values())),
+        'at_times': lambda: data_export_at_times(paths, times, return_quality=True),
+        'data_export': lambda: data_export(start.strftime('%Y-%m-%d %H:%M:%S'), end.strftime('%Y-%m-%d %H:%M:%S'),
+                                           paths, '10m'),
+    }
+    failures = []
+    with MockPIWebAPI(suspect_ratio=suspect_ratio) as mock, mock_backend(mock) as folder:
+        for name, fn in cases.items():
+            _fresh_cache(folder)
+            cold = fn()
+            before = mock.stats()['requests']
+            warm = fn()
+            served = mock.stats()['requests'] - before
+            if served:
+                failures.append(f'{name}: 熱快取仍送出 {served} 個請求')
+            if not _same(cold, warm):
+                failures.append(f'{name}: 冷快取與熱快取的結果不同')
+    return {'month': month, 'suspect_ratio': suspect_ratio, 'cases': list(cases), 'failures': failures}
+
+
+# python check_cache.py                    冷熱快取結果不一致時 exit code = 1
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--month', default=CHECK_MONTH)
+    parser.add_argument('--suspect-ratio', type=float, default=CHECK_SUSPECT_RATIO)
+    args = parser.parse_args()
+    report = check(args.month, args.suspect_ratio)
+    print(json.dumps(report, ensure_ascii=False, indent=1))
+    sys.exit(1 if report['failures'] else 0)
@@ -1,10 +1,19 @@
 import warnings
 warnings.filterwarnings("ignore")
+import threading
+import time
+from contextlib import contextmanager
+import requests
 import pandas as pd
 import numpy as np
 from datetime import datetime
 from datetime import timedelta
-from osisoft.pidevclub.piwebapi.pi_web_api_client import PIWebApiClient
+from six.moves.urllib.parse import urlencode
+from osisoft.pidevclub.piwebapi.rest import RESTClientObject, ApiException
+from pi_cache import PIValueCache, WebIdIndex
+from fetch_engine import FETCH_ENGINE, REQUEST_SLOTS, DeadlineExceeded, check_deadline, is_incomplete, is_transient, \
+    throttle
+from metrics import METRICS
 
 ############################ Parameters
 USERNAME = 'N000184123'
@@ -12,6 +21,19 @@ PASSWORD = '84123'
 PIWEB_API_URL = "https://10.114.134.43:20000/piwebapi"
 PI_SERVER_URL = 'pi:\\10.114.134.1\\'
 PARAMETERS_PATH = './HY07_OP.xlsx'
+POOL_MAX_SIZE = 8           # 同時最多幾個已登入的 client
+SESSION_MAX_AGE = 1800      # client 登入超過幾秒就重新登入
+SESSION_CHECK_IDLE = 60     # client 閒置超過幾秒, 重用前先打一次 home 確認還活著
+MAX_URL_LENGTH = 2000       # 單一 GET 的 URL 長度上限, 超過就拆成多個子請求
+BATCH_MAX_REQUESTS = 50     # 一次 /batch 最多包幾個子請求
+REQUEST_TIMEOUT = (10, 60)  # 單一請求的 (連線, 讀取) 逾時秒數; 呼叫端有設期限 (fetch_engine.deadline) 時取比較短的
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+UTC_OFFSET_HOURS = 8        # PI 回傳 UTC 時間, 轉成台灣時間
+SUMMARY_STATS = ('min', 'max', 'mean', 'twa')   # 每日統計: 最小 / 最大 / 平均 / 時間加權平均
+RAW_SUMMARY_INTERVAL = '1m'                      # PI 不支援 summary 時, 自己抓原始資料的取樣間隔
+ACCEPT_ENCODING = 'gzip, deflate'                # 回應壓縮, 廠內 WAN 頻寬有限; JSON 通常可壓到 1/10 以下
+HEDGED_RESOURCES = ('/streamsets/interpolatedattimes', '/points')   # 只對沖小而大小固定的讀取; 區間/統計的大回應不對沖
+STALE_WEB_ID_STATUS = (400, 404)                 # 用 WebID 抓資料回這些狀態碼, 可能是索引裡的 WebID 失效 (tag 重建、搬移)
 ############################
 
 # def readData(path):
@@ -37,8 +59,61 @@ def getPIParameters(pi_server_url = PI_SERVER_URL):
         parse_parameters.append(new_para)
     
     return parse_parameters, name_list
+
+# 原套件的 RESTClientObject 每次都呼叫 requests.get, 連線不共用, 每個 request 都要重新 TLS + NTLM 握手
+# 這裡改用同一個 requests.Session, 連線 keep-alive, NTLM 只在建立連線時握手一次
+class KeepAliveRESTClient(RESTClientObject):
+    def __init__(self, verifySsl, timeout=REQUEST_TIMEOUT):
+        super().__init__(verifySsl)
+        self.session = requests.Session()
+        self.session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+        self.timeout = timeout
+
+    def send_request(self, url, method, body, headers=None, query_params=None):
+        if query_params:
+            url += '?' + urlencode(query_params)
+
+        if method not in ("GET", "HEAD", "OPTIONS", "POST", "PUT", "PATCH", "DELETE"):
+            raise ValueError(
+                "http method must be `GET`, `HEAD`, `OPTIONS`,"
+                " `POST`, `PATCH`, `PUT` or `DELETE`."
+            )
+        json_body = body if method in ("POST", "PUT", "PATCH") else None
+        throttle()
+        left = check_deadline()
+        connect_timeout, read_timeout = self.timeout
+        if left is not None:
+            connect_timeout, read_timeout = min(connect_timeout, left), min(read_timeout, left)
+        if not REQUEST_SLOTS.acquire(timeout=left):
+            raise DeadlineExceeded('等待 PI 請求名額超過期限')
+        try:
+            with METRICS.timed('http'):
+                response = self.session.request(method, url, json=json_body, auth=self.auth, headers=headers,
+                                                verify=self.verifySsl, timeout=(connect_timeout, read_timeout))
+        finally:
+            REQUEST_SLOTS.release()
+        # 實際傳輸 (壓縮後) 與解壓後的位元組數, 兩者相比就是壓縮省下的流量
+        METRICS.count('http_bytes', response.raw.tell() or len(response.content))
+        METRICS.count('http_bytes_decoded', len(response.content))
+
+        if not 200 <= response.status_code <= 299:
+            # 401 之類的錯誤頁不一定是 JSON, ApiException 會解析失敗
+            try:
+                error = ApiException(http_resp=response)
+            except ValueError:
+                error = ApiException(status=response.status_code, reason=response.reason)
+            raise error
+        return response
+
+    def close(self):
+        self.session.close()
+
+
 # 回傳 已登入client的資訊
-def PILogin(username = USERNAME, password = PASSWORD, piweb_api_url = PIWEB_API_URL):
+@METRICS.wrap('login')
+def PILogin(username = USERNAME, password = PASSWORD, piweb_api_url = PIWEB_API_URL, keep_alive = False):
+    # 套件的 client 會載入全部 API 類別 (約 0.5 秒), 第一次登入才 import, 不拖慢程式啟動
+    from osisoft.pidevclub.piwebapi.pi_web_api_client import PIWebApiClient
     username = username
     password = password
     client = PIWebApiClient(baseUrl=piweb_api_url,
@@ -47,43 +122,717 @@ def PILogin(username = USERNAME, password = PASSWORD, piweb_api_url = PIWEB_API_
                             password="{}".format(password),
                             verifySsl=False,
                             useNtlm=True)  
+    if keep_alive:
+        rest_client = KeepAliveRESTClient(client.verifySsl)
+        rest_client.auth = client.api_client.rest_client.auth
+        client.api_client.rest_client = rest_client
     return client
 
-def PICatchParametersData(start_time, end_time, point_list=None, time_interval='20s'):
-    client = PILogin()
-    
+
+def _is_auth_error(e):
+    return isinstance(e, ApiException) and e.status in (401, 403)
+
+
+# 全程式共用的 client 池, 借出已登入且 keep-alive 的 client, 用完歸還
+# 重用前會檢查是否過期/斷線, 認證失效時自動重新登入
+class PISessionPool:
+    def __init__(self, max_size=POOL_MAX_SIZE, max_age=SESSION_MAX_AGE,
+                 check_idle=SESSION_CHECK_IDLE, login=None):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.check_idle = check_idle
+        self._login = login or (lambda: PILogin(keep_alive=True))
+        self._cond = threading.Condition()
+        self._idle = []         # [(client, 登入時間, 最後使用時間)]
+        self._born = {}         # id(client) -> 登入時間
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.reauths = 0
+
+    def _healthy(self, client, born, last_used, now):
+        if now - born > self.max_age:
+            return False
+        if now - last_used <= self.check_idle:
+            return True
+        try:
+            client.home.get()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, client):
+        rest_client = client.api_client.rest_client
+        if hasattr(rest_client, 'close'):
+            rest_client.close()
+
+    def _checkout(self):
+        while True:
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    self._cond.wait()
+                if not self._idle:
+                    self._size += 1
+                    self.misses += 1
+                    break
+                client, born, last_used = self._idle.pop()
+            # 健康檢查可能要打一次 API, 不要卡住其他執行緒
+            if self._healthy(client, born, last_used, time.monotonic()):
+                with self._cond:
+                    self.hits += 1
+                return client
+            # 過期或斷線: 丟掉, 重新登入補上
+            self._discard(client)
+            with self._cond:
+                self._born.pop(id(client), None)
+                self._size -= 1
+                self.reauths += 1
+                self._cond.notify()
+        try:
+            client = self._login()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._born[id(client)] = time.monotonic()
+        return client
+
+    def _checkin(self, client, broken=False):
+        with self._cond:
+            if broken:
+                self._discard(client)
+                self._born.pop(id(client), None)
+                self._size -= 1
+            else:
+                self._idle.append((client, self._born[id(client)], time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def acquire(self):
+        client = self._checkout()
+        broken = False
+        try:
+            yield client
+        except Exception as e:
+            broken = _is_auth_error(e) or isinstance(e, requests.ConnectionError)
+            raise
+        finally:
+            self._checkin(client, broken)
+
+    # 用池中的 client 執行 fn(client); 認證失效時換一個重新登入的 client 再試一次
+    def call(self, fn):
+        try:
+            with self.acquire() as client:
+                return fn(client)
+        except Exception as e:
+            if not _is_auth_error(e):
+                raise
+            with self._cond:
+                self.reauths += 1
+        with self.acquire() as client:
+            return fn(client)
+
+    def stats(self):
+        with self._cond:
+            return {'size': self._size,
+                    'idle': len(self._idle),
+                    'in_use': self._size - len(self._idle),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'reauths': self.reauths}
+
+    def clear(self):
+        with self._cond:
+            for client, _, _ in self._idle:
+                self._discard(client)
+                self._born.pop(id(client), None)
+            self._size -= len(self._idle)
+            self._idle = []
+
+
+SESSION_POOL = PISessionPool()
+
+
+# PI 回傳的 UTC 時間字串 -> 本地時間 (不帶時區), 整批向量化轉換
+def decode_timestamps(timestamps):
+    index = pd.DatetimeIndex(pd.to_datetime(timestamps, utc=True)).tz_localize(None)
+    return index + pd.Timedelta(UTC_OFFSET_HOURS, unit='h')
+
+
+# 一個 stream 的 Items -> (數值 float64 陣列, 品質遮罩)
+# 壞值 (PI 以 dict 表示的系統狀態, 例如 No Data / Pt Created) 與非數值直接變成 NaN, Good = False
+def decode_stream_values(items):
+    n = len(items)
+    values = np.fromiter((item['Value'] if type(item['Value']) in (float, int) else np.nan for item in items),
+                         dtype=np.float64, count=n)
+    good = np.fromiter((item.get('Good', True) for item in items), dtype=bool, count=n)
+    good &= ~np.isnan(values)
+    return values, good
+
+
+# streamset 回應 (可能分成多段) -> (時間 index, 數值矩陣 [時間 x tag], 品質遮罩)
+# 欄位順序依照 web_ids, 不經過套件的 DataFrame 與逐格轉換
+@METRICS.wrap('decode')
+def decode_streamsets(contents, web_ids):
+    streams = {}
+    for content in contents:
+        for stream in content['Items']:
+            streams[stream['WebId']] = stream['Items']
+    # 時間軸取回應裡最長的那個 stream; 某些 tag 整個沒回來或是空的, 只有那幾欄是 NaN
+    present = [streams[web_id] for web_id in web_ids if web_id in streams]
+    if not present:
+        raise KeyError(f'PI 回應裡沒有任何要求的 stream ({len(web_ids)} 個 WebID)')
+    longest = max(present, key=len)
+    index = decode_timestamps([item['Timestamp'] for item in longest])
+    values = np.full((len(longest), len(web_ids)), np.nan)
+    good = np.zeros((len(longest), len(web_ids)), dtype=bool)
+    for j, web_id in enumerate(web_ids):
+        items = streams.get(web_id)
+        if not items:
+            continue
+        n = min(len(items), len(longest))
+        values[:n, j], good[:n, j] = decode_stream_values(items[:n])
+    return index, values, good
+
+
+# 只要求解析時會用到的欄位 (selectedFields), 單位、Questionable、Substituted 等不傳, 回應約小一半
+_INTERPOLATED_FIELDS = 'Items.WebId;Items.Items.Timestamp;Items.Items.Value;Items.Items.Good'
+_AT_TIMES_FIELDS = 'Items.WebId;Items.Items.Value;Items.Items.Good'
+_SUMMARY_FIELDS = 'Items.WebId;Items.Items.Type;Items.Items.Value.Timestamp;Items.Items.Value.Value;Items.Items.Value.Good'
+
+
+# 直接取 streamset 的 JSON 自己解析, 不用套件的 get_multiple_interpolated_values (逐欄 DataFrame + concat)
+# 回傳 (時間 index, 數值矩陣 [時間 x tag], 品質遮罩)
+def _fetch_interpolated(point_list, start_time, end_time, time_interval, web_ids=None):
+    window = [('startTime', start_time), ('endTime', end_time), ('interval', time_interval),
+              ('selectedFields', _INTERPOLATED_FIELDS)]
+
+    def fetch(web_ids):
+        requested = [[web_ids[j] for j in tag_idx] for tag_idx in _chunk_params('webId', web_ids, MAX_URL_LENGTH // 2)]
+        contents = _get_many([('/streamsets/interpolated', [('webId', w) for w in chunk] + window)
+                              for chunk in requested])
+        return contents, _missing_streams(contents, requested)
+
+    contents, web_ids = _fetch_by_web_ids(point_list, fetch, web_ids)
+    return decode_streamsets(contents, web_ids)
+
+
+def PICatchParametersData(start_time, end_time, point_list=None, time_interval='20s', return_quality=False):
     if(point_list==None):point_list, name_list = getPIParameters()
     
     #start = datetime(2021,10,25,18,0,0) #datetime.now()-timedelta(hours=5)
     #end = datetime(2021,10,25,18,10,0)   #datetime.now() 
-    data = client.data.get_multiple_interpolated_values(point_list,
-                                                        start_time=start_time,
-                                                        end_time=end_time,
-                                                        interval=time_interval)
-    # data = client.data.get_interpolated_values(point_list,
-    #                                             start_time=start_time,
-    #                                             end_time=end_time,
-    #                                             interval=time_interval)
-    index=data.Timestamp1
-    fliter = ['Value'+str(i+1) for i in range(len(point_list))]
-    data=data[fliter]
-    data.columns = [i.split('\\')[-1] for i in point_list]
-    data['Timestamp']=index
-    data['Timestamp'] = pd.to_datetime(data['Timestamp'])
-    data['Timestamp'] = (data['Timestamp']+pd.Timedelta(8, unit='h')).apply(lambda x: x.tz_localize(tz = None))
-    data.index=data['Timestamp']
-    data=data.drop(columns=['Timestamp'])
+    index, values, good = _fetch_interpolated(point_list, start_time, end_time, time_interval)
+    index.name = 'Timestamp'
     # 更動 point_list, 讓 column name 單純秀出 tag name 
     tag_name = [x[17:] for x in point_list]
-    data.columns = tag_name
-    
+    with METRICS.timed('assemble'):
+        data = pd.DataFrame(values, index=index, columns=tag_name, copy=False)
+    if return_quality:
+        return data, pd.DataFrame(good, index=index, columns=tag_name, copy=False)
     return data
 
-def data_export(start_time, end_time,tagpoint_list, time_interval='10m'):
-    data = PICatchParametersData(start_time, end_time,point_list = tagpoint_list,time_interval=time_interval)
+VALUE_CACHE = PIValueCache()
+
+
+# 把 [start, end] 沿著取樣網格切成約一天一段, 網格與直接查詢相同 (start + k * interval)
+# 時間不是 TIME_FORMAT 格式 (例如 '*-1h') 就不走快取, 回傳 None
+def _cache_windows(start_time, end_time, time_interval):
+    try:
+        start = datetime.strptime(str(start_time), TIME_FORMAT)
+        end = datetime.strptime(str(end_time), TIME_FORMAT)
+        step = pd.Timedelta(time_interval).to_pytimedelta()
+    except ValueError:
+        return None
+    if step <= timedelta(0) or end < start:
+        return None
+    span = step * max(1, timedelta(days=1) // step)
+    windows = []
+    while start <= end:
+        window_end = min(start + span - step, end)
+        windows.append((start, window_end))
+        start = start + span
+    return windows
+
+
+def _data_export_cached(windows, tagpoint_list, time_interval):
+    tag_name = [x[17:] for x in tagpoint_list]
+    done = VALUE_CACHE.get_windows(tagpoint_list, [w[0] for w in windows], time_interval)
+    missing = [[tag for tag in tagpoint_list if (tag, start.strftime(TIME_FORMAT)) not in done]
+               for start, end in windows]
+
+    # 缺的 (tag, 區段) 交給 FETCH_ENGINE 平行抓; 快取只存數值, Good = false 的格子先換成 NaN 再存也再回傳,
+    # 冷快取與熱快取拿到的結果才會一樣
+    def fetch(i):
+        start, end = windows[i]
+        fetched, good = PICatchParametersData(start.strftime(TIME_FORMAT), end.strftime(TIME_FORMAT),
+                                              point_list=missing[i], time_interval=time_interval,
+                                              return_quality=True)
+        fetched = fetched.where(good)
+        for tag, column in zip(missing[i], fetched.columns):
+            VALUE_CACHE.put_window(tag, start, end, time_interval, zip(fetched.index, fetched[column].tolist()))
+        return fetched
+
+    todo = [i for i in range(len(windows)) if missing[i]]
+    fetched = dict(zip(todo, FETCH_ENGINE.map(fetch, todo, retry=False)))
+
+    frames = []
+    for i, (start, end) in enumerate(windows):
+        if len(missing[i]) == len(tagpoint_list):
+            frames.append(fetched[i])
+            continue
+        columns = {}
+        for tag, name in zip(tagpoint_list, tag_name):
+            if tag in missing[i]:
+                columns[name] = fetched[i][name]
+            else:
+                series = VALUE_CACHE.get_series(tag, start, end, time_interval)
+                columns[name] = pd.Series([v for _, v in series], index=pd.to_datetime([t for t, _ in series]),
+                                          dtype=np.float64)
+        window_data = pd.DataFrame(columns)[tag_name]
+        window_data.index.name = 'Timestamp'
+        frames.append(window_data)
+    return pd.concat(frames) if len(frames) > 1 else frames[0]
+
+
+def data_export(start_time, end_time,tagpoint_list, time_interval='10m', use_cache=True):
+    windows = _cache_windows(start_time, end_time, time_interval) if use_cache else None
+    # 整段都還沒過安全時間 (例如 Online.py 查現在) 就直接查, 不經過快取
+    if windows and VALUE_CACHE.cacheable(windows[0][1]):
+        data = _data_export_cached(windows, tagpoint_list, time_interval)
+    else:
+        data = PICatchParametersData(start_time, end_time,point_list = tagpoint_list,time_interval=time_interval)
     #data = domain_knowhow_transform(data.reset_index())
     if data is None:
         # print('Calc Falied or I/O Timeout')
         return 
     
-    return data
\ No newline at end of file
+    return data
+
+# 直接用池中 client 的 keep-alive session 打 PI Web API, 回傳 JSON
+def _get_json(client, resource, params=None):
+    url = client.baseUrl.rstrip('/') + resource
+    response = client.api_client.rest_client.send_request(url, "GET", None, query_params=params)
+    with METRICS.timed('parse'):
+        return response.json()
+
+
+# 把多個 GET 包成一個 /batch 請求, 依序回傳每個子請求的 JSON
+def _batch_get(client, resources):
+    if len(resources) == 1:
+        return [_get_json(client, *resources[0])]
+    base = client.baseUrl.rstrip('/')
+    body = {str(i): {"Method": "GET", "Resource": base + resource + '?' + urlencode(params)}
+            for i, (resource, params) in enumerate(resources)}
+    response = client.api_client.rest_client.send_request(base + '/batch', "POST", body)
+    with METRICS.timed('parse'):
+        content = response.json()
+    results = []
+    for i in range(len(resources)):
+        item = content[str(i)]
+        if not 200 <= item['Status'] <= 299:
+            raise ApiException(status=item['Status'], reason=str(item.get('Content')))
+        results.append(item['Content'])
+    return results
+
+
+# 子請求每 BATCH_MAX_REQUESTS 個包成一個 batch, 交給 FETCH_ENGINE 平行送出 (有重試、併發上限與延遲對沖)
+# on_content(子請求序號, JSON) 會在每個 batch 回來時立刻呼叫, 不必等全部完成
+# 有給 on_failed(子請求序號, 錯誤) 時, 超過期限或重試後仍失敗的 batch 不丟例外, 改呼叫 on_failed, 該位置回傳 None
+def _get_many(resources, on_content=None, on_failed=None):
+    chunks = [list(range(i, min(i + BATCH_MAX_REQUESTS, len(resources))))
+              for i in range(0, len(resources), BATCH_MAX_REQUESTS)]
+
+    def request(chunk):
+        return SESSION_POOL.call(lambda client: _batch_get(client, [resources[i] for i in chunk]))
+
+    # 對沖的延遲分布依 (端點, 子請求數) 分開統計; 混了大回應的 batch 直接送, 不對沖
+    def send(chunk):
+        endpoints = {resources[i][0] for i in chunk}
+        if len(endpoints) == 1 and endpoints <= set(HEDGED_RESOURCES):
+            return FETCH_ENGINE.hedged((endpoints.pop(), len(chunk)), request, chunk)
+        return request(chunk)
+
+    # 只在這一層重試; 呼叫 _get_many 的外層 (FETCH_ENGINE.map(..., retry=False)) 不再重試
+    def fetch(chunk):
+        try:
+            contents = FETCH_ENGINE.call(send, chunk)
+        except Exception as e:
+            if on_failed is None or not is_incomplete(e):
+                raise
+            for i in chunk:
+                on_failed(i, e)
+            return [None] * len(chunk)
+        if on_content is not None:
+            for i, content in zip(chunk, contents):
+                on_content(i, content)
+        return contents
+
+    results = FETCH_ENGINE.map(fetch, chunks, retry=False)
+    return [content for chunk_result in results for content in chunk_result]
+
+
+# 依照 URL 長度把 (key, value) 參數切成多段
+def _chunk_params(key, values, budget):
+    chunks = []
+    current, length = [], 0
+    for i, value in enumerate(values):
+        item_length = len(urlencode([(key, value)])) + 1
+        if current and length + item_length > budget:
+            chunks.append(current)
+            current, length = [], 0
+        current.append(i)
+        length += item_length
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+WEB_ID_INDEX = WebIdIndex()
+
+_PATH_RESOURCES = {'pi:': '/points', 'af:': '/attributes'}
+
+
+# 'pi:\\伺服器\\tag' / 'af:\\...' -> 查詢 WebID 的子請求; 全部包成 /batch 一次送出, 不再一個 tag 一個請求
+def _lookup_web_ids(paths):
+    for path in paths:
+        if path[:3] not in _PATH_RESOURCES:
+            raise ValueError(f'invalid path (needs to start with "pi:" or "af:"): {path}')
+    resources = [(_PATH_RESOURCES[path[:3]], [('path', path[3:]), ('selectedFields', 'WebId')]) for path in paths]
+    with METRICS.timed('resolve'):
+        return [content['WebId'] for content in _get_many(resources)]
+
+
+# tag 路徑 -> WebID, 已查過的直接用本機索引 (WEB_ID_INDEX), 只有新的或過期的 tag 才向 PI 查
+# stale: 索引裡的 WebID 已經不能用的路徑, 先清掉再重查
+def resolve_web_ids(paths, stale=()):
+    if stale:
+        WEB_ID_INDEX.invalidate(list(stale))
+    return WEB_ID_INDEX.resolve(list(paths), _lookup_web_ids)
+
+
+# 有回應但裡面少了的 stream 的 WebID; requested = 每個回應要求的 WebID, 回應是 None (整段沒拿到) 的不算
+def _missing_streams(contents, requested):
+    missing = set()
+    for content, web_ids in zip(contents, requested):
+        if content is not None:
+            missing.update(set(web_ids) - {stream['WebId'] for stream in content['Items']})
+    return missing
+
+
+# 用 WebID 抓資料: fetch(web_ids) 回傳 (結果, 沒回來的 stream 的 WebID 集合), 這裡回傳 (結果, 用的 WebID)
+# PI 回 400/404 (分不出是哪個 tag, 整批路徑都重查) 或有 stream 沒回來時, 清掉那些路徑的索引重查一次 WebID,
+# WebID 有變才用新的重抓一次; 重查失敗或 WebID 沒變 (不是索引的問題) 就照原本的結果 / 錯誤
+def _fetch_by_web_ids(paths, fetch, web_ids=None):
+    paths = list(paths)
+    web_ids = resolve_web_ids(paths) if web_ids is None else list(web_ids)
+    try:
+        result, missing = fetch(web_ids)
+    except ApiException as e:
+        if e.status not in STALE_WEB_ID_STATUS:
+            raise
+        error, result, stale = e, None, paths
+    else:
+        if not missing:
+            return result, web_ids
+        error, stale = None, [p for p, w in zip(paths, web_ids) if w in missing]
+    try:
+        fresh = resolve_web_ids(paths, stale)
+    except Exception:
+        fresh = web_ids
+    if fresh == web_ids:
+        if error is not None:
+            raise error
+        return result, web_ids
+    METRICS.count('web_id_refreshes')
+    return fetch(fresh)[0], fresh
+
+
+def _fetch_at_times(tagpoint_list, times, on_values, on_missing=None):
+    try:
+        web_ids = resolve_web_ids(tagpoint_list)
+    except Exception as e:
+        if on_missing is None or not is_incomplete(e):
+            raise
+        on_missing(list(range(len(times))), list(range(len(tagpoint_list))))
+        return
+    time_chunks = _chunk_params('time', times, MAX_URL_LENGTH // 2)
+
+    def fetch(web_ids):
+        jobs, resources = [], []
+        for tag_idx in _chunk_params('webId', web_ids, MAX_URL_LENGTH // 2):
+            for time_idx in time_chunks:
+                params = [('webId', web_ids[j]) for j in tag_idx] + [('time', times[k]) for k in time_idx] + \
+                         [('selectedFields', _AT_TIMES_FIELDS)]
+                jobs.append((tag_idx, time_idx))
+                resources.append(('/streamsets/interpolatedattimes', params))
+
+        def on_content(i, content):
+            tag_idx, time_idx = jobs[i]
+            column_of = {web_ids[j]: j for j in tag_idx}
+            for stream in content['Items']:
+                with METRICS.timed('decode'):
+                    values, good = decode_stream_values(stream['Items'])
+                on_values(time_idx[:len(values)], [column_of[stream['WebId']]], values[:, None], good[:, None])
+
+        def on_failed(i, error):
+            tag_idx, time_idx = jobs[i]
+            on_missing(time_idx, tag_idx)
+
+        contents = _get_many(resources, on_content, on_failed if on_missing is not None else None)
+        return None, _missing_streams(contents, [[web_ids[j] for j in tag_idx] for tag_idx, _ in jobs])
+
+    _fetch_by_web_ids(tagpoint_list, fetch, web_ids)
+
+
+# 快取裡已有的值 [時間 x tag], 以及缺值的 tag 位置與時間位置 (排序後)
+def _cached_block(tagpoint_list, times):
+    cached = VALUE_CACHE.get_points(tagpoint_list, times)
+    block = np.full((len(times), len(tagpoint_list)), np.nan)
+    missing_tags, missing_times = set(), set()
+    for j, tag in enumerate(tagpoint_list):
+        for k, t in enumerate(times):
+            if (tag, t) in cached:
+                block[k, j] = cached[(tag, t)]
+            else:
+                missing_tags.add(j)
+                missing_times.add(k)
+    return block, sorted(missing_tags), sorted(missing_times)
+
+
+# 一次取得多個 tag 在多個時間點的內插值 (streamset interpolatedattimes), 結果邊抓邊交給 on_values
+# on_values(時間位置 list, tag 位置 list, 數值 [時間 x tag], 品質遮罩) 可能在多個執行緒被呼叫, 每次寫的格子不重疊
+# 已過安全時間的 (tag, 時間點) 會存進本機快取, 下次只補抓快取沒有的格子
+# 有給 on_missing(時間位置 list, tag 位置 list) 時, 超過期限 (fetch_engine.deadline) 或一直失敗的格子改交給 on_missing,
+# 其餘照常回傳 (部分結果); 沒給就直接丟例外
+def fetch_at_times(tagpoint_list, timestamps, on_values, use_cache=True, on_missing=None):
+    times = [t.strftime(TIME_FORMAT) if isinstance(t, datetime) else str(t) for t in timestamps]
+    if not use_cache:
+        _fetch_at_times(tagpoint_list, times, on_values, on_missing)
+        return
+
+    block, missing_tags, missing_times = _cached_block(tagpoint_list, times)
+    # 缺的格子取最小外框一次抓回來, 外框以外的格子直接用快取 (每個格子只交給 on_values 一次)
+    all_tags = list(range(len(tagpoint_list)))
+    cached_times = [k for k in range(len(times)) if k not in missing_times]
+    cached_tags = [j for j in all_tags if j not in missing_tags]
+    if cached_times:
+        sub = block[cached_times]
+        on_values(cached_times, all_tags, sub, ~np.isnan(sub))
+    if missing_times and cached_tags:
+        sub = block[np.ix_(missing_times, cached_tags)]
+        on_values(missing_times, cached_tags, sub, ~np.isnan(sub))
+    if not missing_tags:
+        return
+
+    # Good = false 的格子以 NaN 交出並存進快取, 快取命中時 (~isnan) 才會同樣判成壞值, 冷熱快取結果一致
+    def on_fetched(rows, cols, values, good):
+        rows = [missing_times[r] for r in rows]
+        cols = [missing_tags[c] for c in cols]
+        values = np.where(good, values, np.nan)
+        on_values(rows, cols, values, good)
+        VALUE_CACHE.put_points((tagpoint_list[j], datetime.strptime(times[k], TIME_FORMAT), values[a, b])
+                               for b, j in enumerate(cols)
+                               for a, k in enumerate(rows)
+                               if _is_time_format(times[k]))
+
+    def on_lost(rows, cols):
+        on_missing([missing_times[r] for r in rows], [missing_tags[c] for c in cols])
+
+    _fetch_at_times([tagpoint_list[j] for j in missing_tags], [times[k] for k in missing_times], on_fetched,
+                    on_lost if on_missing is not None else None)
+
+
+# 回傳 index = timestamps, columns = tag name 的對齊表格
+def data_export_at_times(tagpoint_list, timestamps, use_cache=True, return_quality=False):
+    values = np.full((len(timestamps), len(tagpoint_list)), np.nan)
+    good = np.zeros((len(timestamps), len(tagpoint_list)), dtype=bool)
+
+    def on_values(rows, cols, block, block_good):
+        values[np.ix_(rows, cols)] = block
+        good[np.ix_(rows, cols)] = block_good
+
+    fetch_at_times(tagpoint_list, timestamps, on_values, use_cache)
+
+    tag_name = [x[17:] for x in tagpoint_list]
+    with METRICS.timed('assemble'):
+        index = pd.to_datetime([t.strftime(TIME_FORMAT) if isinstance(t, datetime) else str(t) for t in timestamps])
+        index.name = 'Timestamp'
+        data = pd.DataFrame(values, index=index, columns=tag_name, copy=False)
+    if return_quality:
+        return data, pd.DataFrame(good, index=index, columns=tag_name, copy=False)
+    return data
+
+
+def _is_time_format(t):
+    try:
+        datetime.strptime(t, TIME_FORMAT)
+        return True
+    except ValueError:
+        return False
+
+
+# summaryType (計算基準) -> 統計名稱; mean 用事件加權, 其餘用時間加權
+_SUMMARY_TYPES = {('Minimum', 'TimeWeighted'): 'min', ('Maximum', 'TimeWeighted'): 'max',
+                  ('Average', 'EventWeighted'): 'mean', ('Average', 'TimeWeighted'): 'twa'}
+
+
+# 由 PI 的 streamsets/summary 直接在 server 端算每日統計, 一個 tag 一天只回傳幾個數字
+def _daily_summary_pi(tagpoint_list, start, days, on_missing=None):
+    window = [('startTime', start.strftime(TIME_FORMAT)),
+              ('endTime', (start + timedelta(days=days)).strftime(TIME_FORMAT)), ('summaryDuration', '1d'),
+              ('selectedFields', _SUMMARY_FIELDS)]
+
+    def fetch(web_ids):
+        resources, bases, chunks = [], [], []
+        for tag_idx in _chunk_params('webId', web_ids, MAX_URL_LENGTH // 2):
+            for basis in ('TimeWeighted', 'EventWeighted'):
+                types = [t for t, b in _SUMMARY_TYPES if b == basis]
+                resources.append(('/streamsets/summary', [('webId', web_ids[j]) for j in tag_idx] + window +
+                                  [('summaryType', t) for t in types] + [('calculationBasis', basis)]))
+                bases.append(basis)
+                chunks.append(tag_idx)
+
+        def on_failed(i, error):
+            on_missing(list(range(days)), chunks[i])
+
+        contents = _get_many(resources, on_failed=on_failed if on_missing is not None else None)
+        return (bases, contents), _missing_streams(contents, [[web_ids[j] for j in tag_idx] for tag_idx in chunks])
+
+    (bases, contents), web_ids = _fetch_by_web_ids(tagpoint_list, fetch)
+    column_of = {web_id: j for j, web_id in enumerate(web_ids)}
+    values = {stat: np.full((days, len(web_ids)), np.nan) for stat in SUMMARY_STATS}
+    with METRICS.timed('decode'):
+        cells, stamps = [], []
+        for basis, content in zip(bases, contents):
+            if content is None:
+                continue
+            for stream in content['Items']:
+                j = column_of[stream['WebId']]
+                for item in stream['Items']:
+                    stat = _SUMMARY_TYPES.get((item['Type'], basis))
+                    value = item['Value']
+                    if stat is not None and type(value['Value']) in (float, int) and value.get('Good', True):
+                        cells.append((stat, j, value['Value']))
+                        stamps.append(value['Timestamp'])
+        if cells:
+            # 每段統計的 Timestamp 是該段起點, 換成本地時間後就是第幾天
+            day_of = (decode_timestamps(stamps).normalize() - pd.Timestamp(start)).days
+            for (stat, j, value), day in zip(cells, day_of):
+                if 0 <= day < days:
+                    values[stat][day, j] = value
+    return values
+
+
+# 一天一段抓原始取樣值, 抓回來立刻算完統計就丟掉, 整個月的原始資料不會同時留在記憶體
+# 取樣點等間隔, 時間加權平均 = 相鄰兩個好值的梯形面積平均
+def _reduce_day(values, good):
+    values = np.where(good, values, np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return {'min': np.nanmin(values, axis=0), 'max': np.nanmax(values, axis=0),
+                'mean': np.nanmean(values, axis=0),
+                'twa': np.nanmean((values[1:] + values[:-1]) / 2, axis=0)}
+
+
+def _daily_summary_raw(tagpoint_list, start, days, progress=None, on_missing=None):
+    web_ids = resolve_web_ids(tagpoint_list)
+    done = [0]
+    lock = threading.Lock()
+
+    def fetch(day):
+        begin = start + timedelta(days=day)
+        # 區間兩端都會取樣, 結束在隔天 00:00 前一個取樣點, 不把隔天的第一筆算進這一天
+        end = begin + timedelta(days=1) - pd.Timedelta(RAW_SUMMARY_INTERVAL)
+        try:
+            _, values, good = _fetch_interpolated(tagpoint_list, begin.strftime(TIME_FORMAT),
+                                                  end.strftime(TIME_FORMAT), RAW_SUMMARY_INTERVAL, web_ids)
+        except Exception as e:
+            if on_missing is None or not is_incomplete(e):
+                raise
+            on_missing([day], list(range(len(tagpoint_list))))
+            values, good = np.full((1, len(tagpoint_list)), np.nan), np.zeros((1, len(tagpoint_list)), dtype=bool)
+        reduced = _reduce_day(values, good)
+        if progress is not None:
+            with lock:
+                done[0] += 1
+                progress(done[0], days)
+        return reduced
+
+    # _fetch_interpolated 底下的 _get_many 已經會重試, 這層不再重試
+    reduced = FETCH_ENGINE.map(fetch, range(days), retry=False)
+    return {stat: np.array([day[stat] for day in reduced]).reshape(days, len(tagpoint_list)) for stat in SUMMARY_STATS}
+
+
+# 從 start (日期 00:00) 起 days 天, 每個 tag 每天的統計值 {統計名稱: 陣列 [日 x tag]}, 沒有好值的格子是 NaN
+# source = 'pi' 只用 PI summary, 'raw' 只用原始資料自己算, 'auto' 先試 summary, PI 不支援 (非暫時性錯誤) 才改抓原始資料
+# on_missing(日位置 list, tag 位置 list): 超過期限或一直失敗而沒拿到的格子, 有給就回傳部分結果而不丟例外
+def fetch_daily_summary(tagpoint_list, start, days, source='auto', progress=None, on_missing=None):
+    start = datetime.combine(start, datetime.min.time()) if not isinstance(start, datetime) else start
+    try:
+        if source != 'raw':
+            try:
+                values = _daily_summary_pi(tagpoint_list, start, days, on_missing)
+            except ApiException as e:
+                if source == 'pi' or is_transient(e):
+                    raise
+            else:
+                if progress is not None:
+                    progress(days, days)
+                return values
+        return _daily_summary_raw(tagpoint_list, start, days, progress, on_missing)
+    except Exception as e:
+        if on_missing is None or not is_incomplete(e):
+            raise
+        on_missing(list(range(days)), list(range(len(tagpoint_list))))
+        return {stat: np.full((days, len(tagpoint_list)), np.nan) for stat in SUMMARY_STATS}
+
+
+# 以下估算各種抓法會送出多少請求, 只看本機快取與 WebID 索引, 不向 PI 發任何請求 (批次匯出的 --dry-run 用)
+WEB_ID_LENGTH_ESTIMATE = 60     # 還沒查過 WebID 的 tag, 以這個長度估算 URL 要切幾段
+
+
+def _planned_web_ids(tagpoint_list):
+    known = WEB_ID_INDEX.known(tagpoint_list)
+    return [known.get(p, 'X' * WEB_ID_LENGTH_ESTIMATE) for p in tagpoint_list], len(set(tagpoint_list) - set(known))
+
+
+# sub_requests 個子請求經 _get_many 包成 batch 後的 HTTP 請求數
+def _http_requests(sub_requests):
+    return -(-sub_requests // BATCH_MAX_REQUESTS)
+
+
+def _plan(sub_requests, http_requests, unresolved, **extra):
+    resolve = _http_requests(unresolved)
+    return dict(extra, sub_requests=sub_requests + unresolved, http_requests=http_requests + resolve,
+                resolve_tags=unresolved)
+
+
+# fetch_at_times 會送出的請求數; 快取裡已有的格子不算
+def plan_at_times(tagpoint_list, timestamps, use_cache=True):
+    times = [t.strftime(TIME_FORMAT) if isinstance(t, datetime) else str(t) for t in timestamps]
+    if use_cache:
+        _, missing_tags, missing_times = _cached_block(tagpoint_list, times)
+    else:
+        missing_tags, missing_times = list(range(len(tagpoint_list))), list(range(len(times)))
+    if not missing_tags or not missing_times:
+        return _plan(0, 0, 0, cells=len(tagpoint_list) * len(times), fetch_cells=0)
+    web_ids, unresolved = _planned_web_ids([tagpoint_list[j] for j in missing_tags])
+    sub_requests = len(_chunk_params('webId', web_ids, MAX_URL_LENGTH // 2)) * \
+        len(_chunk_params('time', [times[k] for k in missing_times], MAX_URL_LENGTH // 2))
+    return _plan(sub_requests, _http_requests(sub_requests), unresolved, cells=len(tagpoint_list) * len(times),
+                 fetch_cells=len(missing_tags) * len(missing_times))
+
+
+# fetch_daily_summary 會送出的請求數; 'auto' 以 PI summary 估算 (不支援時實際會改抓原始資料, 請求數較多)
+def plan_daily_summary(tagpoint_list, days, source='auto'):
+    if not days:
+        return _plan(0, 0, 0, cells=0, fetch_cells=0)
+    web_ids, unresolved = _planned_web_ids(tagpoint_list)
+    tag_chunks = len(_chunk_params('webId', web_ids, MAX_URL_LENGTH // 2))
+    cells = len(tagpoint_list) * days * len(SUMMARY_STATS)
+    if source == 'raw':
+        return _plan(days * tag_chunks, days * _http_requests(tag_chunks), unresolved, cells=cells, fetch_cells=cells)
+    return _plan(2 * tag_chunks, _http_requests(2 * tag_chunks), unresolved, cells=cells, fetch_cells=cells)
@@ -1,17 +1,29 @@
 from __future__ import annotations
 from typing import Iterable
+import argparse
+import os
+import subprocess
+import sys
 import gradio as gr
 from gradio.themes.base import Base
 from gradio.themes.utils import colors, fonts, sizes
 import datetime
-import calendar
-import pandas as pd
-from datascratch import data_export
-from zipfile import ZipFile
-import os
-
-from theme_dropdown import create_theme_dropdown
-
+import time
+from export_jobs import building_pipe, submit_export, submit_range_export, JOBS, JobCancelled
+from month_matrix import count_missing, MISSING_MARKER
+from exporter import FORMATS
+from prewarm import PREWARM
+from metrics import start_reporting
+from tag_registry import load_registry
+
+from theme_dropdown import create_theme_dropdown, theme_asset_paths
+
+############################ Parameters
+SERVER_NAME = '10.114.70.170'
+SERVER_PORT = 8787
+APP_WORKERS = int(os.environ.get('PI_APP_WORKERS', 1))   # worker 程序數, 第 i 個開在 SERVER_PORT + i
+QUEUE_CONCURRENCY = 16      # 每個 worker 同時處理幾個 Gradio 事件 (實際匯出另由 export_jobs.JOB_WORKERS 限制)
+############################
 
 class Seafoam(Base):
     def __init__(
@@ -69,294 +81,59 @@ class Seafoam(Base):
         )
 
 
-def get_month_dates(year, month):
-    num_days = calendar.monthrange(year, month)[1]
-    dates = []
-    for day in range(1, num_days + 1):
-        date = datetime.date(year, month, day)
-        dates.append(date)
-    return dates
-
-
-def replace_dict_with_zero(value):
-    if isinstance(value, dict):
-        return 0
-    return value
-
-
-def download_files_A(x):
-    excel_file = pipe_A_data(x)
-    excel_file.to_excel('tmp_excel_file.xlsx')
-    with ZipFile("甲棟壓縮檔.zip", "w") as zipObj:
-        zipObj.write('tmp_excel_file.xlsx', '甲棟.xlsx')
-    os.remove('tmp_excel_file.xlsx')
-    return "甲棟壓縮檔.zip", gr.File(visible=True)
-
-
-def download_files_B(x):
-    excel_file = pipe_B_data(x)
-    excel_file.to_excel('tmp_excel_file.xlsx')
-    with ZipFile("乙棟壓縮檔.zip", "w") as zipObj:
-        zipObj.write('tmp_excel_file.xlsx', '乙棟.xlsx')
-    os.remove('tmp_excel_file.xlsx')
-    return "乙棟壓縮檔.zip", gr.File(visible=True)
-
-
-def download_files_C(x):
-    excel_file = pipe_C_data(x)
-    excel_file.to_excel('tmp_excel_file.xlsx')
-    with ZipFile("丙棟壓縮檔.zip", "w") as zipObj:
-        zipObj.write('tmp_excel_file.xlsx', '丙棟.xlsx')
-    os.remove('tmp_excel_file.xlsx')
-    return "丙棟壓縮檔.zip", gr.File(visible=True)
-
-
-def pipe_A_data(x):
-    A_class = ["HJ02", "HJ03", "HJ04", "HJ05", "HJ06", "HJ07", "HJ08", "HJ09", "HJ10", "HJ11", "HJ12",
-               "HJ61", "HJ62", "HJ63", "HJ64", "HJ65", "HJ66", "HJ67", "HJ68", "HJ69", "HJ70", "HJ71",
-               "HJ72", "HJ73", "HJ74"]
-    year = x.split('-')[0]
-    month = x.split('-')[-1]
-    for i in A_class:
-        en = []
-        rpa = f"RPA_{i}_TIC01_RKC_READ_PV"
-        en.append(rpa)
-        globals()[i + "_en"] = en
-    pisource = 'pi:\\10.114.134.1\\'
-    for i in A_class:
-        globals()[i + "_pitag"] = [pisource + element for element in globals()[i + "_en"]]
-
-    tag = [HJ02_pitag, HJ03_pitag, HJ04_pitag, HJ05_pitag, HJ06_pitag, HJ07_pitag, HJ08_pitag, HJ09_pitag, HJ10_pitag,
-           HJ11_pitag, HJ12_pitag, HJ61_pitag, HJ62_pitag, HJ63_pitag, HJ64_pitag, HJ65_pitag, HJ66_pitag, HJ67_pitag,
-           HJ68_pitag, HJ69_pitag, HJ70_pitag, HJ71_pitag, HJ72_pitag, HJ73_pitag, HJ74_pitag]
-
-    time_format = '%Y-%m-%d %H:%M:%S'
-
-    dates = get_month_dates(int(year), int(month))
-
-    pi_df = pd.DataFrame()
-
-    for date in dates:
-        start = datetime.datetime.combine(date, datetime.time(11, 0)) - datetime.timedelta(minutes=0)
-        end = datetime.datetime.combine(date, datetime.time(11, 0))
-
-        start_time = start.strftime(time_format)  # 注意这里使用了 strftime
-        end_time = end.strftime(time_format)  # 注意这里使用了 strftime
-
-        temp_rpa = pd.DataFrame()
-
-        for i in tag:
-            pi_data = data_export(start_time=start_time,
-                                  end_time=end_time,
-                                  tagpoint_list=i,
-                                  time_interval='1m').iloc[-1:, :]
-            temp_rpa = pd.concat([temp_rpa, pi_data], axis=1)
-
-        new_row = pd.DataFrame(temp_rpa.values, columns=temp_rpa.columns)
-
-        pi_df = pd.concat([pi_df, new_row], ignore_index=True)
-
-    pi_df.index = pi_df.index + 1
-
-    pi_df = pi_df.applymap(replace_dict_with_zero)
-
-    pi_df = pi_df.rename(columns={'RPA_HJ02_TIC01_RKC_READ_PV': "HJ02",
-                                  'RPA_HJ03_TIC01_RKC_READ_PV': "HJ03",
-                                  'RPA_HJ04_TIC01_RKC_READ_PV': "HJ04",
-                                  'RPA_HJ05_TIC01_RKC_READ_PV': "HJ05",
-                                  'RPA_HJ06_TIC01_RKC_READ_PV': "HJ06",
-                                  'RPA_HJ07_TIC01_RKC_READ_PV': "HJ07",
-                                  'RPA_HJ08_TIC01_RKC_READ_PV': "HJ08",
-                                  'RPA_HJ09_TIC01_RKC_READ_PV': "HJ09",
-                                  'RPA_HJ10_TIC01_RKC_READ_PV': "HJ10",
-                                  'RPA_HJ11_TIC01_RKC_READ_PV': "HJ11",
-                                  'RPA_HJ12_TIC01_RKC_READ_PV': "HJ12",
-                                  'RPA_HJ61_TIC01_RKC_READ_PV': "HJ61",
-                                  'RPA_HJ62_TIC01_RKC_READ_PV': "HJ62",
-                                  'RPA_HJ63_TIC01_RKC_READ_PV': "HJ63",
-                                  'RPA_HJ64_TIC01_RKC_READ_PV': "HJ64",
-                                  'RPA_HJ65_TIC01_RKC_READ_PV': "HJ65",
-                                  'RPA_HJ66_TIC01_RKC_READ_PV': "HJ66",
-                                  'RPA_HJ67_TIC01_RKC_READ_PV': "HJ67",
-                                  'RPA_HJ68_TIC01_RKC_READ_PV': "HJ68",
-                                  'RPA_HJ69_TIC01_RKC_READ_PV': "HJ69",
-                                  'RPA_HJ70_TIC01_RKC_READ_PV': "HJ70",
-                                  'RPA_HJ71_TIC01_RKC_READ_PV': "HJ71",
-                                  'RPA_HJ72_TIC01_RKC_READ_PV': "HJ72",
-                                  'RPA_HJ73_TIC01_RKC_READ_PV': "HJ73",
-                                  'RPA_HJ74_TIC01_RKC_READ_PV': "HJ74"})
-    pi_df_T = pi_df.T
-
-    # pi_df_T.to_excel('temp_A.xlsx')
-
-    pi_df_T.columns = pi_df_T.columns.astype(str)
-
-    return pi_df_T
-
-
-def pipe_B_data(x):
-    B_class = ["HJ15", "HJ16", "HJ17", "HJ18", "HJ19", "HJ20", "HJ21", "HJ22", "HJ23", "HJ24", "HJ25", "HJ26", "HJ27",
-               "HJ28", "HJ29", "HJ30", "HJ31"]
-    year = x.split('-')[0]
-    month = x.split('-')[-1]
-    for i in B_class:
-        en_B = []
-        rpb = f"RPB_{i}_TIC01_RKC_READ_PV"
-        en_B.append(rpb)
-        globals()[i + "_en"] = en_B
-    pisource = 'pi:\\10.114.134.1\\'
-    for i in B_class:
-        globals()[i + "_pitag"] = [pisource + element for element in globals()[i + "_en"]]
-
-    tag_B = [HJ15_pitag, HJ16_pitag, HJ17_pitag, HJ18_pitag, HJ19_pitag, HJ20_pitag, HJ21_pitag, HJ22_pitag, HJ23_pitag,
-             HJ24_pitag, HJ25_pitag, HJ26_pitag, HJ27_pitag, HJ28_pitag, HJ29_pitag, HJ30_pitag, HJ31_pitag]
-
-    time_format = '%Y-%m-%d %H:%M:%S'
-
-    dates = get_month_dates(int(year), int(month))
-
-    pi_df_B = pd.DataFrame()
-
-    for date in dates:
-        start = datetime.datetime.combine(date, datetime.time(11, 0)) - datetime.timedelta(minutes=0)
-        end = datetime.datetime.combine(date, datetime.time(11, 0))
-
-        start_time = start.strftime(time_format)  # 注意这里使用了 strftime
-        end_time = end.strftime(time_format)  # 注意这里使用了 strftime
-
-        temp_rpb = pd.DataFrame()
-
-        for i in tag_B:
-            pi_data = data_export(start_time=start_time,
-                                  end_time=end_time,
-                                  tagpoint_list=i,
-                                  time_interval='1m').iloc[-1:, :]
-            temp_rpb = pd.concat([temp_rpb, pi_data], axis=1)
-
-        new_row_B = pd.DataFrame(temp_rpb.values, columns=temp_rpb.columns)
-
-        pi_df_B = pd.concat([pi_df_B, new_row_B], ignore_index=True)
-
-    pi_df_B.index = pi_df_B.index + 1
-
-    pi_df_B = pi_df_B.applymap(replace_dict_with_zero)
-
-    pi_df_B = pi_df_B.rename(columns={'RPB_HJ15_TIC01_RKC_READ_PV': "HJ15",
-                                      'RPB_HJ16_TIC01_RKC_READ_PV': "HJ16",
-                                      'RPB_HJ17_TIC01_RKC_READ_PV': "HJ17",
-                                      'RPB_HJ18_TIC01_RKC_READ_PV': "HJ18",
-                                      'RPB_HJ19_TIC01_RKC_READ_PV': "HJ19",
-                                      'RPB_HJ20_TIC01_RKC_READ_PV': "HJ20",
-                                      'RPB_HJ21_TIC01_RKC_READ_PV': "HJ21",
-                                      'RPB_HJ22_TIC01_RKC_READ_PV': "HJ22",
-                                      'RPB_HJ23_TIC01_RKC_READ_PV': "HJ23",
-                                      'RPB_HJ24_TIC01_RKC_READ_PV': "HJ24",
-                                      'RPB_HJ25_TIC01_RKC_READ_PV': "HJ25",
-                                      'RPB_HJ26_TIC01_RKC_READ_PV': "HJ26",
-                                      'RPB_HJ27_TIC01_RKC_READ_PV': "HJ27",
-                                      'RPB_HJ28_TIC01_RKC_READ_PV': "HJ28",
-                                      'RPB_HJ29_TIC01_RKC_READ_PV': "HJ29",
-                                      'RPB_HJ30_TIC01_RKC_READ_PV': "HJ30",
-                                      'RPB_HJ31_TIC01_RKC_READ_PV': "HJ31"})
-    pi_df_B = pi_df_B.T
-
-    # pi_df_B.to_excel('temp_B.xlsx')
-
-    pi_df_B.columns = pi_df_B.columns.astype(str)
-
-    return pi_df_B
-
-
-def pipe_C_data(x):
-    C_class_1 = ["HJ84"]
-    C_class_2 = ["HJ83", "HJ82", "HJ81", "HJ75", "HJ76", "HJ78", "HJ79"]
-    C_class_3 = ["HJ44", "HJ45", "HJ46", "HJ47", "HJ48", "HJ49"]
-    year = x.split('-')[0]
-    month = x.split('-')[-1]
-    for i in C_class_1:
-        en = []
-        rpc = f"RPC_{i}_L_TIC01_RKC_READ_PV"
-        en.append(rpc)
-        globals()[i + "_en"] = en
-
-    for i in C_class_2:
-        en = []
-        rpc2 = f"RPC_{i}_TIC01_RKC_READ_PV"
-        en.append(rpc2)
-        globals()[i + "_en"] = en
-
-    for i in C_class_3:
-        en = []
-        rpc4 = f"RPC_{i}_M_TIC01_RKC_READ_PV"
-        en.append(rpc4)
-        globals()[i + "_en"] = en
+registry = load_registry()
 
-    pisource = 'pi:\\10.114.134.1\\'
+BUILDING_NAMES = dict(registry.buildings, ALL='全廠')
 
-    for i in C_class_1:
-        globals()[i + "_pitag"] = [pisource + element for element in globals()[i + "_en"]]
 
-    for i in C_class_2:
-        globals()[i + "_pitag"] = [pisource + element for element in globals()[i + "_en"]]
+# 等背景工作完成, 期間用 gr.Progress 顯示進度 (第幾天); 部分結果 (有格子逾時) 會跳出提醒
+# 使用者按取消時 Gradio 會關掉這個 generator, finally 放掉工作; 沒有人在等的工作會被取消
+def wait_export(job, progress):
+    try:
+        while not job.future.done():
+            progress(job.fraction(), desc=job.message)
+            yield gr.update(), gr.update(), gr.update()
+            time.sleep(0.5)
+        try:
+            pi_df, path = job.future.result()
+        except JobCancelled:
+            raise gr.Error("下載已取消")
+        missing = count_missing(pi_df)
+        if missing:
+            gr.Warning(f"PI 回應逾時, 有 {missing} 格沒有取得, 以 {MISSING_MARKER} 標示; 稍後重新下載即可補齊")
+        yield pi_df, path, gr.File(visible=True)
+    finally:
+        JOBS.release(job)
 
-    for i in C_class_3:
-        globals()[i + "_pitag"] = [pisource + element for element in globals()[i + "_en"]]
 
-    tag_C = [HJ44_pitag, HJ45_pitag, HJ46_pitag, HJ47_pitag, HJ48_pitag, HJ49_pitag, HJ75_pitag, HJ76_pitag,
-             HJ78_pitag, HJ79_pitag, HJ81_pitag, HJ82_pitag, HJ83_pitag, HJ84_pitag]
+# 一次點擊只抓一次資料, 同時給預覽表格與下載檔; 相同棟別/年月/格式/模式的請求共用同一個工作
+def export_A(x, fmt='xlsx', mode='snapshot', progress=gr.Progress()):
+    yield from wait_export(submit_export('A', x, pipe_A_data, BUILDING_NAMES['A'], fmt, mode), progress)
 
-    time_format = '%Y-%m-%d %H:%M:%S'
 
-    dates = get_month_dates(int(year), int(month))
+def export_B(x, fmt='xlsx', mode='snapshot', progress=gr.Progress()):
+    yield from wait_export(submit_export('B', x, pipe_B_data, BUILDING_NAMES['B'], fmt, mode), progress)
 
-    pi_df_C = pd.DataFrame()
 
-    for date in dates:
-        start = datetime.datetime.combine(date, datetime.time(11, 0)) - datetime.timedelta(minutes=0)
-        end = datetime.datetime.combine(date, datetime.time(11, 0))
+def export_C(x, fmt='xlsx', mode='snapshot', progress=gr.Progress()):
+    yield from wait_export(submit_export('C', x, pipe_C_data, BUILDING_NAMES['C'], fmt, mode), progress)
 
-        start_time = start.strftime(time_format)  # 注意这里使用了 strftime
-        end_time = end.strftime(time_format)  # 注意这里使用了 strftime
 
-        temp_rpc = pd.DataFrame()
+def export_all(x, fmt='xlsx', mode='snapshot', progress=gr.Progress()):
+    yield from wait_export(submit_export('ALL', x, pipe_all_data, BUILDING_NAMES['ALL'], fmt, mode), progress)
 
-        for i in tag_C:
-            pi_data = data_export(start_time=start_time,
-                                  end_time=end_time,
-                                  tagpoint_list=i,
-                                  time_interval='1m').iloc[-1:, :]
-            temp_rpc = pd.concat([temp_rpc, pi_data], axis=1)
 
-        new_row_C = pd.DataFrame(temp_rpc.values, columns=temp_rpc.columns)
+# 多個月 / 整年的區間匯出: 逐月抓取並寫入分區檔, 中斷後重按同樣的範圍會從沒做完的月份繼續
+def export_range_months(building, start, end, fmt='xlsx', mode='snapshot', progress=gr.Progress()):
+    if not start or not end or start > end:
+        raise gr.Error("請設定正確的起訖年月")
+    yield from wait_export(submit_range_export(building, start, end, BUILDING_NAMES[building], fmt, mode), progress)
 
-        pi_df_C = pd.concat([pi_df_C, new_row_C], ignore_index=True)
 
-    pi_df_C.index = pi_df_C.index + 1
-
-    pi_df_C = pi_df_C.applymap(replace_dict_with_zero)
-
-    pi_df_C = pi_df_C.rename(columns={'RPC_HJ44_M_TIC01_RKC_READ_PV': "HJ44",
-                                      'RPC_HJ45_M_TIC01_RKC_READ_PV': "HJ45",
-                                      'RPC_HJ46_M_TIC01_RKC_READ_PV': "HJ46",
-                                      'RPC_HJ47_M_TIC01_RKC_READ_PV': "HJ47",
-                                      'RPC_HJ48_M_TIC01_RKC_READ_PV': "HJ48",
-                                      'RPC_HJ49_M_TIC01_RKC_READ_PV': "HJ49",
-                                      'RPC_HJ75_TIC01_RKC_READ_PV': "HJ75",
-                                      'RPC_HJ76_TIC01_RKC_READ_PV': "HJ76",
-                                      'RPC_HJ78_TIC01_RKC_READ_PV': "HJ78",
-                                      'RPC_HJ79_TIC01_RKC_READ_PV': "HJ79",
-                                      'RPC_HJ81_TIC01_RKC_READ_PV': "HJ81",
-                                      'RPC_HJ82_TIC01_RKC_READ_PV': "HJ82",
-                                      'RPC_HJ83_TIC01_RKC_READ_PV': "HJ83",
-                                      'RPC_HJ84_L_TIC01_RKC_READ_PV': "HJ84"})
-
-    pi_df_C = pi_df_C.T
-
-    # pi_df_C.to_excel('temp_C.xlsx')
-
-    pi_df_C.columns = pi_df_C.columns.astype(str)
-
-    return pi_df_C
+pipe_A_data = building_pipe('A')
+pipe_B_data = building_pipe('B')
+pipe_C_data = building_pipe('C')
+pipe_all_data = building_pipe('ALL')
 
 
 def get_current_year():
@@ -379,6 +156,10 @@ def info_C():
     gr.Info("正在讀取丙棟資料，請稍後一分鐘~")
 
 
+def info_all():
+    gr.Info("正在讀取全廠資料，請稍後一分鐘~")
+
+
 seafoam = Seafoam()
 
 dropdown, js = create_theme_dropdown()
@@ -398,6 +179,9 @@ with gr.Blocks(theme=seafoam) as pi_data_C1:
         dt = gr.HTML(f"""<input type="month" id="month" name="month" value="{get_current_year()}-{get_current_month()}"
                                                         max="{get_current_year()}-{get_current_month()}">""")
         x = gr.Textbox(label='搜尋日期為:', value='YYYY-MM', interactive=False, visible=False)
+        fmt = gr.Radio(choices=list(FORMATS), value='xlsx', label='檔案格式 (大範圍建議 csv.gz / parquet)')
+        mode = gr.Radio(choices=[('每日 11:00 快照', 'snapshot'), ('每日統計 (最小/最大/平均/時間加權平均)', 'summary')],
+                        value='snapshot', label='報表內容')
     with gr.Row():
         with gr.Column():
             A_class = gr.Button(value='甲棟C1下載')
@@ -405,6 +189,21 @@ with gr.Blocks(theme=seafoam) as pi_data_C1:
             B_class = gr.Button(value='乙棟C1下載')
         with gr.Column():
             C_class = gr.Button(value='丙棟C1下載')
+        with gr.Column():
+            all_class = gr.Button(value='全廠C1下載')
+        with gr.Column():
+            cancel = gr.Button(value='取消下載', variant='stop')
+    with gr.Row():
+        gr.Markdown('## 多個月 / 整年下載 (可中斷, 重按相同範圍會接續):')
+    with gr.Row():
+        gr.HTML(f"""<input type="month" id="range_start" name="range_start" value="{get_current_year()}-01"
+                                                        max="{get_current_year()}-{get_current_month():02d}">
+                    ~ <input type="month" id="range_end" name="range_end" value="{get_current_year()}-{get_current_month():02d}"
+                                                        max="{get_current_year()}-{get_current_month():02d}">""")
+        range_start = gr.Textbox(value='YYYY-MM', interactive=False, visible=False)
+        range_end = gr.Textbox(value='YYYY-MM', interactive=False, visible=False)
+        range_building = gr.Dropdown(choices=[(v, k) for k, v in BUILDING_NAMES.items()], value='ALL', label='棟別')
+        range_class = gr.Button(value='區間C1下載')
     with gr.Row():
         with gr.Column():
             show_result = gr.Dataframe()
@@ -423,29 +222,74 @@ with gr.Blocks(theme=seafoam) as pi_data_C1:
 
     A_class.click(info_A, None, None)
 
-    A_class.click(pipe_A_data, inputs=x, outputs=show_result,
-                  js='(x) => {return (document.getElementById("month")).value;}')
-
-    A_class.click(download_files_A, inputs=x, outputs=[download_result, download_result],
-                  js='(x) => {return (document.getElementById("month")).value;}')
+    A_event = A_class.click(export_A, inputs=[x, fmt, mode], outputs=[show_result, download_result, download_result],
+                            concurrency_limit=None,
+                            js='(x, fmt, mode) => {return [(document.getElementById("month")).value, fmt, mode];}')
 
     B_class.click(info_B, None, None)
 
-    B_class.click(pipe_B_data, inputs=x, outputs=show_result,
-                  js='(x) => {return (document.getElementById("month")).value;}')
-
-    B_class.click(download_files_B, inputs=x, outputs=[download_result, download_result],
-                  js='(x) => {return (document.getElementById("month")).value;}')
+    B_event = B_class.click(export_B, inputs=[x, fmt, mode], outputs=[show_result, download_result, download_result],
+                            concurrency_limit=None,
+                            js='(x, fmt, mode) => {return [(document.getElementById("month")).value, fmt, mode];}')
 
     C_class.click(info_C, None, None)
 
-    C_class.click(pipe_C_data, inputs=x, outputs=show_result,
-                  js='(x) => {return (document.getElementById("month")).value;}')
+    C_event = C_class.click(export_C, inputs=[x, fmt, mode], outputs=[show_result, download_result, download_result],
+                            concurrency_limit=None,
+                            js='(x, fmt, mode) => {return [(document.getElementById("month")).value, fmt, mode];}')
+
+    all_class.click(info_all, None, None)
+
+    all_event = all_class.click(export_all, inputs=[x, fmt, mode], outputs=[show_result, download_result, download_result],
+                                concurrency_limit=None,
+                                js='(x, fmt, mode) => {return [(document.getElementById("month")).value, fmt, mode];}')
+
+    range_event = range_class.click(export_range_months, inputs=[range_building, range_start, range_end, fmt, mode],
+                                    outputs=[show_result, download_result, download_result],
+                                    concurrency_limit=None,
+                                    js='(b, start, end, fmt, mode) => {return [b, (document.getElementById("range_start")).value, '
+                                       '(document.getElementById("range_end")).value, fmt, mode];}')
+
+    cancel.click(None, None, None, cancels=[A_event, B_event, C_event, all_event, range_event])
+
+
+# 啟動一個 worker; 只有第 0 個跑預抓 (PREWARM), 避免多個程序重複向 PI 要同樣的資料
+def serve(worker_index=0):
+    if worker_index == 0:
+        PREWARM.start()
+    start_reporting(worker_index)
+    pi_data_C1.queue(default_concurrency_limit=QUEUE_CONCURRENCY)
+    pi_data_C1.launch(server_name=SERVER_NAME,
+                      server_port=SERVER_PORT + worker_index,
+                      allowed_paths=theme_asset_paths())
+
+
+# python execute_Block.py --workers 3: 開 3 個 worker 程序 (port 8787, 8788, 8789), 共用磁碟上的快取與成品
+# Gradio 的連線 (SSE) 要固定在同一個 worker, 前面的反向代理需用 ip_hash 之類的 sticky session (nginx_workers.conf, 見 README)
+def spawn_workers(n):
+    ports = ', '.join(str(SERVER_PORT + i) for i in range(n))
+    print(f"啟動 {n} 個 worker (port {ports}); 使用者要經過 sticky session 的反向代理連線, 設定範例見 nginx_workers.conf")
+    workers = [subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker-index', str(i)])
+               for i in range(n)]
+    try:
+        for worker in workers:
+            worker.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            if worker.poll() is None:
+                worker.terminate()
+        for worker in workers:
+            worker.wait()
 
-    C_class.click(download_files_C, inputs=x, outputs=[download_result, download_result],
-                  js='(x) => {return (document.getElementById("month")).value;}')
 
 if __name__ == "__main__":
-    pi_data_C1.launch(server_name='10.114.70.170',
-                      server_port=8787)
-
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=APP_WORKERS)
+    parser.add_argument('--worker-index', type=int)
+    args = parser.parse_args()
+    if args.worker_index is None and args.workers > 1:
+        spawn_workers(args.workers)
+    else:
+        serve(args.worker_index or 0)
@@ -0,0 +1,146 @@
+import calendar
+import datetime
+import threading
+
+import numpy as np
+
+from datascratch import fetch_at_times, fetch_daily_summary, plan_at_times, plan_daily_summary, SUMMARY_STATS
+from metrics import METRICS, profiled
+from month_matrix import MonthMatrix
+from tag_registry import load_registry
+
+
+def get_month_dates(year, month):
+    num_days = calendar.monthrange(year, month)[1]
+    dates = []
+    for day in range(1, num_days + 1):
+        date = datetime.date(year, month, day)
+        dates.append(date)
+    return dates
+
+
+# x = 'YYYY-MM', 已經結束的月份資料不會再變, 成品可以直接重用; 還沒結束的月份之後的日子目前補 0, 之後要重抓
+def is_closed_month(x, now=None):
+    now = now or datetime.datetime.now()
+    year, month = int(x.split('-')[0]), int(x.split('-')[-1])
+    return (year, month) < (now.year, now.month)
+
+
+# 該月每天的取樣時間點 (C1 報表預設早上 11:00, 由 tag_registry.json 的 snapshot_time 設定)
+def get_month_snapshot_times(x, registry=None):
+    registry = registry or load_registry()
+    year = x.split('-')[0]
+    month = x.split('-')[-1]
+    dates = get_month_dates(int(year), int(month))
+    return [datetime.datetime.combine(date, datetime.time(*registry.snapshot_time)) for date in dates]
+
+
+# 一次抓完任意多個棟別的月報 (buildings = None 代表全廠)
+# 所有 tag 共用同一次批次請求、同一個 session pool 與快取, 回傳 {棟別代碼: 報表 DataFrame}
+# 抓回來的值直接寫進預先配置的 MonthMatrix, 壞值/缺值沿用原本補 0 的規則
+# progress(完成天數, 總天數) 在每批資料寫入後呼叫; check() 可丟例外中止 (例如使用者取消)
+# 整體耗時記在 METRICS 的 month_export; 設了 PI_PROFILE_SLOW 時, 太慢的一次會存 cProfile 結果
+# 每日快照由 prewarm.py 預先抓進本機快取, 這裡通常只讀快取; 還沒到取樣時間的日子不向 PI 要資料, 維持補 0
+# 呼叫端設的期限 (fetch_engine.deadline) 到了還沒拿到的格子標成 MISSING_MARKER, 不會卡住或整份失敗
+def export_buildings_month(x, buildings=None, registry=None, progress=None, check=None):
+    registry = registry or load_registry()
+    codes = registry.building_codes() if buildings is None else list(buildings)
+    tags = registry.tags(codes)
+    times = get_month_snapshot_times(x, registry)
+    now = datetime.datetime.now()
+    due = [t for t in times if t <= now]
+
+    matrix = MonthMatrix([tag.display for tag in tags], len(times))
+    lock = threading.Lock()
+    filled = [0]
+
+    def on_values(rows, cols, block, good):
+        if check is not None:
+            check()
+        matrix.fill(rows, cols, block, good)
+        if progress is not None:
+            with lock:
+                filled[0] += len(rows) * len(cols)
+                days = filled[0] // len(tags)
+            progress(days, len(due))
+
+    if check is not None:
+        check()
+    if due:
+        with METRICS.timed('month_export'), profiled(f'month_export-{x}'):
+            fetch_at_times([tag.path for tag in tags], due, on_values, on_missing=matrix.mark_unavailable)
+
+    result = {}
+    offset = 0
+    for code in codes:
+        n = len(registry.tags([code]))
+        result[code] = matrix.to_frame(slice(offset, offset + n))
+        offset += n
+    return result
+
+
+# 每日統計模式: 每個 tag 每天的 最小/最大/平均/時間加權平均, 列名為 "顯示名稱 統計", 欄為 '1'..'N' 日
+# 優先用 PI summary 在 server 端計算, 不支援時才一天一段抓原始資料自己算; 只算已經結束的日子, 其餘補 0
+def export_buildings_month_summary(x, buildings=None, registry=None, progress=None, check=None, source='auto'):
+    registry = registry or load_registry()
+    codes = registry.building_codes() if buildings is None else list(buildings)
+    tags = registry.tags(codes)
+    year, month = int(x.split('-')[0]), int(x.split('-')[-1])
+    dates = get_month_dates(year, month)
+    today = datetime.date.today()
+    days = sum(1 for date in dates if date < today)
+
+    labels = [f'{tag.display} {stat}' for tag in tags for stat in SUMMARY_STATS]
+    matrix = MonthMatrix(labels, len(dates))
+    if check is not None:
+        check()
+    if days:
+        # 沒拿到的 (日, tag): 該 tag 的每一個統計列都標成缺
+        def on_missing(rows, cols):
+            stats = range(len(SUMMARY_STATS))
+            matrix.mark_unavailable(rows, [j * len(SUMMARY_STATS) + k for j in cols for k in stats])
+
+        def on_progress(done, total):
+            if check is not None:
+                check()
+            if progress is not None:
+                progress(done, total)
+
+        with METRICS.timed('month_summary'), profiled(f'month_summary-{x}'):
+            values = fetch_daily_summary([tag.path for tag in tags], dates[0], days, source, on_progress, on_missing)
+        rows = list(range(days))
+        for k, stat in enumerate(SUMMARY_STATS):
+            block = values[stat]
+            cols = [j * len(SUMMARY_STATS) + k for j in range(len(tags))]
+            matrix.fill(rows, cols, block, ~np.isnan(block))
+
+    result = {}
+    offset = 0
+    for code in codes:
+        n = len(registry.tags([code])) * len(SUMMARY_STATS)
+        result[code] = matrix.to_frame(slice(offset, offset + n))
+        offset += n
+    return result
+
+
+# 不送任何請求, 估算 export_buildings_month 會向 PI 送出幾個請求 (快取裡已有的格子不算)
+def plan_buildings_month(x, buildings=None, registry=None):
+    registry = registry or load_registry()
+    codes = registry.building_codes() if buildings is None else list(buildings)
+    now = datetime.datetime.now()
+    due = [t for t in get_month_snapshot_times(x, registry) if t <= now]
+    return plan_at_times([tag.path for tag in registry.tags(codes)], due)
+
+
+def plan_buildings_month_summary(x, buildings=None, registry=None, source='auto'):
+    registry = registry or load_registry()
+    codes = registry.building_codes() if buildings is None else list(buildings)
+    year, month = int(x.split('-')[0]), int(x.split('-')[-1])
+    today = datetime.date.today()
+    days = sum(1 for date in get_month_dates(year, month) if date < today)
+    return plan_daily_summary([tag.path for tag in registry.tags(codes)], days, source)
+
+
+# mode = 'snapshot': 每天 11:00 的值 (原本的 C1 報表); 'summary': 每天的 最小/最大/平均/時間加權平均
+EXPORT_MODES = {'snapshot': export_buildings_month, 'summary': export_buildings_month_summary}
+EXPORT_PLANS = {'snapshot': plan_buildings_month, 'summary': plan_buildings_month_summary}
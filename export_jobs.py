@@ -0,0 +1,198 @@
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from export_engine import EXPORT_MODES, is_closed_month
+from exporter import write_artifact, new_artifact_dir
+from fetch_engine import deadline
+from month_matrix import count_missing
+from range_export import RangeExport
+
+############################ Parameters
+RESULT_DIR = './export_results'
+RESULT_CACHE_SIZE = 36      # 最多保留幾份 (棟別, 年月) 的成品
+JOB_WORKERS = 2             # 背景同時跑幾個匯出工作, 其餘排隊
+MODE_SUFFIX = {'summary': '日統計'}   # 非快照模式的檔名後綴
+JOB_DEADLINE = 600          # 單月匯出最多等 PI 幾秒, 超過的格子標成 #N/A 先交出部分結果 (None = 不限)
+############################
+
+
+# (棟別, 年月, 格式, 模式) -> (DataFrame, 檔案路徑) 的 LRU 快取, 被擠掉的成品連同檔案一起刪除
+class ExportResultCache:
+    def __init__(self, max_size=RESULT_CACHE_SIZE):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            result = self._items.get(key)
+            if result is None or not os.path.exists(result[1]):
+                self._items.pop(key, None)
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return result
+
+    def put(self, key, result):
+        with self._lock:
+            self._items[key] = result
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                _, (_, zip_path) = self._items.popitem(last=False)
+                shutil.rmtree(os.path.dirname(zip_path), ignore_errors=True)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._items), 'hits': self.hits, 'misses': self.misses}
+
+
+RESULT_CACHE = ExportResultCache()
+
+
+class JobCancelled(Exception):
+    pass
+
+
+# 一個背景匯出工作: 回報進度 (已完成幾天 / 共幾天), 所有等待者都離開時自動取消
+class ExportJob:
+    def __init__(self, key):
+        self.key = key
+        self.future = None
+        self.done_units = 0
+        self.total_units = 0
+        self.message = '排隊中'
+        self.waiters = 0
+        self.cancelled = threading.Event()
+
+    def report(self, done, total, message=None):
+        self.done_units = done
+        self.total_units = total
+        self.message = message or f'已完成 {done}/{total} 天'
+
+    # 在工作內部定期呼叫, 被取消就丟 JobCancelled 中止
+    def check(self):
+        if self.cancelled.is_set():
+            raise JobCancelled(self.key)
+
+    def fraction(self):
+        return self.done_units / self.total_units if self.total_units else 0.0
+
+
+# 有上限的背景工作池; 相同 key (棟別, 年月, 格式, 模式) 的請求合併成同一個工作, 大家共用結果
+class JobScheduler:
+    def __init__(self, max_workers=JOB_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='export-job')
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.coalesced = 0
+
+    # fn(job) 在背景執行, 期間的 PI 請求最多等 timeout 秒; 回傳的 job 用完要呼叫 release
+    def submit(self, key, fn, timeout=JOB_DEADLINE):
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is None:
+                job = ExportJob(key)
+                job.future = self._executor.submit(self._run, job, fn, timeout)
+                self._jobs[key] = job
+                self.submitted += 1
+            else:
+                self.coalesced += 1
+            job.waiters += 1
+            return job
+
+    def _run(self, job, fn, timeout):
+        try:
+            job.check()
+            job.message = '讀取中'
+            with deadline(timeout):
+                return fn(job)
+        finally:
+            with self._lock:
+                if self._jobs.get(job.key) is job:
+                    del self._jobs[job.key]
+
+    # 等待者離開 (完成或取消); 沒有人在等的工作就取消, 不再浪費 PI 的資源
+    def release(self, job):
+        with self._lock:
+            job.waiters -= 1
+            if job.waiters <= 0 and not job.future.done():
+                job.cancelled.set()
+                if self._jobs.get(job.key) is job:
+                    del self._jobs[job.key]
+
+    def stats(self):
+        with self._lock:
+            return {'running': len(self._jobs), 'submitted': self.submitted, 'coalesced': self.coalesced}
+
+
+JOBS = JobScheduler()
+
+
+# job 由背景工作傳入, 用來回報進度與檢查是否被取消
+def _job_hooks(job):
+    if job is None:
+        return {}
+    return {'progress': job.report, 'check': job.check}
+
+
+# 棟別代碼 -> pipe(x, job, mode); 'ALL' 為全廠一次抓完, 各棟依序接在一起
+# pipe 不保留任何狀態, 每次呼叫的資料都在自己的 MonthMatrix 裡, 多個使用者同時下載互不影響
+def building_pipe(building):
+    def pipe(x, job=None, mode='snapshot'):
+        if building == 'ALL':
+            return pd.concat(list(EXPORT_MODES[mode](x, **_job_hooks(job)).values()))
+        return EXPORT_MODES[mode](x, [building], **_job_hooks(job))[building]
+    return pipe
+
+
+# 同一個 (棟別, 年月) 只算一次 DataFrame, 預覽與下載檔共用
+# 檔案先寫到這次請求專用的資料夾; 已結束的月份再搬進 RESULT_DIR 並放進 RESULT_CACHE
+# mode = 'snapshot' (每日 11:00 快照) 或 'summary' (每日統計), 兩種報表分開快取
+def run_export(building, x, pipe, name, fmt='xlsx', mode='snapshot'):
+    key = (building, x, fmt, mode)
+    result = RESULT_CACHE.get(key)
+    if result is not None:
+        return result
+    df = pipe(x)
+    if mode != 'snapshot':
+        name = f"{name}{MODE_SUFFIX.get(mode, mode)}"
+    folder = new_artifact_dir(f"{building}_{x}_{mode}_")
+    path = write_artifact(df, name, folder, fmt)
+    # 有格子沒拿到 (部分結果) 就不留成品, 下次重新抓
+    if is_closed_month(x) and not count_missing(df):
+        # 資料夾名稱本身就是唯一的, 搬過去不會跟其他請求衝突; 不會被過期清理掃掉
+        final = os.path.join(RESULT_DIR, os.path.basename(folder))
+        os.makedirs(RESULT_DIR, exist_ok=True)
+        os.rename(folder, final)
+        path = os.path.join(final, os.path.basename(path))
+        RESULT_CACHE.put(key, (df, path))
+    return df, path
+
+
+# 排入背景工作; pipe(x, job, mode) 透過 job.report 回報進度、job.check 檢查是否取消
+def submit_export(building, x, pipe, name, fmt='xlsx', mode='snapshot'):
+    return JOBS.submit((building, x, fmt, mode),
+                       lambda job: run_export(building, x, lambda x: pipe(x, job, mode), name, fmt, mode))
+
+
+# 多個月的區間匯出: 一個月一個 chunk 寫到 range_export 的工作資料夾, 取消或當機後重按會從沒做完的月份繼續
+# 結果沒有預覽表格, 只有下載檔; 期限改由 RangeExport 每個月各自計算, 整個工作不設上限
+def submit_range_export(building, start, end, name, fmt='xlsx', mode='snapshot'):
+    buildings = None if building == 'ALL' else [building]
+    if mode != 'snapshot':
+        name = f"{name}{MODE_SUFFIX.get(mode, mode)}"
+
+    def run(job):
+        export = RangeExport(start, end, buildings, mode, fmt, name)
+        return None, export.run(progress=job.report, check=job.check)
+
+    return JOBS.submit(('range', building, start, end, fmt, mode), run, timeout=None)
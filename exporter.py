@@ -0,0 +1,103 @@
+import gzip
+import os
+import shutil
+import tempfile
+import time
+from zipfile import ZipFile, ZIP_DEFLATED
+
+import pandas as pd
+
+from metrics import METRICS
+
+############################ Parameters
+ARTIFACT_DIR = './export_artifacts'
+ARTIFACT_TTL = 3600                 # 單次下載產生的檔案保留幾秒後自動刪除
+SPOOL_MAX_SIZE = 16 * 1024 * 1024   # 活頁簿先寫在記憶體, 超過這個大小才落到暫存檔
+FORMATS = ('xlsx', 'csv.gz', 'parquet')
+############################
+
+
+def _write_sheet(workbook, frame, sheet_name=None):
+    sheet = workbook.add_worksheet(sheet_name)
+    bold = workbook.add_format({'bold': True, 'border': 1, 'align': 'center'})
+    sheet.write_row(0, 1, [str(c) for c in frame.columns], bold)
+    for r, (label, row) in enumerate(zip(frame.index, frame.itertuples(index=False, name=None)), start=1):
+        sheet.write(r, 0, str(label), bold)
+        sheet.write_row(r, 1, row)
+
+
+# 依 xlsxwriter 的 constant_memory 模式逐列寫出, 不需要像 openpyxl 一樣保留整張表的 cell 物件
+# sheets = [(工作表名稱, DataFrame)] 可以是 generator, 一次只需要一張表在記憶體裡
+def _write_xlsx_sheets(sheets, f):
+    try:
+        import xlsxwriter
+    except ImportError:
+        with pd.ExcelWriter(f) as writer:
+            for sheet_name, frame in sheets:
+                frame.to_excel(writer, sheet_name=sheet_name or 'Sheet1')
+        return
+    workbook = xlsxwriter.Workbook(f, {'constant_memory': True, 'nan_inf_to_errors': True})
+    for sheet_name, frame in sheets:
+        _write_sheet(workbook, frame, sheet_name)
+    workbook.close()
+
+
+# 活頁簿寫進 spooled 暫存, 再直接串流進 zip, 工作目錄不會出現共用的暫存 xlsx
+def write_xlsx_zip(frame, name, zip_path):
+    return write_xlsx_sheets_zip([(None, frame)], name, zip_path)
+
+
+def write_xlsx_sheets_zip(sheets, name, zip_path):
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as spool:
+        _write_xlsx_sheets(sheets, spool)
+        spool.seek(0)
+        with ZipFile(zip_path, 'w', ZIP_DEFLATED) as zipObj, zipObj.open(f'{name}.xlsx', 'w') as entry:
+            shutil.copyfileobj(spool, entry)
+    return zip_path
+
+
+def write_csv_gz(frame, path):
+    with gzip.open(path, 'wt', encoding='utf-8-sig', newline='') as f:
+        frame.to_csv(f)
+    return path
+
+
+# 需要 pyarrow 或 fastparquet; parquet 欄位要同一型別, 逾時沒拿到的格子 (#N/A) 存成 null
+def write_parquet(frame, path):
+    frame = frame.copy()
+    frame.columns = [str(c) for c in frame.columns]
+    for column in frame.columns[frame.dtypes == object]:
+        frame[column] = pd.to_numeric(frame[column], errors='coerce')
+    frame.to_parquet(path)
+    return path
+
+
+# 依格式寫出到 folder, 回傳檔案路徑; xlsx 維持原本的 "甲棟壓縮檔.zip"
+@METRICS.wrap('export')
+def write_artifact(frame, name, folder, fmt='xlsx'):
+    if fmt == 'xlsx':
+        return write_xlsx_zip(frame, name, os.path.join(folder, f"{name}壓縮檔.zip"))
+    if fmt == 'csv.gz':
+        return write_csv_gz(frame, os.path.join(folder, f"{name}.csv.gz"))
+    if fmt == 'parquet':
+        return write_parquet(frame, os.path.join(folder, f"{name}.parquet"))
+    raise ValueError(f"unknown export format: {fmt}")
+
+
+# 每次請求一個獨立資料夾, 同時下載不會互相覆蓋; 順便清掉過期的舊資料夾
+def new_artifact_dir(prefix='export_'):
+    os.makedirs(ARTIFACT_DIR, exist_ok=True)
+    cleanup_artifacts()
+    return tempfile.mkdtemp(prefix=prefix, dir=ARTIFACT_DIR)
+
+
+def cleanup_artifacts(max_age=ARTIFACT_TTL):
+    if not os.path.isdir(ARTIFACT_DIR):
+        return
+    cutoff = time.time() - max_age
+    for entry in os.scandir(ARTIFACT_DIR):
+        try:
+            if entry.is_dir() and entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,270 @@
+import multiprocessing
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import contextmanager
+
+import requests
+
+from metrics import METRICS, bind_profile
+
+############################ Parameters
+MAX_WORKERS = 8                 # 同時進行的工作數
+MAX_CONCURRENT_REQUESTS = 6     # 整個程式同時打到 PI Web API 的請求上限
+MAX_RETRIES = 3                 # 暫時性錯誤最多重試幾次
+BACKOFF_BASE = 0.5              # 第一次重試最多等幾秒, 之後每次加倍
+BACKOFF_MAX = 10.0
+TRANSIENT_STATUS = (408, 429, 500, 502, 503, 504)
+HEDGE_PERCENTILE = 95           # 請求超過最近延遲的第幾百分位還沒回來, 就再送一份相同的請求 (0 = 不對沖)
+HEDGE_MIN_SAMPLES = 20          # 至少累積幾筆延遲才開始對沖
+HEDGE_MIN_DELAY = 0.05          # 對沖前最少等幾秒
+HEDGE_BUDGET = 0.1              # 對沖的請求最多佔全部請求的比例, 避免 PI 變慢時反而加倍負載
+HEDGE_WINDOW = 200              # 用最近幾筆延遲算百分位
+############################
+
+# 所有送往 PI 的 HTTP 請求都要先拿到一個名額 (datascratch.KeepAliveRESTClient 使用)
+REQUEST_SLOTS = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+_deadline = threading.local()
+
+
+# 目前執行緒剩下的時間 (秒), 沒有設期限時回傳 None
+def remaining():
+    at = getattr(_deadline, 'at', None)
+    return None if at is None else at - time.monotonic()
+
+
+# with deadline(秒數): 期間內所有 PI 請求 (包含 FETCH_ENGINE 分出去的執行緒) 都要在期限內完成
+# 巢狀使用時取比較早的期限; seconds = None 代表不另外限制
+@contextmanager
+def deadline(seconds):
+    previous = getattr(_deadline, 'at', None)
+    at = None if seconds is None else time.monotonic() + seconds
+    if previous is not None and (at is None or previous < at):
+        at = previous
+    _deadline.at = at
+    try:
+        yield
+    finally:
+        _deadline.at = previous
+
+
+# 期限已過就丟 DeadlineExceeded, 否則回傳剩下的秒數 (None = 沒有期限)
+def check_deadline():
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded('PI 請求超過期限')
+    return left
+
+
+# 每秒最多送出 rate 個 PI 請求, 多個程序共用 (next_at 放在共享記憶體, 要在建立子程序時傳進去)
+# context 要與建立子程序的 multiprocessing context 相同 (例如 spawn)
+# 每個請求先預約下一個空檔再睡到那個時間點, 鎖只包住預約本身; 要等的時間超過期限就直接丟 DeadlineExceeded
+class RateLimiter:
+    def __init__(self, rate, context=multiprocessing):
+        self.interval = 1.0 / rate
+        self.next_at = context.Value('d', 0.0, lock=False)
+        self.lock = context.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.time()
+            at = max(now, self.next_at.value)
+            left = remaining()
+            if left is not None and at - now > left:
+                raise DeadlineExceeded('等待 PI 請求速率上限超過期限')
+            self.next_at.value = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+
+_rate_limiter = None
+
+
+# 設定整個程序的請求速率上限 (None = 不限), batch_export 在每個 worker 程序啟動時呼叫
+def set_rate_limit(limiter):
+    global _rate_limiter
+    _rate_limiter = limiter
+
+
+# 每個送往 PI 的 HTTP 請求送出前呼叫 (datascratch.KeepAliveRESTClient)
+def throttle():
+    if _rate_limiter is not None:
+        _rate_limiter.acquire()
+
+
+# 把呼叫端執行緒的期限帶進 fn, 給 worker 執行緒使用
+def bind_deadline(fn):
+    at = getattr(_deadline, 'at', None)
+
+    def bound(*args):
+        previous = getattr(_deadline, 'at', None)
+        _deadline.at = at
+        try:
+            return fn(*args)
+        finally:
+            _deadline.at = previous
+    return bound
+
+
+# 期限到了或重試後仍是暫時性錯誤: 可以當作 "這部分沒拿到" 回傳部分結果的錯誤
+def is_incomplete(e):
+    return isinstance(e, DeadlineExceeded) or is_transient(e)
+
+
+# 連線中斷、逾時、伺服器忙碌這類錯誤重試通常會好
+def is_transient(e):
+    if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+        return True
+    return getattr(e, 'status', None) in TRANSIENT_STATUS
+
+
+# 有上限的執行緒池: 失敗的工作以 jitter 指數退避重試, 結果依照輸入順序回傳
+# 重試不會超過呼叫端的期限 (deadline); hedged() 對冪等的讀取請求做延遲對沖, 延遲分布依 key (端點與大小) 各自統計
+class FetchEngine:
+    def __init__(self, max_workers=MAX_WORKERS, max_retries=MAX_RETRIES,
+                 backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX, hedge_percentile=HEDGE_PERCENTILE,
+                 hedge_budget=HEDGE_BUDGET):
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_percentile = hedge_percentile
+        self.hedge_budget = hedge_budget
+        self._executor = None
+        self._hedge_executor = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._latencies = {}    # key -> 最近 HEDGE_WINDOW 筆延遲
+        self.retries = 0
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix='pi-fetch')
+            return self._executor
+
+    # 對沖用獨立的執行緒池, 不佔 map 的 worker
+    def _hedge_pool(self):
+        with self._lock:
+            if self._hedge_executor is None:
+                self._hedge_executor = ThreadPoolExecutor(max_workers=self.max_workers * 2,
+                                                          thread_name_prefix='pi-hedge')
+            return self._hedge_executor
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    # 執行 fn(*args), 暫時性錯誤重試, 其他錯誤直接拋出; 等下一次重試會超過期限就丟 DeadlineExceeded
+    def call(self, fn, *args):
+        attempt = 0
+        while True:
+            check_deadline()
+            try:
+                return fn(*args)
+            except Exception as e:
+                if attempt >= self.max_retries or not is_transient(e):
+                    raise
+                pause = self.backoff(attempt)
+                left = remaining()
+                if left is not None and left <= pause:
+                    raise DeadlineExceeded(f'PI 請求超過期限 (最後一次錯誤: {e!r})') from e
+                with self._lock:
+                    self.retries += 1
+                time.sleep(pause)
+                attempt += 1
+
+    # 同一個 key 最近延遲的 hedge_percentile 百分位; 樣本不夠或關閉對沖時回傳 None
+    def hedge_delay(self, key=None):
+        with self._lock:
+            latencies = self._latencies.get(key, ())
+            if self.hedge_percentile <= 0 or len(latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile / 100))
+        return max(HEDGE_MIN_DELAY, ordered[index])
+
+    def _timed(self, key, fn, *args):
+        t0 = time.monotonic()
+        result = fn(*args)
+        with self._lock:
+            self._latencies.setdefault(key, deque(maxlen=HEDGE_WINDOW)).append(time.monotonic() - t0)
+        return result
+
+    # 冪等的讀取請求: 超過同一個 key 的 hedge_delay 還沒回來就再送一份, 先成功的那份勝出
+    # key 要區分端點與回應大小, 小請求的延遲不能拿來判斷大請求; 大回應 (區間、統計) 不要走這裡
+    # 輸掉的那份請求無法中斷, 會在背景跑完後丟棄; 對沖數量受 hedge_budget 限制
+    def hedged(self, key, fn, *args):
+        with self._lock:
+            self.requests += 1
+        delay = self.hedge_delay(key)
+        if delay is None:
+            return self._timed(key, fn, *args)
+        first = self._hedge_pool().submit(bind_profile(bind_deadline(self._timed)), key, fn, *args)
+        done, _ = wait([first], timeout=delay)
+        with self._lock:
+            hedge = not done and self.hedges < self.hedge_budget * self.requests
+            if hedge:
+                self.hedges += 1
+        if not hedge:
+            return first.result()
+        METRICS.count('hedges')
+        second = self._hedge_pool().submit(bind_profile(bind_deadline(self._timed)), key, fn, *args)
+        pending = {first, second}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        with self._lock:
+                            self.hedge_wins += 1
+                        METRICS.count('hedge_wins')
+                    return future.result()
+            if not pending:
+                return first.result()
+
+    def stats(self):
+        with self._lock:
+            return {'retries': self.retries, 'requests': self.requests, 'hedges': self.hedges,
+                    'hedge_wins': self.hedge_wins}
+
+    def _run(self, fn, item, retry=True):
+        self._local.inside = True
+        try:
+            return self.call(fn, item) if retry else fn(item)
+        finally:
+            self._local.inside = False
+
+    # 平行執行 fn(item), 回傳與 items 同順序的結果
+    # 在 worker 裡再呼叫 map 時直接同步執行, 避免池子被自己塞滿而卡死
+    # fn 裡面已經會重試 (例如最後都走 datascratch._get_many) 時傳 retry=False, 否則每一層都重試, 次數會相乘
+    def map(self, fn, items, retry=True):
+        items = list(items)
+        if len(items) <= 1 or getattr(self._local, 'inside', False):
+            return [self.call(fn, item) if retry else fn(item) for item in items]
+        run = bind_profile(bind_deadline(self._run))
+        futures = [self._pool().submit(run, fn, item, retry) for item in items]
+        return [future.result() for future in futures]
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+            if self._hedge_executor is not None:
+                self._hedge_executor.shutdown(wait=True)
+                self._hedge_executor = None
+
+
+FETCH_ENGINE = FetchEngine()
@@ -0,0 +1,227 @@
+import bisect
+import cProfile
+import datetime
+import json
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+############################ Parameters
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)   # 秒
+METRICS_PORT = int(os.environ.get('PI_METRICS_PORT', 0))           # > 0 時開 /metrics (Prometheus 文字格式)
+METRICS_LOG_INTERVAL = int(os.environ.get('PI_METRICS_LOG', 0))    # > 0 時每隔幾秒印一行 JSON 統計
+PROFILE_SLOW = float(os.environ.get('PI_PROFILE_SLOW', 0))         # > 0 時, 超過幾秒的請求把 cProfile 結果存檔
+PROFILE_DIR = './profiles'
+############################
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.errors = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+# 各階段 (login, http, decode, export, predict, sql ...) 的次數 / 延遲分布 / 錯誤數, 以及一般計數器
+class Metrics:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._stages = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds, error=False):
+        with self._lock:
+            hist = self._stages.get(stage)
+            if hist is None:
+                hist = self._stages[stage] = _Histogram(self.buckets)
+            hist.observe(seconds)
+            if error:
+                hist.errors += 1
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    # with METRICS.timed('http'): ... 或當 decorator 用; 例外會算進該階段的錯誤數
+    @contextmanager
+    def timed(self, stage):
+        t0 = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.observe(stage, time.perf_counter() - t0, error=True)
+            raise
+        self.observe(stage, time.perf_counter() - t0)
+
+    def wrap(self, stage):
+        def decorator(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.timed(stage):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        with self._lock:
+            stages = {name: {'count': h.count, 'errors': h.errors, 'sum': round(h.sum, 4),
+                             'mean': round(h.sum / h.count, 4) if h.count else 0.0}
+                      for name, h in self._stages.items()}
+            return {'stages': stages, 'counters': dict(self._counters)}
+
+    def render_prometheus(self):
+        lines = ['# TYPE pi_stage_seconds histogram']
+        with self._lock:
+            for name, h in sorted(self._stages.items()):
+                cumulative = 0
+                for le, n in zip([str(b) for b in self.buckets] + ['+Inf'], h.counts):
+                    cumulative += n
+                    lines.append(f'pi_stage_seconds_bucket{{stage="{name}",le="{le}"}} {cumulative}')
+                lines.append(f'pi_stage_seconds_sum{{stage="{name}"}} {h.sum}')
+                lines.append(f'pi_stage_seconds_count{{stage="{name}"}} {h.count}')
+            lines.append('# TYPE pi_stage_errors_total counter')
+            for name, h in sorted(self._stages.items()):
+                lines.append(f'pi_stage_errors_total{{stage="{name}"}} {h.errors}')
+            for name, value in sorted(self._counters.items()):
+                lines.append(f'# TYPE pi_{name}_total counter')
+                lines.append(f'pi_{name}_total {value}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+
+
+# 在背景開一個只回應 GET /metrics 的 HTTP server
+def serve_metrics(port=METRICS_PORT, host='0.0.0.0', metrics=METRICS):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
+
+
+# 每 interval 秒印一行 JSON 統計 (給沒有 Prometheus 的環境看 log 用)
+def log_metrics(interval=METRICS_LOG_INTERVAL, metrics=METRICS):
+    def loop():
+        while True:
+            time.sleep(interval)
+            print(json.dumps({'time': datetime.datetime.now().isoformat(timespec='seconds'),
+                              'metrics': metrics.snapshot()}, ensure_ascii=False))
+
+    thread = threading.Thread(target=loop, name='metrics-log', daemon=True)
+    thread.start()
+    return thread
+
+
+# 依環境變數啟動 /metrics 與定期 log, 都沒設就什麼都不做
+# 多個 worker 程序時, 第 worker_index 個的 /metrics 開在 METRICS_PORT + worker_index
+def start_reporting(worker_index=0):
+    if METRICS_PORT > 0:
+        serve_metrics(METRICS_PORT + worker_index)
+    if METRICS_LOG_INTERVAL > 0:
+        log_metrics(METRICS_LOG_INTERVAL)
+
+
+_profile_lock = threading.Lock()
+_profile_local = threading.local()      # session: 這個執行緒目前在量的 profiled (worker 執行緒的結果要併進去)
+
+
+class _ProfileSession:
+    def __init__(self):
+        self.profilers = []
+        self._lock = threading.Lock()
+
+    def add(self, profiler):
+        with self._lock:
+            self.profilers.append(profiler)
+
+    # 呼叫端執行緒與各 worker 執行緒的結果合成一份 pstats
+    def stats(self, profiler):
+        stats = pstats.Stats(profiler)
+        with self._lock:
+            profilers = list(self.profilers)
+        for worker in profilers:
+            stats.add(worker)
+        return stats
+
+
+# profiled 進行中時, 把交給 worker 執行緒的 fn 包成也用 cProfile 量, 結果併進同一份 .prof (FetchEngine.map / hedged 使用)
+# worker 裡已經在量 (巢狀的 map / hedged) 就不再開一個; Python 3.12 起同時只能有一個 cProfile, 開不了就只量呼叫端執行緒
+def bind_profile(fn):
+    session = getattr(_profile_local, 'session', None)
+    if session is None:
+        return fn
+
+    def bound(*args):
+        if getattr(_profile_local, 'session', None) is not None:
+            return fn(*args)
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            return fn(*args)
+        _profile_local.session = session
+        try:
+            return fn(*args)
+        finally:
+            profiler.disable()
+            _profile_local.session = None
+            session.add(profiler)
+    return bound
+
+
+# 設了 PI_PROFILE_SLOW 才啟用: 整段用 cProfile 跑, 超過門檻就把結果存到 PROFILE_DIR/<name>-<時間>.prof
+# cProfile 同時只能有一個 profiled, 其他執行緒這時進來就直接跑不量測
+# 期間交給 FETCH_ENGINE 的抓取、解碼 (pi-fetch / pi-hedge 執行緒) 也會量到, 見 bind_profile;
+# 其他執行緒在這段時間送出的 FETCH_ENGINE 工作不會算進來
+@contextmanager
+def profiled(name, threshold=None):
+    threshold = PROFILE_SLOW if threshold is None else threshold
+    if threshold <= 0 or not _profile_lock.acquire(blocking=False):
+        yield
+        return
+    profiler = cProfile.Profile()
+    session = _ProfileSession()
+    t0 = time.perf_counter()
+    try:
+        _profile_local.session = session
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            _profile_local.session = None
+        elapsed = time.perf_counter() - t0
+        if elapsed > threshold:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            path = os.path.join(PROFILE_DIR, f"{name}-{datetime.datetime.now():%Y%m%d-%H%M%S}.prof")
+            session.stats(profiler).dump_stats(path)
+            print(f"{name} 花了 {elapsed:.2f}s, cProfile 結果存到 {path}")
+    finally:
+        _profile_lock.release()
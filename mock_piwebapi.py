@@ -0,0 +1,281 @@
+import argparse
+import base64
+import gzip
+import json
+import random
+import threading
+import time
+import zlib
+from datetime import datetime
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+############################ Parameters
+MOCK_PREFIX = '/piwebapi'
+MOCK_UTC_OFFSET_HOURS = 8       # 與 datascratch.UTC_OFFSET_HOURS 相同: 收到本地時間, 回傳 UTC
+MOCK_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+############################
+
+_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+_NO_DATA = {'Name': 'No Data', 'Value': 248, 'IsSystem': True}
+
+
+def _web_id(path):
+    return 'MOCK' + base64.urlsafe_b64encode(path.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+# PI 的 selectedFields: 'Items.WebId;Items.Items.Value' 這類以 ; 分隔的欄位路徑, list 逐項套用
+def select_fields(content, fields):
+    if isinstance(content, list):
+        return [select_fields(item, fields) for item in content]
+    if not isinstance(content, dict):
+        return content
+    tree = {}
+    for field in fields:
+        head, _, rest = field.partition('.')
+        tree.setdefault(head, []).append(rest)
+    return {key: value if '' in tree[key] else select_fields(value, tree[key])
+            for key, value in content.items() if key in tree}
+
+
+def _interval(text):
+    return timedelta(seconds=float(text[:-1]) * _UNITS[text[-1]])
+
+
+# 假資料: 由 (webId, 時間) 決定的數值, 同一格每次都一樣; bad_ratio 比例的格子回傳 PI 的壞值 dict
+def synthetic_value(web_id, t, bad_ratio=0.01):
+    seed = zlib.crc32(f'{web_id}|{t:%Y%m%d%H%M%S}'.encode())
+    if seed % 10000 < bad_ratio * 10000:
+        return _NO_DATA
+    return round(150 + (seed % 6000) / 100, 2)
+
+
+# 數值正常但 PI 標成 Good = false 的格子 (例如儀表校正中), suspect_ratio 比例, 與 bad_ratio 的格子不重疊
+def synthetic_good(web_id, t, value, suspect_ratio=0.0):
+    if isinstance(value, dict):
+        return False
+    seed = zlib.crc32(f'{web_id}|{t:%Y%m%d%H%M%S}'.encode())
+    return seed % 10000 < 10000 - suspect_ratio * 10000
+
+
+# 本機的 PI Web API 替身, 支援 home / points?path / streamsets (interpolated, interpolatedattimes, summary) /
+# streams/{webId}/interpolated 與 /batch, 以及 selectedFields 與 gzip; 可設定延遲 (秒, 加上 ±jitter) 與錯誤率 (回 503)
+# tail_rate 比例的請求額外延遲 tail_latency 秒, 模擬偶發的長尾; suspect_ratio 比例的格子回傳數值但 Good = false
+# recordings = {"/streamsets/interpolated?...": JSON} 的錄製檔, 完全相同的 resource 直接回放, 其餘用假資料
+class MockPIWebAPI:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0, bad_ratio=0.01,
+                 recordings=None, seed=0, tail_rate=0.0, tail_latency=0.0, suspect_ratio=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+        self.error_rate = error_rate
+        self.bad_ratio = bad_ratio
+        self.suspect_ratio = suspect_ratio
+        self.recordings = recordings or {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.sub_requests = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.bytes_raw = 0
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                mock._serve(self, None)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                mock._serve(self, json.loads(self.rfile.read(length) or b'{}'))
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}{MOCK_PREFIX}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='mock-piwebapi', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests = self.sub_requests = self.errors = self.bytes_sent = self.bytes_raw = 0
+
+    def stats(self):
+        with self._lock:
+            return {'requests': self.requests, 'sub_requests': self.sub_requests, 'errors': self.errors,
+                    'bytes_sent': self.bytes_sent, 'bytes_raw': self.bytes_raw}
+
+    def _serve(self, handler, body):
+        with self._lock:
+            self.requests += 1
+            fail = self.error_rate > 0 and self._random.random() < self.error_rate
+            delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+            if self.tail_rate > 0 and self._random.random() < self.tail_rate:
+                delay += self.tail_latency
+        if delay:
+            time.sleep(delay)
+        if fail:
+            status, content = 503, {'Errors': ['Injected error']}
+            with self._lock:
+                self.errors += 1
+        elif handler.command == 'POST':
+            status, content = self._batch(body)
+        else:
+            status, content = self.handle(handler.path)
+        payload = raw = json.dumps(content).encode('utf-8')
+        gzipped = 'gzip' in handler.headers.get('Accept-Encoding', '')
+        if gzipped:
+            payload = gzip.compress(raw, compresslevel=6)
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json; charset=utf-8')
+        if gzipped:
+            handler.send_header('Content-Encoding', 'gzip')
+        handler.send_header('Content-Length', str(len(payload)))
+        handler.end_headers()
+        try:
+            handler.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            # client 已經放棄 (逾時或對沖輸掉), 和真的 server 一樣不理它
+            return
+        with self._lock:
+            self.bytes_sent += len(payload)
+            self.bytes_raw += len(raw)
+
+    def _batch(self, body):
+        if not isinstance(body, dict):
+            return 400, {'Errors': ['Only /batch accepts POST']}
+        result = {}
+        for key, request in body.items():
+            status, content = self.handle(request['Resource'])
+            result[key] = {'Status': status, 'Headers': {}, 'Content': content}
+        return 207, result
+
+    # resource 可以是完整 URL 或 /piwebapi/... 路徑, 回傳 (HTTP status, JSON)
+    def handle(self, resource):
+        parts = urlsplit(resource)
+        path = parts.path[len(MOCK_PREFIX):] if parts.path.startswith(MOCK_PREFIX) else parts.path
+        path = path.rstrip('/')
+        key = path + ('?' + parts.query if parts.query else '')
+        with self._lock:
+            self.sub_requests += 1
+        if key in self.recordings:
+            return 200, self.recordings[key]
+        query = parse_qs(parts.query)
+        status, content = self._route(path, query)
+        if status == 200 and 'selectedFields' in query:
+            content = select_fields(content, query['selectedFields'][0].split(';'))
+        return status, content
+
+    def _route(self, path, query):
+        try:
+            if path == '':
+                return 200, {'Links': {'Self': MOCK_PREFIX + '/'}}
+            if path == '/points':
+                point_path = query['path'][0]
+                return 200, {'WebId': _web_id(point_path), 'Name': point_path.split('\\')[-1], 'Path': point_path}
+            if path == '/streamsets/interpolated':
+                times = self._range(query)
+                return 200, {'Items': [self._stream(w, times) for w in query['webId']]}
+            if path == '/streamsets/interpolatedattimes':
+                times = [datetime.strptime(t, MOCK_TIME_FORMAT) for t in query['time']]
+                return 200, {'Items': [self._stream(w, times) for w in query['webId']]}
+            if path == '/streamsets/summary':
+                return 200, {'Items': [self._summary(w, query) for w in query['webId']]}
+            if path.startswith('/streams/') and path.endswith('/interpolated'):
+                web_id = path.split('/')[2]
+                return 200, self._stream(web_id, self._range(query))
+        except (KeyError, ValueError) as e:
+            return 400, {'Errors': [repr(e)]}
+        return 404, {'Errors': [f'Unknown resource {path}']}
+
+    def _range(self, query):
+        start = datetime.strptime(query['startTime'][0], MOCK_TIME_FORMAT)
+        end = datetime.strptime(query['endTime'][0], MOCK_TIME_FORMAT)
+        step = _interval(query.get('interval', ['1h'])[0])
+        times = []
+        while start <= end:
+            times.append(start)
+            start += step
+        return times
+
+    # 每個 summaryDuration 區段用 10 分鐘網格的假資料算統計, 足夠驗證格式與數量
+    def _summary(self, web_id, query):
+        start = datetime.strptime(query['startTime'][0], MOCK_TIME_FORMAT)
+        end = datetime.strptime(query['endTime'][0], MOCK_TIME_FORMAT)
+        step = _interval(query.get('summaryDuration', ['1d'])[0])
+        items = []
+        while start < end:
+            samples = [synthetic_value(web_id, start + timedelta(minutes=10 * k), self.bad_ratio)
+                       for k in range(int(step.total_seconds() // 600) + 1)]
+            samples = [v for v in samples if not isinstance(v, dict)]
+            stats = {'Minimum': min(samples), 'Maximum': max(samples), 'Average': sum(samples) / len(samples)}
+            utc = start - timedelta(hours=MOCK_UTC_OFFSET_HOURS)
+            for summary_type in query.get('summaryType', ['Total']):
+                value = stats.get(summary_type, _NO_DATA)
+                items.append({'Type': summary_type, 'Value': {
+                    'Timestamp': utc.strftime('%Y-%m-%dT%H:%M:%SZ'), 'Value': value, 'UnitsAbbreviation': '',
+                    'Good': not isinstance(value, dict), 'Questionable': False, 'Substituted': False}})
+            start += step
+        return {'WebId': web_id, 'Items': items}
+
+    def _stream(self, web_id, times):
+        items = []
+        for t in times:
+            value = synthetic_value(web_id, t, self.bad_ratio)
+            utc = t - timedelta(hours=MOCK_UTC_OFFSET_HOURS)
+            items.append({'Timestamp': utc.strftime('%Y-%m-%dT%H:%M:%SZ'), 'Value': value, 'UnitsAbbreviation': '',
+                          'Good': synthetic_good(web_id, t, value, self.suspect_ratio), 'Questionable': False,
+                          'Substituted': False})
+        return {'WebId': web_id, 'Items': items}
+
+
+# 單獨執行: python mock_piwebapi.py --port 8800 --latency 0.05 --error-rate 0.01
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8800)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--bad-ratio', type=float, default=0.01)
+    parser.add_argument('--tail-rate', type=float, default=0.0)
+    parser.add_argument('--tail-latency', type=float, default=0.0)
+    parser.add_argument('--suspect-ratio', type=float, default=0.0)
+    parser.add_argument('--recordings')
+    args = parser.parse_args()
+    recordings = None
+    if args.recordings:
+        with open(args.recordings, encoding='utf-8') as f:
+            recordings = json.load(f)
+    mock = MockPIWebAPI(args.host, args.port, args.latency, args.jitter, args.error_rate, args.bad_ratio, recordings,
+                        tail_rate=args.tail_rate, tail_latency=args.tail_latency, suspect_ratio=args.suspect_ratio)
+    print(f'mock PI Web API: {mock.url}')
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        mock.server.server_close()
@@ -0,0 +1,108 @@
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from metrics import METRICS
+
+############################ Parameters
+MODEL_REGISTRY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model_registry.json')
+RELOAD_CHECK = 30       # 最多每幾秒檢查一次模型檔有沒有更新
+############################
+
+
+# 一個模型檔: 第一次用到才載入, 檔案的 (mtime, size) 變了就重新載入
+# 新檔載入失敗 (例如還在複製中) 就繼續用舊模型, 下次檢查再試
+class ModelSlot:
+    def __init__(self, path):
+        self.path = path
+        self.model = None
+        self.version = None
+        self.loads = 0
+        self._lock = threading.Lock()
+
+    def _stamp(self):
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def get(self, check=True):
+        if self.model is not None and not check:
+            return self.model
+        with self._lock:
+            try:
+                stamp = self._stamp()
+                if self.model is not None and stamp == self.version:
+                    return self.model
+                import joblib
+                # mmap_mode 讓模型裡的大型 numpy 陣列直接對應到檔案, 不用整份讀進記憶體
+                model = joblib.load(self.path, mmap_mode='r')
+            except Exception as e:
+                # 檔案暫時不見 (換檔中) 或載入失敗: 已有舊模型就繼續用, 下次檢查再試
+                if self.model is None:
+                    raise
+                print(f"模型 {self.path} 重新載入失敗, 繼續使用舊版: {e!r}")
+                return self.model
+            self.model = model
+            self.version = stamp
+            self.loads += 1
+            return self.model
+
+
+# 機台 -> 模型的對照表, 由 model_registry.json 設定, 沒列出的機台用 default
+# 同一個模型檔只載入一次, 共用同一個模型的機台合併成一次 predict
+class ModelRegistry:
+    def __init__(self, config, base_dir='.', reload_check=RELOAD_CHECK):
+        model_dir = os.path.normpath(os.path.join(base_dir, config.get('model_dir', '.')))
+        self.default = os.path.join(model_dir, config['default'])
+        self.machines = {machine: os.path.join(model_dir, path) for machine, path in config['machines'].items()}
+        self.reload_check = reload_check
+        self._slots = {}
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def path_for(self, machine):
+        return self.machines.get(machine, self.default)
+
+    # 多個執行緒同時要同一個模型檔時只建一個 ModelSlot, 模型只載入一次
+    def _slot(self, path):
+        with self._lock:
+            if path not in self._slots:
+                self._slots[path] = ModelSlot(path)
+            return self._slots[path]
+
+    def model_for(self, machine):
+        return self._slot(self.path_for(machine)).get()
+
+    # rows = {機台: 特徵 (1 列或多列)}, 回傳 {機台: 預測值陣列}
+    def predict(self, rows):
+        now = time.monotonic()
+        with self._lock:
+            check = now - self._checked >= self.reload_check
+            if check:
+                self._checked = now
+        groups = {}
+        for machine, features in rows.items():
+            groups.setdefault(self.path_for(machine), []).append(machine)
+        result = {}
+        for path, machines in groups.items():
+            features = [np.atleast_2d(np.asarray(rows[machine])) for machine in machines]
+            model = self._slot(path).get(check)
+            with METRICS.timed('predict'):
+                predicted = np.asarray(model.predict(np.vstack(features)))
+            offset = 0
+            for machine, block in zip(machines, features):
+                result[machine] = predicted[offset:offset + len(block)]
+                offset += len(block)
+        return result
+
+    def stats(self):
+        with self._lock:
+            slots = list(self._slots.items())
+        return {path: {'loaded': slot.model is not None, 'loads': slot.loads} for path, slot in slots}
+
+
+def load_model_registry(path=MODEL_REGISTRY_PATH):
+    with open(path, encoding='utf-8') as f:
+        return ModelRegistry(json.load(f), base_dir=os.path.dirname(os.path.abspath(path)))
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+
+from metrics import METRICS
+
+############################ Parameters
+MISSING_MARKER = '#N/A'     # 逾時或一直失敗而沒拿到的格子; 與壞值 (補 0) 區分, Excel 與 pandas.read_csv 都會當成缺值
+############################
+
+
+# 月報的欄式矩陣: values[tag, day] 事先配置好, valid 記錄哪些格子已經拿到好值
+# 抓資料時直接原地寫入, 最後一次轉成 UI 要的 (tag x 日) DataFrame, 不需要反覆 concat / 轉置
+# unavailable 記錄沒拿到的格子 (超過期限等), 輸出時標成 MISSING_MARKER
+class MonthMatrix:
+    def __init__(self, labels, n_days, dtype=np.float64):
+        self.labels = list(labels)
+        self.values = np.full((len(self.labels), n_days), np.nan, dtype=dtype)
+        self.valid = np.zeros((len(self.labels), n_days), dtype=bool)
+        self.unavailable = np.zeros((len(self.labels), n_days), dtype=bool)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    # 對應 datascratch.fetch_at_times 的 on_values: rows = 日 (時間) 位置, cols = tag 位置, block 為 [日 x tag]
+    def fill(self, rows, cols, block, good):
+        self.values[np.ix_(cols, rows)] = np.asarray(block).T
+        self.valid[np.ix_(cols, rows)] = np.asarray(good).T
+
+    # 對應 fetch_at_times 的 on_missing: rows = 日位置, cols = tag 位置
+    def mark_unavailable(self, rows, cols):
+        self.unavailable[np.ix_(cols, rows)] = True
+
+    # tags = 要輸出的列 (slice 或位置 list), 壞值/缺值補 fill_value, 沒拿到的格子為 MISSING_MARKER, 欄名為 '1'..'N' 日
+    @METRICS.wrap('assemble')
+    def to_frame(self, tags=slice(None), fill_value=0):
+        values = np.where(self.valid[tags], self.values[tags], fill_value)
+        unavailable = self.unavailable[tags]
+        if unavailable.any():
+            values = values.astype(object)
+            values[unavailable] = MISSING_MARKER
+        labels = self.labels[tags] if isinstance(tags, slice) else [self.labels[i] for i in tags]
+        columns = [str(day + 1) for day in range(self.values.shape[1])]
+        return pd.DataFrame(values, index=labels, columns=columns, copy=False)
+
+    def missing(self):
+        return int((~self.valid).sum())
+
+
+# 報表裡有幾格是 MISSING_MARKER (部分結果)
+def count_missing(frame):
+    if frame is None:
+        return 0
+    text = frame.select_dtypes(exclude='number')
+    return int((text == MISSING_MARKER).to_numpy().sum()) if text.shape[1] else 0
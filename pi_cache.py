@@ -0,0 +1,267 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from datetime import timedelta
+
+############################ Parameters
+CACHE_PATH = './pi_cache.sqlite'
+CACHE_SAFE_LAG = timedelta(minutes=30)   # 離現在太近的資料 PI 可能還會補值, 不快取
+CACHE_MAX_ROWS = 5000000                 # 超過就從最舊的開始刪
+CACHE_MAX_AGE = timedelta(days=400)      # 寫入超過這麼久的資料直接刪
+EVICT_EVERY = 20000                      # 每寫入幾筆檢查一次容量
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+SQLITE_MAX_PARAMS = 900
+WEBID_PATH = './pi_webids.json'
+WEBID_TTL = timedelta(days=7)            # tag 路徑 -> WebID 的對應多久重新查一次 (tag 重建後 WebID 會變)
+############################
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS points (
+    tag TEXT NOT NULL,
+    interval TEXT NOT NULL,
+    ts TEXT NOT NULL,
+    value TEXT,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (tag, interval, ts)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS windows (
+    tag TEXT NOT NULL,
+    interval TEXT NOT NULL,
+    start TEXT NOT NULL,
+    end TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (tag, interval, start)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS points_fetched_at ON points (fetched_at);
+CREATE INDEX IF NOT EXISTS windows_fetched_at ON windows (fetched_at);
+"""
+
+
+def _ts(t):
+    return t.strftime(TIME_FORMAT) if isinstance(t, datetime) else str(t)
+
+
+# 舊版快取可能存了 PI 的壞值 dict, 一律讀成 NaN
+def _load(value):
+    value = json.loads(value)
+    return value if type(value) in (float, int) else float('nan')
+
+
+def _chunks(items, size=SQLITE_MAX_PARAMS):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+# PI 歷史值的本機快取 (SQLite), key = (tag 路徑, 時間, interval)
+# interval = 'at' 代表 interpolatedattimes 取的單點值, 其他則是區間內插的取樣間隔
+# windows 表記錄哪些 (tag, 區段) 已經完整下載過, 區間查詢只補抓沒有的區段
+class PIValueCache:
+    def __init__(self, path=CACHE_PATH, max_rows=CACHE_MAX_ROWS, max_age=CACHE_MAX_AGE,
+                 safe_lag=CACHE_SAFE_LAG):
+        self.path = path
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.safe_lag = safe_lag
+        self._lock = threading.Lock()
+        self._conn = None
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.executescript(_SCHEMA)
+        return self._conn
+
+    # 只有確定不會再變動的歷史值才能進快取
+    def cacheable(self, t):
+        return t <= datetime.now() - self.safe_lag
+
+    # 回傳 {(tag, 'YYYY-mm-dd HH:MM:SS'): value}, 只包含快取裡有的
+    def get_points(self, tags, timestamps, interval='at'):
+        times = [_ts(t) for t in timestamps]
+        if not tags or not times:
+            return {}
+        wanted = set(times)
+        found = {}
+        with self._lock:
+            conn = self._connect()
+            for tag_chunk in _chunks(tags, SQLITE_MAX_PARAMS - 3):
+                rows = conn.execute(
+                    'SELECT tag, ts, value FROM points WHERE interval = ? AND ts BETWEEN ? AND ? '
+                    'AND tag IN ({})'.format(','.join('?' * len(tag_chunk))),
+                    [interval, min(times), max(times)] + tag_chunk)
+                for tag, ts, value in rows:
+                    if ts in wanted:
+                        found[(tag, ts)] = _load(value)
+        self.hits += len(found)
+        self.misses += len(tags) * len(wanted) - len(found)
+        return found
+
+    # rows: [(tag, 時間, value)], 不可快取的時間點會被略過
+    def put_points(self, rows, interval='at'):
+        now = time.time()
+        records = [(tag, interval, _ts(t), json.dumps(value), now)
+                   for tag, t, value in rows if self.cacheable(t)]
+        if not records:
+            return
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO points VALUES (?, ?, ?, ?, ?)', records)
+            self._writes += len(records)
+        self._maybe_evict()
+
+    # 回傳已完整快取的 (tag, 區段起點) 集合
+    def get_windows(self, tags, starts, interval):
+        starts = [_ts(t) for t in starts]
+        if not tags or not starts:
+            return set()
+        wanted = set(starts)
+        found = set()
+        with self._lock:
+            conn = self._connect()
+            for tag_chunk in _chunks(tags, SQLITE_MAX_PARAMS - 3):
+                rows = conn.execute(
+                    'SELECT tag, start FROM windows WHERE interval = ? AND start BETWEEN ? AND ? '
+                    'AND tag IN ({})'.format(','.join('?' * len(tag_chunk))),
+                    [interval, min(starts), max(starts)] + tag_chunk)
+                found.update((tag, start) for tag, start in rows if start in wanted)
+        return found
+
+    # 存一整個區段的資料並標記為完整; 區段結束時間不可快取時不做事
+    def put_window(self, tag, start, end, interval, series):
+        if not self.cacheable(end):
+            return
+        now = time.time()
+        records = [(tag, interval, _ts(t), json.dumps(value), now) for t, value in series]
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO points VALUES (?, ?, ?, ?, ?)', records)
+                conn.execute('INSERT OR REPLACE INTO windows VALUES (?, ?, ?, ?, ?)',
+                             (tag, interval, _ts(start), _ts(end), now))
+            self._writes += len(records)
+        self._maybe_evict()
+
+    # 讀出一個 tag 在區段內的資料 [(時間字串, value)]
+    def get_series(self, tag, start, end, interval):
+        with self._lock:
+            rows = self._connect().execute(
+                'SELECT ts, value FROM points WHERE tag = ? AND interval = ? AND ts BETWEEN ? AND ? ORDER BY ts',
+                (tag, interval, _ts(start), _ts(end))).fetchall()
+        return [(ts, _load(value)) for ts, value in rows]
+
+    def _maybe_evict(self):
+        if self._writes >= EVICT_EVERY:
+            self.evict()
+
+    # 先刪太舊的, 再把總筆數壓回 max_rows 以下 (從最早寫入的刪起)
+    def evict(self):
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                if self.max_age is not None:
+                    cutoff = time.time() - self.max_age.total_seconds()
+                    conn.execute('DELETE FROM points WHERE fetched_at < ?', (cutoff,))
+                    conn.execute('DELETE FROM windows WHERE fetched_at < ?', (cutoff,))
+                if self.max_rows is not None:
+                    count = conn.execute('SELECT COUNT(*) FROM points').fetchone()[0]
+                    if count > self.max_rows:
+                        cutoff = conn.execute('SELECT fetched_at FROM points ORDER BY fetched_at LIMIT 1 OFFSET ?',
+                                              (count - self.max_rows,)).fetchone()[0]
+                        conn.execute('DELETE FROM points WHERE fetched_at < ?', (cutoff,))
+                        # 區段裡的點被刪了就不算完整
+                        conn.execute('DELETE FROM windows WHERE fetched_at < ?', (cutoff,))
+            self._writes = 0
+
+    def stats(self):
+        with self._lock:
+            conn = self._connect()
+            rows = conn.execute('SELECT COUNT(*) FROM points').fetchone()[0]
+            windows = conn.execute('SELECT COUNT(*) FROM windows').fetchone()[0]
+        return {'rows': rows, 'windows': windows, 'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+# tag 路徑 -> WebID 的本機索引 (JSON 檔), 每個路徑只查一次, 超過 ttl 才重查
+# resolver(路徑 list) -> WebID list, 由呼叫端決定怎麼向 PI 查詢; 同時只有一個執行緒在查, 其他人等結果
+class WebIdIndex:
+    def __init__(self, path=WEBID_PATH, ttl=WEBID_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._entries = None
+        self._lock = threading.Lock()
+        self._resolve_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.path, encoding='utf-8') as f:
+                    self._entries = json.load(f)
+            except (FileNotFoundError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def _save(self):
+        # 多個程序 (multi-worker) 共用同一個檔案, 暫存檔名加上 pid 避免互相覆蓋
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self._entries, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, self.path)
+
+    def _missing(self, paths):
+        cutoff = time.time() - self.ttl.total_seconds()
+        entries = self._load()
+        return [p for p in dict.fromkeys(paths) if p not in entries or entries[p][1] < cutoff]
+
+    # 已知且未過期的 {路徑: WebID}, 不會向 PI 查詢 (估算請求數用)
+    def known(self, paths):
+        with self._lock:
+            missing = set(self._missing(paths))
+            return {p: self._entries[p][0] for p in paths if p not in missing}
+
+    def resolve(self, paths, resolver):
+        with self._lock:
+            missing = self._missing(paths)
+        if missing:
+            with self._resolve_lock:
+                # 等鎖的期間別人可能已經查好了
+                with self._lock:
+                    missing = self._missing(paths)
+                if missing:
+                    web_ids = resolver(missing)
+                    now = time.time()
+                    with self._lock:
+                        self._entries.update((p, [w, now]) for p, w in zip(missing, web_ids))
+                        self._save()
+        with self._lock:
+            self.misses += len(missing)
+            self.hits += len(paths) - len(missing)
+            return [self._entries[p][0] for p in paths]
+
+    # 路徑對應的 WebID 失效 (例如 tag 重建) 時手動清掉, 下次重查
+    def invalidate(self, paths=None):
+        with self._lock:
+            entries = self._load()
+            for p in (list(entries) if paths is None else paths):
+                entries.pop(p, None)
+            self._save()
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._load()), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,246 @@
+import datetime
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from fetch_engine import deadline
+from metrics import METRICS
+
+############################ Parameters
+POLL_HISTORY = 144          # 保留最近幾輪的耗時紀錄
+BACKFILL_CHUNK = 144        # 補抓時一批最多幾個 tick (600 秒週期 = 一天)
+BACKFILL_PAUSE = 5          # 每批補抓之間至少休息幾秒, 不要搶走即時輪的資源
+BACKFILL_GUARD = 30         # 離下一個即時 tick 不到幾秒就先不補抓, 等即時輪跑完
+CYCLE_DEADLINE = 0.8        # 每輪 PI 請求最多用掉週期的幾成; 超過就放棄這輪並記成空窗, 交給補抓
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+############################
+
+
+# 對齊牆上時鐘的下一個 tick: 以當天 00:00 為基準, 每 interval 一格 (600 秒 -> :00, :10, :20 ...)
+def next_tick(interval, now=None):
+    now = now or datetime.datetime.now()
+    midnight = datetime.datetime.combine(now.date(), datetime.time())
+    elapsed = (now - midnight).total_seconds()
+    return midnight + datetime.timedelta(seconds=(elapsed // interval + 1) * interval)
+
+
+# 記錄最後一個成功處理的 tick 與尚未補抓的區段 [(起, 迄)], 每次變動都原子寫回 json 檔
+# 程式重啟、PI 或資料庫斷線造成的空窗都會變成區段, 由 PollingEngine 的補抓執行緒依序處理
+class Checkpoint:
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = datetime.timedelta(seconds=interval)
+        self._lock = threading.Lock()
+        self.last_tick = None
+        self.gaps = []
+        try:
+            with open(path, encoding='utf-8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        if state.get('last_tick'):
+            self.last_tick = datetime.datetime.strptime(state['last_tick'], TIME_FORMAT)
+        self.gaps = [[datetime.datetime.strptime(t, TIME_FORMAT) for t in gap] for gap in state.get('gaps', [])]
+
+    def _save(self):
+        state = {'last_tick': self.last_tick.strftime(TIME_FORMAT) if self.last_tick else None,
+                 'gaps': [[t.strftime(TIME_FORMAT) for t in gap] for gap in self.gaps]}
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.path)
+
+    def mark_done(self, tick):
+        with self._lock:
+            if self.last_tick is None or tick > self.last_tick:
+                self.last_tick = tick
+                self._save()
+
+    # 加入 [start, end] 這段沒處理到的 tick, 與相鄰或重疊的區段合併
+    def add_gap(self, start, end):
+        if end < start:
+            return
+        with self._lock:
+            gaps = sorted(self.gaps + [[start, end]])
+            merged = [gaps[0]]
+            for gap in gaps[1:]:
+                if gap[0] <= merged[-1][1] + self.interval:
+                    merged[-1][1] = max(merged[-1][1], gap[1])
+                else:
+                    merged.append(gap)
+            self.gaps = merged
+            self._save()
+
+    # 重啟時: 上次最後處理的 tick 到這次第一個即時 tick 之間都算空窗
+    def add_downtime(self, first_live_tick):
+        if self.last_tick is not None:
+            self.add_gap(self.last_tick + self.interval, first_live_tick - self.interval)
+
+    # 最舊區段開頭的 limit 個 tick
+    def next_chunk(self, limit):
+        with self._lock:
+            if not self.gaps:
+                return []
+            start, end = self.gaps[0]
+            count = min(limit, int((end - start) / self.interval) + 1)
+            return [start + self.interval * k for k in range(count)]
+
+    # ticks 已補抓完成, 從最舊區段的開頭扣掉
+    def done_chunk(self, ticks):
+        with self._lock:
+            if not self.gaps or not ticks:
+                return
+            start, end = self.gaps[0]
+            following = ticks[-1] + self.interval
+            if following > end:
+                self.gaps.pop(0)
+            else:
+                self.gaps[0] = [following, end]
+            self._save()
+
+    def pending(self):
+        with self._lock:
+            return sum(int((end - start) / self.interval) + 1 for start, end in self.gaps)
+
+
+# 一輪的耗時拆解: with timer.stage('fetch'): ... 累計每個階段花的秒數
+class CycleTimer:
+    def __init__(self, tick):
+        self.tick = tick
+        self.started = datetime.datetime.now()
+        self.stages = {}
+        self.total = None
+        self._t0 = time.perf_counter()
+
+    @property
+    def lag(self):
+        return (self.started - self.tick).total_seconds()
+
+    @contextmanager
+    def stage(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - t0
+
+    def finish(self):
+        self.total = time.perf_counter() - self._t0
+
+    # 還沒 finish 時 (例如在 cycle 裡面呼叫) 回報目前為止的耗時
+    def summary(self):
+        total = self.total if self.total is not None else time.perf_counter() - self._t0
+        stages = ', '.join(f'{name} {sec:.2f}s' for name, sec in self.stages.items())
+        return f'tick {self.tick:%H:%M:%S} 延遲 {self.lag:.2f}s 共 {total:.2f}s ({stages})'
+
+
+# 每 interval 秒在對齊的時間點執行 cycle(tick, timer)
+# 下一輪的等待時間由下一個 tick 反推, 抓資料/推論/寫入花多久都不會讓週期漂移
+# 一輪跑超過 interval 視為 overrun: 回報並跳過已經錯過的 tick, 不會補跑堆積
+# 有 checkpoint 時, 失敗或跳過的 tick 與停機期間的空窗都記成區段, 由 backfill(ticks) 在背景一批一批補抓
+# 補抓每批最多 backfill_chunk 個 tick、批次間休息 backfill_pause 秒, 且會避開即時 tick, 不影響即時輪
+class PollingEngine:
+    def __init__(self, interval, cycle, history=POLL_HISTORY, checkpoint=None, backfill=None,
+                 backfill_chunk=BACKFILL_CHUNK, backfill_pause=BACKFILL_PAUSE):
+        self.interval = interval
+        self.cycle = cycle
+        self.history = deque(maxlen=history)
+        self.checkpoint = checkpoint
+        self.backfill = backfill
+        self.backfill_chunk = backfill_chunk
+        self.backfill_pause = backfill_pause
+        self.cycles = 0
+        self.errors = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.backfilled = 0
+        self._stop = threading.Event()
+        self._backfill_thread = None
+
+    def run_once(self, tick):
+        timer = CycleTimer(tick)
+        error = False
+        try:
+            with deadline(self.interval * CYCLE_DEADLINE):
+                self.cycle(tick, timer)
+        except Exception as e:
+            error = True
+            self.errors += 1
+            print(f"{datetime.datetime.now()} tick {tick:%H:%M:%S} 執行失敗: {e!r}")
+        timer.finish()
+        METRICS.observe('poll_cycle', timer.total, error)
+        self.cycles += 1
+        self.history.append(timer)
+        if self.checkpoint is not None:
+            if error:
+                self.checkpoint.add_gap(tick, tick)
+            else:
+                self.checkpoint.mark_done(tick)
+        return timer
+
+    def _backfill_loop(self):
+        while not self._stop.is_set():
+            ticks = self.checkpoint.next_chunk(self.backfill_chunk)
+            if not ticks:
+                self._stop.wait(self.interval)
+                continue
+            # 下一個即時 tick 快到了就先讓它
+            until_live = (next_tick(self.interval) - datetime.datetime.now()).total_seconds()
+            if until_live < min(BACKFILL_GUARD, self.interval / 4):
+                self._stop.wait(until_live + 1)
+                continue
+            try:
+                with METRICS.timed('backfill'), deadline(self.interval * CYCLE_DEADLINE):
+                    self.backfill(ticks)
+            except Exception as e:
+                print(f"{datetime.datetime.now()} 補抓 {ticks[0]} ~ {ticks[-1]} 失敗: {e!r}")
+                self._stop.wait(max(self.backfill_pause, self.interval / 2))
+                continue
+            self.checkpoint.done_chunk(ticks)
+            self.backfilled += len(ticks)
+            print(f"{datetime.datetime.now()} 已補抓 {ticks[0]} ~ {ticks[-1]} 共 {len(ticks)} 個 tick, "
+                  f"剩 {self.checkpoint.pending()} 個")
+            self._stop.wait(self.backfill_pause)
+
+    def run(self):
+        tick = next_tick(self.interval)
+        if self.checkpoint is not None:
+            self.checkpoint.add_downtime(tick)
+            if self.backfill is not None:
+                self._backfill_thread = threading.Thread(target=self._backfill_loop, name='backfill', daemon=True)
+                self._backfill_thread.start()
+        while not self._stop.is_set():
+            wait = (tick - datetime.datetime.now()).total_seconds()
+            if wait > 0 and self._stop.wait(wait):
+                break
+            timer = self.run_once(tick)
+            if timer.total > self.interval:
+                self.overruns += 1
+                print(f"{datetime.datetime.now()} overrun: {timer.summary()}")
+            following = next_tick(self.interval)
+            missed = int(round((following - tick).total_seconds() / self.interval)) - 1
+            if missed > 0:
+                self.skipped += missed
+                print(f"{datetime.datetime.now()} 跳過 {missed} 個已錯過的 tick")
+                if self.checkpoint is not None:
+                    step = datetime.timedelta(seconds=self.interval)
+                    self.checkpoint.add_gap(tick + step, following - step)
+            tick = following
+
+    def stop(self):
+        self._stop.set()
+
+    # 最近幾輪各階段的平均/最大耗時, 用來評估能不能把週期縮短
+    def stats(self):
+        stages = {}
+        for timer in self.history:
+            for name, sec in list(timer.stages.items()) + [('total', timer.total), ('lag', timer.lag)]:
+                stages.setdefault(name, []).append(sec)
+        return {'cycles': self.cycles, 'errors': self.errors, 'overruns': self.overruns, 'skipped': self.skipped,
+                'backfilled': self.backfilled,
+                'pending_backfill': self.checkpoint.pending() if self.checkpoint is not None else 0,
+                'stages': {name: {'mean': round(sum(v) / len(v), 3), 'max': round(max(v), 3)}
+                           for name, v in stages.items()}}
@@ -0,0 +1,103 @@
+import argparse
+import datetime
+import threading
+
+from datascratch import fetch_at_times, VALUE_CACHE
+from tag_registry import load_registry
+
+############################ Parameters
+PREWARM_DELAY = datetime.timedelta(minutes=35)   # 取樣時間過後多久再抓 (要超過 pi_cache.CACHE_SAFE_LAG 才會進快取)
+PREWARM_BACKFILL_DAYS = 62                       # 每次檢查最近幾天, 停機期間漏掉的日子一併補抓
+PREWARM_RETRY = datetime.timedelta(minutes=10)   # 抓失敗時多久後重試
+############################
+
+
+# 已經可以進快取的每日取樣時間點, 由舊到新, 最多 days 天
+def snapshot_times(days=PREWARM_BACKFILL_DAYS, now=None, registry=None):
+    registry = registry or load_registry()
+    now = now or datetime.datetime.now()
+    at = datetime.time(*registry.snapshot_time)
+    times = []
+    for back in range(days, -1, -1):
+        t = datetime.datetime.combine(now.date() - datetime.timedelta(days=back), at)
+        if VALUE_CACHE.cacheable(t):
+            times.append(t)
+    return times
+
+
+# 全廠所有 tag 的每日快照一次批次抓完寫進本機快取; 快取裡已經有的格子不會再向 PI 要
+# 回傳這次實際向 PI 抓回的格子數
+def prewarm(days=PREWARM_BACKFILL_DAYS, now=None, registry=None):
+    registry = registry or load_registry()
+    paths = registry.paths(registry.building_codes())
+    times = snapshot_times(days, now, registry)
+    before = VALUE_CACHE.misses
+    fetch_at_times(paths, times, lambda rows, cols, block, good: None)
+    return VALUE_CACHE.misses - before
+
+
+# 程式內的每日排程: 啟動時先補抓一次, 之後每天在取樣時間 + PREWARM_DELAY 執行
+class PrewarmScheduler:
+    def __init__(self, days=PREWARM_BACKFILL_DAYS, delay=PREWARM_DELAY, retry=PREWARM_RETRY):
+        self.days = days
+        self.delay = delay
+        self.retry = retry
+        self.last_run = None
+        self.last_error = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def next_run(self, now=None):
+        now = now or datetime.datetime.now()
+        run_at = datetime.datetime.combine(now.date(), datetime.time(*load_registry().snapshot_time)) + self.delay
+        return run_at if now < run_at else run_at + datetime.timedelta(days=1)
+
+    def run_once(self):
+        try:
+            fetched = prewarm(self.days)
+        except Exception as e:
+            self.last_error = e
+            print(f"{datetime.datetime.now()} 每日快照預抓失敗: {e!r}")
+            return False
+        self.last_run = datetime.datetime.now()
+        self.last_error = None
+        print(f"{self.last_run} 每日快照預抓完成, 向 PI 補抓 {fetched} 格")
+        return True
+
+    def _loop(self):
+        while not self._stop.is_set():
+            if self.run_once():
+                wait = self.next_run() - datetime.datetime.now()
+            else:
+                wait = self.retry
+            self._stop.wait(max(wait.total_seconds(), 1))
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name='prewarm', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+PREWARM = PrewarmScheduler()
+
+
+# 單獨執行: python prewarm.py (常駐) 或 python prewarm.py --once (交給 cron / 工作排程器)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--once', action='store_true')
+    parser.add_argument('--days', type=int, default=PREWARM_BACKFILL_DAYS)
+    args = parser.parse_args()
+    if args.once:
+        raise SystemExit(0 if PrewarmScheduler(args.days).run_once() else 1)
+    scheduler = PrewarmScheduler(args.days).start()
+    try:
+        scheduler._thread.join()
+    except KeyboardInterrupt:
+        scheduler.stop()
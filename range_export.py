@@ -0,0 +1,153 @@
+import json
+import os
+import shutil
+from zipfile import ZipFile, ZIP_STORED
+
+import pandas as pd
+
+from export_engine import EXPORT_MODES, is_closed_month
+from exporter import write_csv_gz, write_parquet, write_xlsx_sheets_zip
+from fetch_engine import deadline
+from metrics import METRICS
+from month_matrix import count_missing
+
+############################ Parameters
+RANGE_DIR = './export_ranges'      # 區間匯出的工作資料夾, 同一個 (範圍, 棟別, 模式, 格式) 重跑會接續
+MANIFEST = 'manifest.json'
+RANGE_MONTH_DEADLINE = 600         # 每個月最多等 PI 幾秒, 超過的格子標成 #N/A, 下次重跑時重抓該月
+############################
+
+# 'YYYY-MM' ~ 'YYYY-MM' 之間的每個月 (含頭尾)
+def month_range(start, end):
+    year, month = (int(v) for v in start.split('-'))
+    end_year, end_month = (int(v) for v in end.split('-'))
+    while (year, month) <= (end_year, end_month):
+        yield f'{year}-{month:02d}'
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+# 暫存檔名帶 pid: 多個 worker 程序剛好跑同一個範圍時各寫各的, 最後 os.replace 誰先誰後都是完整的檔案
+def _tmp(path):
+    return f'{path}.{os.getpid()}.tmp'
+
+
+def _month_frame(x, buildings, mode, progress=None, check=None):
+    hooks = {}
+    if check is not None:
+        hooks['check'] = check
+    if progress is not None:
+        hooks['progress'] = progress
+    frames = EXPORT_MODES[mode](x, buildings, **hooks)
+    return pd.concat(list(frames.values())) if len(frames) > 1 else next(iter(frames.values()))
+
+
+# 區間匯出: 一個月一個 chunk, 抓完立刻寫成分區檔並記進 manifest, 中斷後重跑只補沒完成的月份
+# 分區檔: csv.gz -> {月}.csv.gz, parquet -> month={月}/part-0.parquet, xlsx -> 先存 {月}.pkl,
+# 全部完成後再依序一個月一張工作表寫進活頁簿; 記憶體裡同時只有一個月的資料
+# 超過期限而有格子沒拿到的月份仍會寫出 (標成 #N/A), 但記在 partial, 下次重跑會重抓
+class RangeExport:
+    def __init__(self, start, end, buildings=None, mode='snapshot', fmt='xlsx', name='C1', root=RANGE_DIR):
+        self.months = list(month_range(start, end))
+        self.buildings = None if buildings is None else list(buildings)
+        self.mode = mode
+        self.fmt = fmt
+        self.name = name
+        scope = 'ALL' if self.buildings is None else '-'.join(self.buildings)
+        self.folder = os.path.join(root, f'{name}_{scope}_{start}_{end}_{mode}_{fmt.replace(".", "")}')
+        self.parts = os.path.join(self.folder, 'parts')
+        os.makedirs(self.parts, exist_ok=True)
+        self.done, self.partial = self._load_manifest()
+
+    def _load_manifest(self):
+        try:
+            with open(os.path.join(self.folder, MANIFEST), encoding='utf-8') as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return {}, set()
+        # 檔案不見的月份當作沒做
+        done = {x: part for x, part in manifest['done'].items() if os.path.exists(os.path.join(self.parts, part))}
+        return done, set(manifest.get('partial', ())) & set(done)
+
+    def _save_manifest(self):
+        path = os.path.join(self.folder, MANIFEST)
+        with open(_tmp(path), 'w', encoding='utf-8') as f:
+            json.dump({'months': self.months, 'mode': self.mode, 'fmt': self.fmt, 'done': self.done,
+                       'partial': sorted(self.partial)}, f, ensure_ascii=False, indent=1)
+        os.replace(_tmp(path), path)
+
+    # 還要抓的月份: 沒做過的、上次只拿到部分資料的, 以及還沒結束的月份 (之後的日子上次是補 0)
+    def pending(self):
+        return [x for x in self.months if x not in self.done or x in self.partial or not is_closed_month(x)]
+
+    def _write_part(self, x, frame):
+        if self.fmt == 'csv.gz':
+            part = f'{x}.csv.gz'
+            write_csv_gz(frame, _tmp(os.path.join(self.parts, part)))
+        elif self.fmt == 'parquet':
+            part = os.path.join(f'month={x}', 'part-0.parquet')
+            os.makedirs(os.path.join(self.parts, f'month={x}'), exist_ok=True)
+            write_parquet(frame, _tmp(os.path.join(self.parts, part)))
+        elif self.fmt == 'xlsx':
+            part = f'{x}.pkl'
+            frame.to_pickle(_tmp(os.path.join(self.parts, part)))
+        else:
+            raise ValueError(f"unknown export format: {self.fmt}")
+        os.replace(_tmp(os.path.join(self.parts, part)), os.path.join(self.parts, part))
+        return part
+
+    # 逐月產生 (年月, 分區檔路徑); 已完成的月份直接跳過
+    # progress(完成月數, 總月數, 訊息) 每個月結束時呼叫, check() 可丟例外中止 (下次從中止的月份繼續)
+    def chunks(self, progress=None, check=None):
+        total = len(self.months)
+        for x in self.pending():
+            if check is not None:
+                check()
+
+            def month_progress(done, days, x=x):
+                if progress is not None:
+                    progress(len(self.done), total, f'{x} 已完成 {done}/{days} 天')
+
+            with METRICS.timed('range_chunk'):
+                with deadline(RANGE_MONTH_DEADLINE):
+                    frame = _month_frame(x, self.buildings, self.mode, month_progress, check)
+                part = self._write_part(x, frame)
+            if count_missing(frame):
+                self.partial.add(x)
+            else:
+                self.partial.discard(x)
+            del frame
+            self.done[x] = part
+            self._save_manifest()
+            if progress is not None:
+                note = f', 其中 {len(self.partial)} 個月有逾時缺值' if self.partial else ''
+                progress(len(self.done), total, f'已完成 {len(self.done)}/{total} 個月{note}')
+            yield x, os.path.join(self.parts, part)
+
+    # 全部月份完成後打包成單一下載檔: xlsx 為一個月一張工作表的活頁簿 zip, 其餘為分區檔的 zip
+    def finalize(self):
+        todo = [x for x in self.months if x not in self.done]
+        if todo:
+            raise RuntimeError(f'尚未完成的月份: {", ".join(todo)}')
+        label = f'{self.name}_{self.months[0]}_{self.months[-1]}'
+        if self.fmt == 'xlsx':
+            sheets = ((x, pd.read_pickle(os.path.join(self.parts, self.done[x]))) for x in self.months)
+            return write_xlsx_sheets_zip(sheets, label, os.path.join(self.folder, f'{label}壓縮檔.zip'))
+        zip_path = os.path.join(self.folder, f'{label}.zip')
+        # csv.gz / parquet 本身已壓縮, zip 只是打包
+        with ZipFile(_tmp(zip_path), 'w', ZIP_STORED) as z:
+            for x in self.months:
+                z.write(os.path.join(self.parts, self.done[x]), self.done[x])
+        os.replace(_tmp(zip_path), zip_path)
+        return zip_path
+
+    def run(self, progress=None, check=None):
+        for _ in self.chunks(progress, check):
+            pass
+        return self.finalize()
+
+    def clear(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+def export_range(start, end, buildings=None, mode='snapshot', fmt='xlsx', name='C1', progress=None, check=None):
+    return RangeExport(start, end, buildings, mode, fmt, name).run(progress, check)
@@ -0,0 +1,102 @@
+import datetime
+import json
+import os
+import sqlite3
+import sys
+
+import joblib
+import numpy as np
+
+import Online
+from benchmark import mock_backend, _fresh_cache
+from mock_piwebapi import MockPIWebAPI
+from model_registry import ModelRegistry
+from poller import PollingEngine, Checkpoint, BACKFILL_CHUNK
+from sql_sink import SQLSink, SQLiteBackend
+from tag_registry import TagRegistry, REGISTRY_PATH
+
+############################ Parameters
+SMOKE_TICK = datetime.datetime(2024, 1, 15, 11, 0)   # 即時輪的 tick
+SMOKE_BACKFILL = 6                                   # 即時輪之前有幾個 tick 當成空窗補抓
+SMOKE_PATTERN = '{unit}_{channel}'                    # 假 PI server 不檢查 tag 是否存在, 機台 tag 名稱用這個代替
+############################
+
+
+# 假模型: 健康度 = 4 個特徵的平均 / 200, 確認 score 交給模型的是 [列 x (X, Y, C, T)]
+# 壞值是 NaN, 跟 CatBoost 一樣當成缺值處理 (不跳過)
+class DummyModel:
+    def predict(self, features):
+        assert features.shape[1] == 4, features.shape
+        return np.round(np.nanmean(features, axis=1) / 200, 4)
+
+
+# tag_registry.json 的機台設定, 沒設定 PI tag 名稱的 channel 補上 SMOKE_PATTERN
+def smoke_registry(path=REGISTRY_PATH):
+    with open(path, encoding='utf-8') as f:
+        config = json.load(f)
+    for channel in config['machines']['channels']:
+        channel['pattern'] = channel['pattern'] or SMOKE_PATTERN.replace('{channel}', channel['code'])
+    return TagRegistry(config)
+
+
+# Online.py 的冒煙測試: 假 PI server + SQLite + 假模型, 跑一次即時輪 (PollingEngine.run_once) 與一批補抓
+# 與正式環境走同一套 poll_cycle / backfill_cycle / score / SQLSink, 檢查寫進資料庫的列數與內容
+def smoke(tick=SMOKE_TICK, backfill=SMOKE_BACKFILL):
+    failures = []
+    saved = Online.models, Online.sql_sink, Online.registry, Online.all_machine, Online.tag, Online.all_tag
+    Online.use_registry(smoke_registry())
+    with MockPIWebAPI() as mock, mock_backend(mock) as folder:
+        _fresh_cache(folder)
+        joblib.dump(DummyModel(), os.path.join(folder, 'dummy.pkl'))
+        joblib.dump(DummyModel(), os.path.join(folder, 'dummy_KQ07.pkl'))
+        Online.models = ModelRegistry({'default': 'dummy.pkl', 'machines': {'KQ07': 'dummy_KQ07.pkl'}}, folder)
+
+        db = os.path.join(folder, 'health.sqlite')
+        with sqlite3.connect(db) as conn:
+            conn.execute('CREATE TABLE KQ_Health ({})'.format(', '.join(Online.SQL_COLUMNS)))
+        Online.sql_sink = SQLSink(SQLiteBackend(db), 'KQ_Health', Online.SQL_COLUMNS,
+                                  spool_path=os.path.join(folder, 'spool.jsonl'), background=False)
+        try:
+            checkpoint = Checkpoint(os.path.join(folder, 'checkpoint.json'), Online.POLL_INTERVAL)
+            engine = PollingEngine(Online.POLL_INTERVAL, Online.poll_cycle, checkpoint=checkpoint,
+                                   backfill=Online.backfill_cycle)
+            engine.run_once(tick)
+            if engine.errors:
+                failures.append('即時輪執行失敗')
+            if checkpoint.last_tick != tick:
+                failures.append(f'checkpoint 的 last_tick 為 {checkpoint.last_tick}, 應為 {tick}')
+
+            # 與 PollingEngine._backfill_loop 的一輪相同, 但不等下一個即時 tick
+            step = datetime.timedelta(seconds=Online.POLL_INTERVAL)
+            checkpoint.add_gap(tick - step * backfill, tick - step)
+            ticks = checkpoint.next_chunk(BACKFILL_CHUNK)
+            Online.backfill_cycle(ticks)
+            checkpoint.done_chunk(ticks)
+            if checkpoint.pending():
+                failures.append(f'補抓後還剩 {checkpoint.pending()} 個 tick')
+            Online.sql_sink.flush()
+
+            with sqlite3.connect(db) as conn:
+                rows = conn.execute('SELECT DT, Machine, Health, Status FROM KQ_Health').fetchall()
+        finally:
+            Online.sql_sink.close()
+            machines = len(Online.all_machine)
+            Online.models, Online.sql_sink, Online.registry, Online.all_machine, Online.tag, Online.all_tag = saved
+
+    expected = {t.strftime('%Y-%m-%d %H:%M:%S') for t in ticks + [tick]}
+    written = {dt for dt, _, _, _ in rows}
+    if len(rows) != machines * len(expected):
+        failures.append(f'寫入 {len(rows)} 列, 應為 {machines} 台 x {len(expected)} 個 tick')
+    if written != expected:
+        failures.append(f'寫入的時間 {sorted(written)} 與 tick 不符')
+    if not all(status == 1 and 0 < health < 2 for _, _, health, status in rows):
+        failures.append('有機台沒有算出健康度')
+    return {'ticks': len(expected), 'rows': len(rows), 'pi_requests': mock.stats()['requests'],
+            'failures': failures}
+
+
+# python smoke_online.py                   有錯誤時 exit code = 1
+if __name__ == '__main__':
+    report = smoke()
+    print(json.dumps(report, ensure_ascii=False, indent=1))
+    sys.exit(1 if report['failures'] else 0)
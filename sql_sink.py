@@ -0,0 +1,215 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import METRICS
+
+############################ Parameters
+SPOOL_PATH = './sql_spool.jsonl'
+SINK_BATCH_SIZE = 5000      # 一次 executemany 最多幾列 (重送 spool 時也用這個大小)
+SINK_POOL_SIZE = 2          # 連線池大小
+SINK_RETRY_INTERVAL = 30    # 資料庫連不上時, 隔幾秒再試
+############################
+
+
+# 後端只要提供 connect() 與 placeholder, SQL Server 與本機測試用的 SQLite 共用同一套流程
+class SQLiteBackend:
+    placeholder = '?'
+
+    def __init__(self, path):
+        self.path = path
+
+    def connect(self):
+        import sqlite3
+        return sqlite3.connect(self.path, check_same_thread=False)
+
+
+class MSSQLBackend:
+    placeholder = '%s'
+
+    def __init__(self, **connect_kwargs):
+        self.connect_kwargs = connect_kwargs
+
+    def connect(self):
+        import pymssql
+        return pymssql.connect(**self.connect_kwargs)
+
+
+# 簡單的連線池: 用完放回去重用, 出錯的連線直接丟掉, 下次重連
+class ConnectionPool:
+    def __init__(self, backend, max_size=SINK_POOL_SIZE):
+        self.backend = backend
+        self.max_size = max_size
+        self._idle = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def acquire(self):
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = self.backend.connect()
+        try:
+            yield conn
+        except Exception:
+            try:
+                conn.close()
+            except Exception:
+                pass
+            raise
+        with self._lock:
+            if len(self._idle) < self.max_size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+def _cell(v):
+    if v is None or v != v:         # NaN -> NULL
+        return None
+    return v.item() if hasattr(v, 'item') else v
+
+
+# 寫入 SQL 的 sink: 每輪的 DataFrame 先 append 到本機 spool 檔 (fsync, 程式掛掉也不會丟)
+# 背景執行緒再把 spool 裡還沒寫進資料庫的列用 executemany 整批寫入; 資料庫斷線時列會留在 spool, 恢復後一次補寫
+# 已寫入的位置記在 spool_path + '.offset', 全部寫完才清空 spool; 最壞情況 (寫入後、記錄位置前當機) 會重送一批
+class SQLSink:
+    def __init__(self, backend, table, columns, spool_path=SPOOL_PATH, batch_size=SINK_BATCH_SIZE,
+                 pool_size=SINK_POOL_SIZE, retry_interval=SINK_RETRY_INTERVAL, background=True):
+        self.pool = ConnectionPool(backend, pool_size)
+        self.columns = list(columns)
+        self.spool_path = spool_path
+        self.offset_path = spool_path + '.offset'
+        self.batch_size = batch_size
+        self.retry_interval = retry_interval
+        self.sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            table, ', '.join(self.columns), ', '.join([backend.placeholder] * len(self.columns)))
+        self.inserted = 0
+        self.failures = 0
+        self.last_error = None
+        self._spool_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        if background:
+            self._thread = threading.Thread(target=self._loop, name='sql-sink', daemon=True)
+            self._thread.start()
+
+    # 只做本機 append, 不會因為資料庫慢或斷線卡住呼叫端
+    def write(self, frame):
+        rows = [[_cell(v) for v in row] for row in frame[self.columns].itertuples(index=False, name=None)]
+        if not rows:
+            return 0
+        with self._spool_lock:
+            # 開新 spool 前位置一定要是 0 (上次清空 spool 時可能來不及歸零)
+            if not os.path.exists(self.spool_path):
+                self._write_offset(0)
+            with open(self.spool_path, 'a', encoding='utf-8') as f:
+                f.write(''.join(json.dumps(row, ensure_ascii=False) + '\n' for row in rows))
+                f.flush()
+                os.fsync(f.fileno())
+        if self._thread is None:
+            self.flush()
+        else:
+            self._wake.set()
+        return len(rows)
+
+    def _read_offset(self):
+        try:
+            with open(self.offset_path) as f:
+                return int(f.read() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _write_offset(self, offset):
+        tmp = self.offset_path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.offset_path)
+
+    @METRICS.wrap('sql')
+    def _insert(self, rows):
+        with self.pool.acquire() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.executemany(self.sql, rows)
+                conn.commit()
+            finally:
+                cursor.close()
+
+    # 把 spool 裡還沒寫入的列整批寫進資料庫, 回傳是否全部寫完
+    def flush(self):
+        with self._flush_lock:
+            offset = self._read_offset()
+            try:
+                with open(self.spool_path, 'rb') as f:
+                    # spool 被換掉 (位置超過檔案大小) 就從頭送, 寧可重複也不要漏
+                    if offset > os.fstat(f.fileno()).st_size:
+                        offset = 0
+                    f.seek(offset)
+                    while True:
+                        lines = [line for line in (f.readline() for _ in range(self.batch_size)) if line]
+                        # 寫到一半的最後一行 (還沒有換行) 留到下次
+                        if lines and not lines[-1].endswith(b'\n'):
+                            lines.pop()
+                        if not lines:
+                            break
+                        self._insert([json.loads(line) for line in lines])
+                        offset += sum(len(line) for line in lines)
+                        self.inserted += len(lines)
+                        self._write_offset(offset)
+                        f.seek(offset)
+            except FileNotFoundError:
+                return True
+            except Exception as e:
+                self.failures += 1
+                self.last_error = e
+                self.pool.clear()
+                print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} SQL 寫入失敗, 資料暫存在 {self.spool_path}: {e!r}")
+                return False
+            # 全部寫完: 沒有新資料進來的話就清空 spool
+            # 先刪 spool 再歸零位置: 中間當機只會留下過大的位置, 下次開新 spool 時歸零, 不會重送整份已寫入的 spool
+            with self._spool_lock:
+                if os.path.getsize(self.spool_path) == offset:
+                    os.remove(self.spool_path)
+                    self._write_offset(0)
+            return True
+
+    def pending_bytes(self):
+        try:
+            return os.path.getsize(self.spool_path) - self._read_offset()
+        except FileNotFoundError:
+            return 0
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.retry_interval)
+            self._wake.clear()
+            if not self.flush():
+                self._stop.wait(self.retry_interval)
+
+    # 結束前把 spool 盡量寫完
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        self.pool.clear()
+
+    def stats(self):
+        return {'inserted': self.inserted, 'failures': self.failures, 'pending_bytes': self.pending_bytes()}
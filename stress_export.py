@@ -0,0 +1,139 @@
+import argparse
+import importlib.util
+import io
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from zipfile import ZipFile
+
+import numpy as np
+import pandas as pd
+
+import export_jobs
+import exporter
+from benchmark import mock_backend, _fresh_cache
+from export_jobs import building_pipe, submit_export, JOBS, ExportResultCache
+from mock_piwebapi import MockPIWebAPI
+from tag_registry import load_registry
+
+############################ Parameters
+STRESS_USERS = 24                       # 同時按下載的使用者數
+STRESS_MONTHS = ('2024-01', '2024-02')
+STRESS_MODES = ('snapshot', 'summary')
+STRESS_LATENCY = 0.05                   # 假 PI server 每個請求的延遲 (秒)
+############################
+
+
+def _formats():
+    fmts = ['xlsx', 'csv.gz']
+    if importlib.util.find_spec('pyarrow') or importlib.util.find_spec('fastparquet'):
+        fmts.append('parquet')
+    return fmts
+
+
+def read_artifact(path, fmt):
+    if fmt == 'xlsx':
+        with ZipFile(path) as z:
+            return pd.read_excel(io.BytesIO(z.read(z.namelist()[0])), index_col=0)
+    if fmt == 'csv.gz':
+        return pd.read_csv(path, index_col=0, encoding='utf-8-sig')
+    return pd.read_parquet(path)
+
+
+# 列名、欄名、數值都要一樣 (#N/A 與 NaN 視為相同)
+def same_frame(frame, expected):
+    if frame.shape != expected.shape:
+        return False
+    if [str(v) for v in frame.index] != [str(v) for v in expected.index]:
+        return False
+    if [str(v) for v in frame.columns] != [str(v) for v in expected.columns]:
+        return False
+    a = frame.apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+    b = expected.apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+    return bool(np.allclose(a, b, equal_nan=True))
+
+
+# 對假 PI server 同時發出 users 個下載 (棟別 / 年月 / 模式 / 格式隨機), 走跟 UI 一樣的 submit_export
+# 結果與一個一個單獨跑的參考答案比對, 下載檔讀回來也要一樣; 不同請求的下載檔不能共用同一個路徑
+def stress(users=STRESS_USERS, months=STRESS_MONTHS, modes=STRESS_MODES, fmts=None, latency=STRESS_LATENCY,
+           seed=0):
+    registry = load_registry()
+    names = dict(registry.buildings, ALL='全廠')
+    buildings = list(names)
+    fmts = list(fmts or _formats())
+    rng = random.Random(seed)
+    plan = [(rng.choice(buildings), rng.choice(months), rng.choice(modes), rng.choice(fmts)) for _ in range(users)]
+
+    saved = exporter.ARTIFACT_DIR, export_jobs.RESULT_DIR, export_jobs.RESULT_CACHE
+    with MockPIWebAPI(latency=latency) as mock, mock_backend(mock) as folder:
+        exporter.ARTIFACT_DIR = os.path.join(folder, 'artifacts')
+        export_jobs.RESULT_DIR = os.path.join(folder, 'results')
+        export_jobs.RESULT_CACHE = ExportResultCache()
+        try:
+            _fresh_cache(folder)
+            expected = {}
+            for building, x, mode, _ in plan:
+                if (building, x, mode) not in expected:
+                    expected[(building, x, mode)] = building_pipe(building)(x, None, mode)
+
+            _fresh_cache(folder)
+            before = JOBS.stats()
+            barrier = threading.Barrier(users)
+
+            def user(request):
+                building, x, mode, fmt = request
+                barrier.wait()
+                t0 = time.perf_counter()
+                job = submit_export(building, x, building_pipe(building), names[building], fmt, mode)
+                try:
+                    frame, path = job.future.result()
+                finally:
+                    JOBS.release(job)
+                return time.perf_counter() - t0, frame, path
+
+            t0 = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=users) as pool:
+                results = list(pool.map(user, plan))
+            wall = time.perf_counter() - t0
+            after = JOBS.stats()
+
+            failures = []
+            owner = {}
+            for request, (_, frame, path) in zip(plan, results):
+                building, x, mode, fmt = request
+                reference = expected[(building, x, mode)]
+                if not same_frame(frame, reference):
+                    failures.append(f'{request}: 預覽表格與參考答案不同')
+                if not same_frame(read_artifact(path, fmt), reference):
+                    failures.append(f'{request}: 下載檔內容與參考答案不同')
+                if owner.setdefault(path, request) != request:
+                    failures.append(f'{request}: 與 {owner[path]} 共用同一個下載檔 {path}')
+        finally:
+            exporter.ARTIFACT_DIR, export_jobs.RESULT_DIR, export_jobs.RESULT_CACHE = saved
+
+    latencies = sorted(r[0] for r in results)
+    return {'users': users, 'distinct_requests': len(set(plan)), 'wall_s': round(wall, 3),
+            'p50_s': round(latencies[len(latencies) // 2], 3),
+            'p95_s': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3),
+            'jobs': after['submitted'] - before['submitted'], 'coalesced': after['coalesced'] - before['coalesced'],
+            'pi_requests': mock.stats()['requests'], 'failures': failures}
+
+
+# python stress_export.py                  24 個使用者同時下載, 有錯誤時 exit code = 1
+# python stress_export.py --users 60 --latency 0.2
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=STRESS_USERS)
+    parser.add_argument('--months', nargs='+', default=list(STRESS_MONTHS))
+    parser.add_argument('--modes', nargs='+', default=list(STRESS_MODES))
+    parser.add_argument('--formats', nargs='+')
+    parser.add_argument('--latency', type=float, default=STRESS_LATENCY)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    report = stress(args.users, args.months, args.modes, args.formats, args.latency, args.seed)
+    print(json.dumps(report, ensure_ascii=False, indent=1))
+    sys.exit(1 if report['failures'] else 0)
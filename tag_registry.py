@@ -0,0 +1,88 @@
+import json
+import os
+from collections import namedtuple
+from functools import lru_cache
+
+############################ Parameters
+REGISTRY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tag_registry.json')
+############################
+
+# building = 棟別代碼, unit = 機台, name = PI tag 名稱, path = PI 完整路徑, display = 報表上顯示的名稱
+Tag = namedtuple('Tag', ['building', 'unit', 'name', 'path', 'display'])
+
+
+# 棟別 / tag 命名規則 / 顯示名稱的註冊表, 由 tag_registry.json 載入並建好索引
+class TagRegistry:
+    def __init__(self, config):
+        self.pi_server = config['pi_server']
+        hour, minute = config.get('snapshot_time', '11:00').split(':')
+        self.snapshot_time = (int(hour), int(minute))
+        self.buildings = {}
+        self._tags = {}
+        self.by_path = {}
+        for building in config['buildings']:
+            code = building['code']
+            self.buildings[code] = building['name']
+            tags = []
+            for group in building['groups']:
+                for unit in group['units']:
+                    name = group['pattern'].format(unit=unit)
+                    display = group.get('display', building.get('display', '{unit}')).format(unit=unit)
+                    tag = Tag(code, unit, name, self.pi_server + name, display)
+                    tags.append(tag)
+                    self.by_path[tag.path] = tag
+            self._tags[code] = tags
+        # Online.py 監控的機台: 每台的 tag 依 channels 順序排列 (building 為 None, 不屬於任何棟別報表)
+        # pattern 為 null 代表 PI tag 名稱還沒設定, 這時 machine_tags() 直接丟錯, 不會去抓不存在的 tag
+        machines = config.get('machines', {'units': [], 'channels': []})
+        self.channels = [channel['code'] for channel in machines['channels']]
+        self.unconfigured_channels = [channel['code'] for channel in machines['channels'] if not channel.get('pattern')]
+        self._machine_units = list(machines['units'])
+        self._machine_tags = {}
+        for unit in self._machine_units if not self.unconfigured_channels else []:
+            tags = []
+            for channel in machines['channels']:
+                name = channel['pattern'].format(unit=unit)
+                tag = Tag(None, unit, name, self.pi_server + name, channel['display'].format(unit=unit))
+                tags.append(tag)
+                self.by_path[tag.path] = tag
+            self._machine_tags[unit] = tags
+
+    def building_codes(self):
+        return list(self.buildings)
+
+    def building_name(self, code):
+        return self.buildings[code]
+
+    # codes = None 代表全部棟別
+    def tags(self, codes=None):
+        codes = self.building_codes() if codes is None else codes
+        return [tag for code in codes for tag in self._tags[code]]
+
+    def paths(self, codes=None):
+        return [tag.path for tag in self.tags(codes)]
+
+    def machine_codes(self):
+        return list(self._machine_units)
+
+    # units = None 代表全部機台
+    def machine_tags(self, units=None):
+        if self.unconfigured_channels:
+            raise ValueError('tag_registry.json 的 machines 還沒設定 PI tag 名稱 (pattern): '
+                             + ', '.join(self.unconfigured_channels))
+        units = self.machine_codes() if units is None else units
+        return [tag for unit in units for tag in self._machine_tags[unit]]
+
+    def machine_paths(self, units=None):
+        return [tag.path for tag in self.machine_tags(units)]
+
+    # PI tag 名稱 -> 報表顯示名稱, 取代原本手寫的 rename dict
+    def display_map(self, codes=None):
+        return {tag.name: tag.display for tag in self.tags(codes)}
+
+
+# 整個程式只讀一次
+@lru_cache(maxsize=None)
+def load_registry(path=REGISTRY_PATH):
+    with open(path, encoding='utf-8') as f:
+        return TagRegistry(json.load(f))
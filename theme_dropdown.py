@@ -1,48 +1,86 @@
+import hashlib
+import json
 import os
 import pathlib
 
-from gradio.themes.utils import ThemeAsset
+############################ Parameters
+APP_DIR = pathlib.Path(__file__).parent
+THEME_SOURCES = [APP_DIR / "themes", APP_DIR]     # themes/*.json 與根目錄的 themes_*.json
+THEME_CACHE_DIR = APP_DIR / "theme_cache"          # 編譯好的 CSS, 檔名帶主題檔的 hash
+############################
+
+
+def _theme_files():
+    files = []
+    for folder in THEME_SOURCES:
+        if folder.is_dir():
+            pattern = "*.json" if folder.name == "themes" else "themes_*.json"
+            files.extend(sorted(folder.glob(pattern)))
+    return files
+
+
+def _version(path):
+    # 檔名格式 theme_schema@0.0.1.json / themes_theme_schema@0.0.1.json, 版本在 @ 與 .json 之間
+    return path.name.rsplit("@", 1)[-1][: -len(".json")]
+
+
+# 主題檔內容的 hash 當 key: 主題沒變就直接用快取的 CSS, 不必 gr.Theme.load + 產生 CSS
+# 回傳 {版本: CSS 檔路徑}, 由新到舊排序
+def compile_theme_css(cache_dir=THEME_CACHE_DIR):
+    cache_dir = pathlib.Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    compiled = {}
+    for path in _theme_files():
+        version = _version(path)
+        digest = hashlib.sha256(path.read_bytes()).hexdigest()[:16]
+        css_path = cache_dir / f"theme-{version}-{digest}.css"
+        if not css_path.exists():
+            import gradio as gr
+
+            css = gr.Theme.load(str(path))._get_theme_css()
+            # 多個 worker 程序同時啟動時各寫各的暫存檔
+            tmp = css_path.with_suffix(f".{os.getpid()}.tmp")
+            tmp.write_text(css, encoding="utf-8")
+            os.replace(tmp, css_path)
+        compiled[version] = css_path
+    # 清掉主題檔已經改過的舊 CSS
+    keep = set(compiled.values())
+    for old in cache_dir.glob("theme-*.css"):
+        if old not in keep:
+            old.unlink(missing_ok=True)
+
+    def version_key(version):
+        return tuple(int(p) if p.isdigit() else 0 for p in version.split("."))
+
+    return dict(sorted(compiled.items(), key=lambda item: version_key(item[0]), reverse=True))
+
+
+# launch(allowed_paths=...) 要開放的目錄, 前端才能用 file= 取得 CSS
+def theme_asset_paths():
+    return [str(THEME_CACHE_DIR)]
 
 
 def create_theme_dropdown():
     import gradio as gr
 
-    asset_path = pathlib.Path(__file__).parent / "themes"
-    themes = []
-    for theme_asset in os.listdir(str(asset_path)):
-        themes.append(
-            (ThemeAsset(theme_asset), gr.Theme.load(str(asset_path / theme_asset)))
-        )
-
-    def make_else_if(theme_asset):
-        return f"""
-        else if (theme == '{str(theme_asset[0].version)}') {{
-            var theme_css = `{theme_asset[1]._get_theme_css()}`
-        }}"""
-
-    head, tail = themes[0], themes[1:]
-    if_statement = f"""
-        if (theme == "{str(head[0].version)}") {{
-            var theme_css = `{head[1]._get_theme_css()}`
-        }} {" ".join(make_else_if(t) for t in tail)}
-    """
-
-    latest_to_oldest = sorted([t[0] for t in themes], key=lambda asset: asset.version)[
-        ::-1
-    ]
-    latest_to_oldest = [str(t.version) for t in latest_to_oldest]
+    compiled = compile_theme_css()
+    latest_to_oldest = list(compiled)
+    urls = {version: str(path.resolve()).replace("\\", "/") for version, path in compiled.items()}
 
     component = gr.Dropdown(
         choices=latest_to_oldest,
-        value=latest_to_oldest[0],
+        value=latest_to_oldest[0] if latest_to_oldest else None,
         render=False,
         label="Select Version",
     )
 
+    # 只把 {版本: CSS 檔路徑} 放進 JS, 選到某個版本時才向 server 取那一份 CSS, 取過的留在瀏覽器裡
     return (
         component,
         f"""
-        (theme) => {{
+        async (theme) => {{
+            const paths = {json.dumps(urls)};
+            window.__themeCss = window.__themeCss || {{}};
             if (!document.querySelector('.theme-css')) {{
                 var theme_elem = document.createElement('style');
                 theme_elem.classList.add('theme-css');
@@ -50,8 +88,17 @@ def create_theme_dropdown():
             }} else {{
                 var theme_elem = document.querySelector('.theme-css');
             }}
-            {if_statement}
-            theme_elem.innerHTML = theme_css;
+            if (!(theme in paths)) {{
+                return;
+            }}
+            if (!(theme in window.__themeCss)) {{
+                let response = await fetch('gradio_api/file=' + paths[theme]);
+                if (!response.ok) {{
+                    response = await fetch('file=' + paths[theme]);
+                }}
+                window.__themeCss[theme] = await response.text();
+            }}
+            theme_elem.innerHTML = window.__themeCss[theme];
         }}
     """,
-    )
\ No newline at end of file
+    )